@@ -7,6 +7,20 @@ agi     - python wrapper for agi
 agitb   - a module to assist in agi debugging, like cgitb
 config  - a module for parsing asterisk config files
 manager - a module for interacting with the asterisk manager interface
+asyncmanager
+        - the manager interface for asyncio (python 3 only)
+stats   - instrumentation of the manager interface
+channels
+        - live channel table maintained from manager events
+peers   - SIP/PJSIP peer table maintained from manager events
+queues  - real-time queue statistics from manager events
+multiplex
+        - many manager connections driven by one thread
+cluster - actions on many asterisk servers in parallel
+pool    - pool of manager sessions to one asterisk
+originate
+        - rate governed bulk originate
+cache   - response cache for read-only manager actions
 
 """
 
@@ -1,7 +1,8 @@
 import socket
 from   signal import SIGTERM
 from   os import fork, kill, waitpid
-from   time import sleep
+from   threading import Thread
+from   asterisk.compat import to_str, to_bytes
 
 class Event(dict):
     """ Events are encoded as dicts with a header fieldname to
@@ -42,9 +43,11 @@ class Event(dict):
 
     def as_string(self, id):
         ret = []
-        if 'Response' in self:
+        # responses and events of list actions (which contain an
+        # ActionID placeholder) get the ActionID of the action
+        if 'Response' in self or 'ActionID' in self:
             self ['ActionID'] = [id]
-        for k,v in sorted(self.iteritems(), key=self.sort):
+        for k,v in sorted(self.items(), key=self.sort):
             if k == 'CONTENT':
                 ret.append(v)
             else :
@@ -93,6 +96,8 @@ class AsteriskEmu(object):
 
     def __init__(self, chatscript, port = 0):
         s = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+        # allow restarting an emulator on the same port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('localhost', port))
         s.listen(1)
         pid = fork()
@@ -107,33 +112,58 @@ class AsteriskEmu(object):
         """ Emulate asterisk management interface on a socket.
             Chatscript is a dict of command names to event list mapping.
             The event list contains events to send when the given
-            command is recognized.
+            command is recognized. Each connection is handled in its
+            own thread.
         """
         while True:
             conn, addr = sock.accept()
-            f = conn.makefile('rw')
-            conn.close()
-            f.write('Asterisk Call Manager/1.1\r\n')
-            f.flush()
-            cmd = lastid = ''
-            try:
-                for l in f:
-                    if l.startswith ('ActionID:'):
-                        lastid = l.split(':', 1)[1].strip()
-                    elif l.startswith ('Action:'):
-                        cmd = l.split(':', 1)[1].strip()
-                    elif not l.strip():
-                        for d in chatscript, self.default_events:
-                            if cmd in d:
-                                for event in d[cmd]:
-                                    f.write(event.as_string(id = lastid))
-                                    f.flush()
-                                    if cmd == 'Logoff':
-                                        f.close()
-                                break
-            except:
-                pass
-            sleep(10000) # wait for being killed
+            t = Thread(target = self.converse, args = (conn, chatscript))
+            t.setDaemon(True)
+            t.start()
+
+    def converse(self, conn, chatscript):
+        """ Talk to one client. After a login with 'Events: off' only
+            responses and the events of list actions (those with an
+            ActionID) are sent.
+        """
+        # a text mode file in python 3 loses the data read ahead when
+        # writing, pipelined actions would never be answered
+        reader = conn.makefile('rb')
+        writer = conn.makefile('wb')
+        conn.close()
+        def send(text):
+            writer.write(to_bytes(text))
+            writer.flush()
+        send('Asterisk Call Manager/1.1\r\n')
+        cmd = lastid = ''
+        events = send_events = True
+        try:
+            for l in reader:
+                l = to_str(l)
+                if l.startswith ('ActionID:'):
+                    lastid = l.split(':', 1)[1].strip()
+                elif l.startswith ('Action:'):
+                    cmd = l.split(':', 1)[1].strip()
+                elif l.startswith ('Events:'):
+                    events = l.split(':', 1)[1].strip() != 'off'
+                elif not l.strip():
+                    if cmd == 'Login':
+                        send_events = events
+                    for d in chatscript, self.default_events:
+                        if cmd in d:
+                            for event in d[cmd]:
+                                if not send_events and 'Event' in event \
+                                    and 'ActionID' not in event:
+                                    continue
+                                send(event.as_string(id = lastid))
+                                if cmd == 'Logoff':
+                                    writer.close()
+                                    reader.close()
+                            break
+                    cmd = lastid = ''
+                    events = True
+        except:
+            pass
 
     def close(self):
         if self.childpid:
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Asyncio Interface for Asterisk Manager
+
+This module provides the API of asterisk.manager for use with asyncio
+(python 3.7 and later). All actions are coroutines, messages are parsed
+with the same ManagerMsg and Event classes as the threaded manager, and
+no threads are used: reading, event dispatching and the callers all run
+on one event loop. Event callbacks may be plain functions or coroutine
+functions.
+
+   import asyncio
+   import asterisk.manager
+   import asterisk.asyncmanager
+
+   async def handle_event(event, manager):
+      print ("Received event: %s" % event.name)
+
+   async def main():
+      manager = asterisk.asyncmanager.AsyncManager()
+      try:
+          await manager.connect('host')
+          await manager.login('user', 'secret')
+
+          # register some callbacks
+          manager.register_event('*', handle_event)
+
+          # get a status report
+          response = await manager.status()
+      except asterisk.manager.ManagerException as reason:
+          print ("Error: %s" % reason)
+      finally:
+          # remember to clean up
+          await manager.close()
+
+   asyncio.run(main())
+"""
+
+import asyncio
+import inspect
+import os
+import socket
+from collections import OrderedDict
+from asterisk.compat import string_types
+from asterisk.manager import _Actions, _Framer, ManagerMsg, Event, \
+    _event_mask, ManagerException, ManagerSocketException, ManagerAuthException
+
+class AsyncManager(_Actions):
+    # size of the reads from the socket
+    recv_size = 65536
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._framer = None
+        self._backlog = []
+        self.title = None     # set by received greeting
+        self.version = None
+        self._connected = False
+
+        # our hostname
+        self.hostname = socket.gethostname()
+        # pid -- used for unique naming of ActionID
+        self.pid      = os.getpid ()
+        self._seq = 0
+
+        # futures of send_action waiting for a response by ActionID
+        self._pending = OrderedDict()
+
+        # callbacks for events
+        self._event_callbacks = {}
+        self._event_queue = None
+        self._tasks = []
+
+    def connected(self):
+        """
+        Check if we are connected or not.
+        """
+        return self._connected
+
+    def next_seq(self):
+        """Return the next number in the sequence, this is used for ActionID"""
+        try:
+            return self._seq
+        finally:
+            self._seq += 1
+
+    async def send_action(self, cdict={}, **kwargs):
+        """
+        Send a command to the manager and wait for the response, see
+        Manager.send_action.
+        """
+
+        if not self._connected:
+            raise ManagerException("Not connected")
+
+        actionid, command = self._build_action(cdict, kwargs)
+        if actionid in self._pending:
+            raise ManagerException('Duplicate ActionID %s' % actionid)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[actionid] = future
+        try:
+            try:
+                self._writer.write(command.encode('utf-8'))
+                await self._writer.drain()
+            except OSError as err:
+                raise ManagerSocketException(err.errno, err.strerror)
+            response = await future
+        finally:
+            self._pending.pop(actionid, None)
+
+        if not response:
+            raise ManagerSocketException(0, 'Connection Terminated')
+
+        return response
+
+    async def _read_messages(self):
+        """
+        Read data until at least one message is complete, return the
+        list of complete messages or None on EOF.
+        """
+
+        while True:
+            data = await self._reader.read(self.recv_size)
+            if not data:
+                return None
+            messages = self._framer.feed(data)
+            if self._framer.title and not self.title:
+                self.title = self._framer.title
+                self.version = self._framer.version
+            if messages:
+                return messages
+
+    def _route_response(self, message):
+        """Resolve the future waiting for this response"""
+        actionid = message.get_header('ActionID')
+        if actionid is None:
+            # no ActionID, hand it to the oldest waiter
+            future = None
+            if self._pending:
+                actionid, future = self._pending.popitem(last=False)
+        else:
+            future = self._pending.pop(actionid, None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    async def message_loop(self):
+        """
+        The reading task, receives all types of messages and routes
+        them to the waiting actions or the event queue.
+        """
+        try:
+            messages = self._backlog
+            while messages is not None:
+                for data in messages:
+                    message = ManagerMsg(data)
+                    if message.is_event():
+                        self._event_queue.put_nowait(Event(message))
+                    elif message.has_header('Response'):
+                        self._route_response(message)
+                    else:
+                        print ('No clue what we got\n%s' % message.data)
+                messages = await self._read_messages()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._connected = False
+            self._event_queue.put_nowait(None)
+            pending = list(self._pending.values())
+            self._pending.clear()
+            for future in pending:
+                if not future.done():
+                    future.set_result(None)
+
+    async def event_dispatch(self):
+        """This task is responsible for dispatching events"""
+
+        while True:
+            ev = await self._event_queue.get()
+            if not ev:
+                break
+
+            callbacks = (self._event_callbacks.get(ev.name, [])
+                      +  self._event_callbacks.get('*', []))
+
+            for callback in callbacks:
+                result = callback(ev, self)
+                if inspect.isawaitable(result):
+                    result = await result
+                if result:
+                    break
+
+    def register_event(self, event, function):
+        """
+        Register a callback for the specfied event.
+        The callback may be a coroutine function. If a callback returns
+        True, no more callbacks for that event will be executed.
+        """
+        self._event_callbacks.setdefault(event, []).append(function)
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        self._event_callbacks.get(event, []).remove(function)
+
+    async def connect(self, host, port=5038):
+        """Connect to the manager interface, returns the greeting"""
+
+        if self._connected:
+            raise ManagerException('Already connected to manager')
+
+        # make sure host is a string
+        assert isinstance (host, string_types)
+
+        port = int(port)  # make sure port is an int
+
+        try:
+            self._reader, self._writer = \
+                await asyncio.open_connection(host, port)
+        except OSError as err:
+            raise ManagerSocketException(err.errno, err.strerror)
+
+        self._framer = _Framer()
+        messages = await self._read_messages()
+        if not messages:
+            self._writer.close()
+            raise ManagerSocketException(0, 'Connection Terminated')
+        greeting = messages.pop(0)
+        self._backlog = messages
+
+        self._connected = True
+        self._event_queue = asyncio.Queue()
+        self._tasks = \
+            [ asyncio.ensure_future(self.message_loop())
+            , asyncio.ensure_future(self.event_dispatch())
+            ]
+        return ManagerMsg(greeting)
+
+    async def close(self):
+        """Shutdown the connection to the manager"""
+
+        if self._connected:
+            try:
+                await self.logoff()
+            except ManagerSocketException:
+                pass
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+        # don't wait for our self when called from an event handler
+        current = asyncio.current_task()
+        tasks = [t for t in self._tasks if t is not current]
+        self._tasks = []
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def login(self, username, secret, events=None):
+        """
+        Login to the manager, throws ManagerAuthException when login falis,
+        see Manager.login for the event mask.
+        """
+
+        cdict = {'Action':'Login'}
+        cdict['Username'] = username
+        cdict['Secret'] = secret
+        if events is not None:
+            cdict['Events'] = _event_mask(events)
+        response = await self.send_action(cdict)
+
+        if response.get_header('Response') == 'Error':
+           raise ManagerAuthException(response.get_header('Message'))
+
+        return response
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Response Cache for read-only Manager Actions
+
+Busy lamp and voicemail indicator code asks for the same mailbox,
+extension and peer states again and again. With an ActionCache the
+Manager answers repeated MailboxCount, MailboxStatus, ExtensionState and
+SIPshowpeer actions from memory:
+
+   import asterisk.manager
+   import asterisk.cache
+
+   cache = asterisk.cache.ActionCache(size = 10000, ttl = 60)
+   manager = asterisk.manager.Manager(cache = cache)
+   manager.connect('host')
+   manager.login('user', 'secret')
+
+   manager.mailbox_count('100@default')     # asks asterisk
+   manager.mailbox_count('100@default')     # from the cache
+   print (cache.cache_stats())
+
+Successful responses are kept by action and arguments until their time
+to live (ttl, per action in ttls) is over, the least recently used
+response is dropped when the cache is full. The events changing a state
+remove the responses about it right away: MessageWaiting the mailbox,
+ExtensionStatus the extension and PeerStatus the peer. After a
+reconnect (and on FullyBooted) the cache is emptied, events may have
+been missed. Actions with an ActionID given by the caller are never
+cached.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+def _mailbox(mailbox):
+    if mailbox and '@' not in mailbox:
+        mailbox += '@default'
+    return ('mailbox', mailbox)
+
+def _extension(exten, context):
+    return ('extension', exten, context)
+
+def _peer(peer):
+    # PeerStatus names SIP/100, SIPshowpeer only 100
+    return ('peer', peer and peer.split('/')[-1])
+
+# the state an action is about, by action name
+actions = \
+    { 'MailboxCount'   : lambda cdict: _mailbox(cdict.get('Mailbox'))
+    , 'MailboxStatus'  : lambda cdict: _mailbox(cdict.get('Mailbox'))
+    , 'ExtensionState' : lambda cdict:
+        _extension(cdict.get('Exten'), cdict.get('Context'))
+    , 'SIPshowpeer'    : lambda cdict: _peer(cdict.get('Peer'))
+    }
+
+# the state an event changes, by event name
+events = \
+    { 'MessageWaiting'  : lambda event: _mailbox(event.get_header('Mailbox'))
+    , 'ExtensionStatus' : lambda event:
+        _extension(event.get_header('Exten'), event.get_header('Context'))
+    , 'PeerStatus'      : lambda event: _peer(event.get_header('Peer'))
+    }
+
+
+class ActionCache(object):
+    """
+    LRU cache with time to live of the responses of read-only actions,
+    invalidated by events.
+    """
+
+    def __init__(self, size=1024, ttl=30.0, ttls=None, clock=time.time):
+        """
+        Keep at most size responses for ttl seconds, ttls may give the
+        time to live by action name.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.ttls = dict(ttls or ())
+        self.clock = clock
+        self._lock = threading.Lock()
+        # response, expiry time and state by key, least recently used
+        # first
+        self._entries = OrderedDict()
+        self._keys = {}
+        # the number of invalidations and of tickets on the way by state
+        # (only while there are any) and the number of clears, to
+        # detect changes while an action is on the way
+        self._generations = {}
+        self._epoch = 0
+        self.manager = None
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def attach(self, manager):
+        """Invalidate entries from the events of the manager"""
+        self.manager = manager
+        for name in events:
+            manager.register_event(name, self._invalidate_event)
+        manager.register_event('FullyBooted', self._fully_booted)
+
+    def detach(self):
+        """Stop listening to the events of our manager"""
+        for name in events:
+            self.manager.unregister_event(name, self._invalidate_event)
+        self.manager.unregister_event('FullyBooted', self._fully_booted)
+        self.manager = None
+
+    def get(self, cdict):
+        """
+        Return the cached response to an action and a ticket for
+        storing the response with put, both may be None.
+        """
+        name = cdict.get('Action')
+        state = actions.get(name)
+        if state is None or 'ActionID' in cdict:
+            return None, None
+        state = state(cdict)
+        key = (name,) + tuple(sorted(cdict.items()))
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                response, expires, state = entry
+                if expires > now:
+                    # most recently used
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return response, None
+                self._remove(key, state)
+            self.misses += 1
+            generation = self._generations.setdefault(state, [0, 0])
+            generation[1] += 1
+            return None, (key, state, generation[0], self._epoch)
+        finally:
+            self._lock.release()
+
+    def put(self, ticket, response):
+        """
+        Store the response to an action, see get. Every ticket must be
+        put, with a response of None if the action failed.
+        """
+        success = response is not None \
+            and response.get_header('Response') == 'Success'
+        key, state, generation, epoch = ticket
+        ttl = self.ttls.get(key[0], self.ttl)
+        self._lock.acquire()
+        try:
+            current = self._generations[state]
+            current[1] -= 1
+            if not current[1]:
+                del self._generations[state]
+            # the state changed while the action was on the way
+            if not success or current[0] != generation \
+                or self._epoch != epoch:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (response, self.clock() + ttl, state)
+            self._keys.setdefault(state, set()).add(key)
+            while len(self._entries) > self.size:
+                old = next(iter(self._entries))
+                self._remove(old, self._entries[old][2])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def _remove(self, key, state):
+        self._entries.pop(key, None)
+        keys = self._keys.get(state)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[state]
+
+    def invalidate(self, state):
+        """
+        Remove the responses about a state, e.g. ('mailbox',
+        '100@default'), ('extension', '100', 'hints') or ('peer', '100').
+        """
+        self._lock.acquire()
+        try:
+            generation = self._generations.get(state)
+            if generation is not None:
+                generation[0] += 1
+            for key in self._keys.pop(state, ()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all responses"""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._keys.clear()
+            # the actions on the way may have old states, too
+            self._epoch += 1
+        finally:
+            self._lock.release()
+
+    def _invalidate_event(self, event, manager):
+        self.invalidate(events[event.name](event))
+
+    def _fully_booted(self, event, manager):
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cache_stats(self):
+        """The number of entries, hits, misses, evictions and invalidations"""
+        self._lock.acquire()
+        try:
+            return dict \
+                ( size          = len(self._entries)
+                , hits          = self.hits
+                , misses        = self.misses
+                , evictions     = self.evictions
+                , invalidations = self.invalidations
+                )
+        finally:
+            self._lock.release()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Live Channel Table for the Asterisk Manager
+
+A ChannelRegistry keeps the live channels of an asterisk in memory. It
+is seeded with a CoreShowChannels (or, for old versions, Status)
+snapshot and updated from the channel events, so that looking up
+channels needs no round trip to asterisk:
+
+   import asterisk.manager
+   import asterisk.channels
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   channels = asterisk.channels.ChannelRegistry(manager)
+
+   for channel in channels.by_linkedid('1332366541.558'):
+      print (channel['Channel'], channel.get('ChannelStateDesc'))
+
+A channel is a dict of the latest values of the headers of its events.
+The dicts are never modified but replaced on updates, they may be kept
+and read without locking. After a (re)connect asterisk sends the
+FullyBooted event, then the table is loaded again.
+"""
+
+import threading
+
+class ChannelRegistry(object):
+    """
+    Live channels by Uniqueid, with indexes by channel name and Linkedid.
+    """
+
+    # events updating a channel, Newchannel creates and Hangup removes it
+    events = \
+        ( 'Newchannel', 'Newstate', 'NewCallerid', 'NewConnectedLine'
+        , 'NewAccountCode', 'Rename', 'Hangup'
+        )
+    # headers that are not about the channel
+    ignored = frozenset(('Event', 'Privilege', 'ActionID', 'EventList'))
+
+    def __init__(self, manager=None, seed=True):
+        """
+        Attach to the manager (if given) and load the current channels
+        if seed is true, the manager must be logged in then.
+        """
+        self._lock = threading.Lock()
+        self._by_uniqueid = {}
+        self._by_name = {}
+        self._by_linkedid = {}
+        # events received while loading a snapshot, replayed over it
+        self._seed_events = None
+        self.manager = None
+        if manager is not None:
+            self.attach(manager)
+            if seed:
+                self.seed()
+
+    def attach(self, manager):
+        """Keep the table up to date from the events of the manager"""
+        self.manager = manager
+        for name in self.events:
+            manager.register_event(name, self._update)
+        manager.register_event('FullyBooted', self._fully_booted)
+
+    def detach(self):
+        """Stop listening to the events of our manager"""
+        for name in self.events:
+            self.manager.unregister_event(name, self._update)
+        self.manager.unregister_event('FullyBooted', self._fully_booted)
+        self.manager = None
+
+    def seed(self):
+        """Replace the table by a snapshot of the live channels"""
+        self._lock.acquire()
+        try:
+            self._seed_events = []
+        finally:
+            self._lock.release()
+        try:
+            response, events = self.manager.send_list_action \
+                (Action = 'CoreShowChannels')
+            if response.get_header('Response') == 'Error':
+                # asterisk before 1.6.2
+                response, events = self.manager.send_list_action \
+                    (Action = 'Status')
+        except:
+            self._seed_events = None
+            raise
+        self._lock.acquire()
+        try:
+            self._by_uniqueid.clear()
+            self._by_name.clear()
+            self._by_linkedid.clear()
+            for event in events:
+                self._store(self._channel(None, event))
+            # the snapshot may be older than the events
+            for event in self._seed_events:
+                self._apply(event)
+            self._seed_events = None
+        finally:
+            self._lock.release()
+
+    def _fully_booted(self, event, manager):
+        self.seed()
+
+    def _channel(self, channel, event):
+        """The channel updated with the headers of the event"""
+        channel = dict(channel or ())
+        for name, value in event.headers.items():
+            if name not in self.ignored:
+                channel[name] = value
+        # Rename reports the new name (and in old versions the old one
+        # as Oldname instead of Channel)
+        if 'Newname' in channel:
+            channel['Channel'] = channel.pop('Newname')
+            channel.pop('Oldname', None)
+        return channel
+
+    def _store(self, channel):
+        uniqueid = channel.get('Uniqueid')
+        if uniqueid is None:
+            return
+        old = self._by_uniqueid.get(uniqueid)
+        if old is not None:
+            self._unindex(old)
+        self._by_uniqueid[uniqueid] = channel
+        if 'Channel' in channel:
+            self._by_name[channel['Channel']] = uniqueid
+        linkedid = channel.get('Linkedid')
+        if linkedid is not None:
+            self._by_linkedid.setdefault(linkedid, set()).add(uniqueid)
+
+    def _unindex(self, channel):
+        uniqueid = channel['Uniqueid']
+        if self._by_name.get(channel.get('Channel')) == uniqueid:
+            del self._by_name[channel['Channel']]
+        linked = self._by_linkedid.get(channel.get('Linkedid'))
+        if linked is not None:
+            linked.discard(uniqueid)
+            if not linked:
+                del self._by_linkedid[channel['Linkedid']]
+
+    def _update(self, event, manager):
+        uniqueid = event.get_header('Uniqueid')
+        if uniqueid is None:
+            return
+        self._lock.acquire()
+        try:
+            if self._seed_events is not None:
+                self._seed_events.append(event)
+            self._apply(event)
+        finally:
+            self._lock.release()
+
+    def _apply(self, event):
+        uniqueid = event.get_header('Uniqueid')
+        channel = self._by_uniqueid.get(uniqueid)
+        if event.name == 'Hangup':
+            if channel is not None:
+                self._unindex(channel)
+                del self._by_uniqueid[uniqueid]
+        else:
+            # also for channels we missed the Newchannel of
+            self._store(self._channel(channel, event))
+
+    def get(self, uniqueid, default=None):
+        """The channel with the given Uniqueid"""
+        return self._by_uniqueid.get(uniqueid, default)
+
+    def by_channel(self, name):
+        """The channel with the given name, e.g. SIP/100-00000001"""
+        uniqueid = self._by_name.get(name)
+        if uniqueid is None:
+            return None
+        return self._by_uniqueid.get(uniqueid)
+
+    def by_linkedid(self, linkedid):
+        """All channels with the given Linkedid"""
+        self._lock.acquire()
+        try:
+            return [self._by_uniqueid[uniqueid]
+                for uniqueid in self._by_linkedid.get(linkedid, ())]
+        finally:
+            self._lock.release()
+
+    def channels(self):
+        """A list of all live channels"""
+        return list(self._by_uniqueid.values())
+
+    def __len__(self):
+        return len(self._by_uniqueid)
+
+    def __contains__(self, uniqueid):
+        return uniqueid in self._by_uniqueid
+
+    def __iter__(self):
+        return iter(self.channels())
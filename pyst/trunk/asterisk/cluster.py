@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Actions on many Asterisk Servers at once
+
+A Cluster runs an action on all (or some) of a set of named managers in
+parallel and waits at most until a deadline, so a query over all servers
+takes as long as the slowest server and not the sum of all of them:
+
+   import asterisk.manager
+   import asterisk.cluster
+
+   cluster = asterisk.cluster.Cluster(timeout = 2)
+   for name in 'pbx1', 'pbx2', 'pbx3':
+      manager = asterisk.manager.Manager()
+      manager.connect(name)
+      manager.login('user', 'secret')
+      cluster.add(name, manager)
+
+   # the server knowing the peer
+   found = cluster.first(Action = 'SIPshowpeer', Peer = '100')
+   if found:
+      name, response = found
+      print ("%s: %s" % (name, response['Address-IP']))
+
+   # channels of all servers
+   results = cluster.send_list_action(Action = 'CoreShowChannels')
+   for name, result in results.items():
+      if not asterisk.cluster.is_error(result):
+         response, channels = result
+         print ("%s: %d channels" % (name, len(channels)))
+
+Results are tagged with the name of the server. A server that fails
+(with an exception raised by the action) or misses the deadline gets the
+exception as its result, ManagerTimeoutException for the deadline.
+
+The managers may be anything with the actions of asterisk.manager, e.g.
+the servers of an asterisk.multiplex.Multiplexer. Each action runs in a
+thread of its own, actions missing the deadline keep running until
+their own timeout.
+"""
+
+import threading
+from collections import OrderedDict
+from asterisk.compat import Queue, Empty
+from asterisk.manager import ManagerTimeoutException
+from asterisk.stats import clock
+
+def is_error(result):
+    """
+    Check the result of a server for an exception or an 'Error'
+    response (also of the (response, events) of list actions).
+    """
+    if isinstance(result, Exception):
+        return True
+    if isinstance(result, tuple):
+        result = result[0]
+    return hasattr(result, 'get_header') \
+        and result.get_header('Response') == 'Error'
+
+
+class Cluster(object):
+    """
+    A set of managers by name with parallel actions on all of them.
+    """
+
+    def __init__(self, managers=(), timeout=None):
+        """
+        managers is a dict or a list of pairs of names and managers,
+        timeout the default deadline in seconds (None waits for all
+        servers).
+        """
+        self.timeout = timeout
+        self._managers = OrderedDict(managers)
+
+    def add(self, name, manager):
+        self._managers[name] = manager
+
+    def remove(self, name):
+        """Remove a manager from the cluster, return it"""
+        return self._managers.pop(name)
+
+    def names(self):
+        return list(self._managers)
+
+    def __getitem__(self, name):
+        return self._managers[name]
+
+    def __len__(self):
+        return len(self._managers)
+
+    def __contains__(self, name):
+        return name in self._managers
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def iter_call(self, function, servers=None, timeout=None):
+        """
+        Call function(manager) for each of the servers (names, default
+        all) in parallel and iterate over the pairs of server name and
+        result as they complete. Exceptions are returned as result,
+        when the timeout expires the servers still busy get a
+        ManagerTimeoutException.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if servers is None:
+            servers = self.names()
+        targets = [(name, self._managers[name]) for name in servers]
+
+        results = Queue()
+        for name, manager in targets:
+            t = threading.Thread(target=self._call,
+                args=(results, name, function, manager))
+            t.setDaemon(True)
+            t.start()
+
+        waiting = set(name for name, manager in targets)
+        if timeout is not None:
+            deadline = clock() + timeout
+        while waiting:
+            if timeout is None:
+                name, result = results.get()
+            else:
+                try:
+                    name, result = results.get \
+                        (True, max(deadline - clock(), 0))
+                except Empty:
+                    break
+            waiting.discard(name)
+            yield name, result
+        for name, manager in targets:
+            if name in waiting:
+                yield name, ManagerTimeoutException \
+                    ('No result from %s within %ss' % (name, timeout))
+
+    def _call(self, results, name, function, manager):
+        try:
+            result = function(manager)
+        except Exception as err:
+            result = err
+        results.put((name, result))
+
+    def call(self, function, servers=None, timeout=None):
+        """
+        Call function(manager) for the servers in parallel, return the
+        results by server name in the order of the servers, see
+        iter_call.
+        """
+        if servers is None:
+            servers = self.names()
+        results = OrderedDict((name, None) for name in servers)
+        results.update(self.iter_call(function, servers, timeout))
+        return results
+
+    def first_call(self, function, servers=None, timeout=None):
+        """
+        Call function(manager) for the servers in parallel, return the
+        server name and result of the first result that is no error
+        (see is_error), None if all fail. The other calls are not
+        waited for.
+        """
+        for name, result in self.iter_call(function, servers, timeout):
+            if not is_error(result):
+                return name, result
+        return None
+
+    def _action(self, cdict, kwargs, timeout):
+        """A function sending the action to a manager"""
+        cdict = dict(cdict, **kwargs)
+        if timeout is None:
+            timeout = self.timeout
+        return lambda manager: manager.send_action(cdict, timeout)
+
+    def send_action(self, cdict={}, servers=None, timeout=None, **kwargs):
+        """
+        Send an action to the servers (names, default all) in parallel,
+        return the responses (or exceptions) by server name.
+        """
+        return self.call(self._action(cdict, kwargs, timeout),
+            servers, timeout)
+
+    def send_list_action(self, cdict={}, servers=None, timeout=None,
+        **kwargs):
+        """
+        Send a list action to the servers in parallel, return the
+        response and events (or the exception) by server name, see
+        Manager.send_list_action.
+        """
+        cdict = dict(cdict, **kwargs)
+        if timeout is None:
+            timeout = self.timeout
+        return self.call(lambda manager:
+            manager.send_list_action(cdict, timeout), servers, timeout)
+
+    def first(self, cdict={}, servers=None, timeout=None, **kwargs):
+        """
+        Send an action to the servers in parallel, return the server
+        name and response of the first successful response, None if
+        all fail.
+        """
+        return self.first_call(self._action(cdict, kwargs, timeout),
+            servers, timeout)
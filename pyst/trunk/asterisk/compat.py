@@ -12,16 +12,86 @@ PY2 = sys.version_info[0] == 2
 
 # Queue in python3 has moved:
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty, Full
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty, Full
 
 # String types, stolen from Armin Ronacher above
 if not PY2:
     text_type = str
     string_types = (str,)
     unichr = chr
+    intern = sys.intern
 else:
     text_type = unicode
     string_types = (str, unicode)
     unichr = unichr
+    intern = intern
+
+# The manager interface talks bytes on the socket, we hand native
+# strings to the parser (str in both python versions)
+if not PY2:
+    def to_str(data):
+        return data.decode('utf-8', 'replace')
+    def to_bytes(s):
+        return s.encode('utf-8')
+else:
+    def to_str(data):
+        return data
+    def to_bytes(s):
+        return s
+
+# selectors is new in python 3.4, python 2 gets a select based
+# selector with the same interface (as far as we use it)
+try:
+    from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+except ImportError:
+    import select
+    from collections import namedtuple
+
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+
+    SelectorKey = namedtuple('SelectorKey', 'fileobj fd events data')
+
+    class DefaultSelector(object):
+        def __init__(self):
+            self._keys = {}
+
+        def register(self, fileobj, events, data=None):
+            key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+            if key.fd in self._keys:
+                raise KeyError('%r is already registered' % fileobj)
+            self._keys[key.fd] = key
+            return key
+
+        def unregister(self, fileobj):
+            return self._keys.pop(fileobj.fileno())
+
+        def modify(self, fileobj, events, data=None):
+            self._keys.pop(fileobj.fileno())
+            return self.register(fileobj, events, data)
+
+        def get_key(self, fileobj):
+            return self._keys[fileobj.fileno()]
+
+        def select(self, timeout=None):
+            if timeout is not None:
+                timeout = max(timeout, 0)
+            readers = [fd for fd, key in self._keys.items()
+                if key.events & EVENT_READ]
+            writers = [fd for fd, key in self._keys.items()
+                if key.events & EVENT_WRITE]
+            try:
+                r, w, x = select.select(readers, writers, [], timeout)
+            except select.error:
+                # interrupted, the caller tries again
+                return []
+            ready = []
+            for fd in set(r) | set(w):
+                events = (fd in r and EVENT_READ) | (fd in w and EVENT_WRITE)
+                ready.append((self._keys[fd], events))
+            return ready
+
+        def close(self):
+            self._keys.clear()
@@ -36,7 +36,7 @@ This module provides a Python API for interfacing with the asterisk manager.
 
            manager.logoff()
        except asterisk.manager.ManagerSocketException as err:
-          errno, reason = err
+          errno, reason = err.args
           print ("Error connecting to the manager: %s" % reason)
           sys.exit(1)
        except asterisk.manager.ManagerAuthException as reason:
@@ -60,16 +60,24 @@ import sys,os
 import socket
 import threading
 import re
+import operator
+import random
+from functools import partial
 from io import StringIO
 from time import sleep
-from asterisk.compat import Queue, string_types
+from collections import OrderedDict, deque
+from asterisk.compat import Queue, Empty, Full, string_types, to_str, to_bytes
+from asterisk.compat import intern
+from asterisk.stats import clock, callback_name
 
 EOL = '\r\n'
 
 class _Msg(object): 
+    __slots__ = ()
+
     def has_header(self, hname):
         """Check for a header"""
-        return self.headers.has_key(hname)
+        return hname in self.headers
 
     def get_header(self, hname, defval = None):
         """Return the specified header"""
@@ -83,17 +91,112 @@ class _Msg(object):
         return self.headers['Response']
 
 
+def _split_headers(raw):
+    """
+    Return the list of (name, value) header pairs of a raw message and
+    the offset where the data starts. Header names are interned, they
+    are shared by all messages.
+    """
+    headers = []
+    pos = 0
+    while True:
+        eol = raw.find('\n', pos)
+        # all valid header lines end in \r\n
+        if eol <= pos or raw[eol - 1] != '\r':
+            break
+        k, sep, v = raw[pos:eol].partition(':')
+        if not sep:
+            # invalid header, start of multi-line data response
+            break
+        headers.append((intern(k.strip()), v.strip()))
+        pos = eol + 1
+    return headers, pos
+
+
 class ManagerMsg(_Msg): 
-    """A manager interface message"""
+    """
+    A manager interface message. Only the raw message is stored, the
+    headers are parsed when first used.
+    """
+    __slots__ = ('raw', '_headers', '_multiheaders', '_data')
+
     def __init__(self, response):
-        # the raw response, straight from the horse's mouth:
-        self.response = response
-        self.data = ''
-        self.headers = {}
-        self.multiheaders = {}
-        
-        # parse the response
-        self.parse(response)
+        # the raw response, straight from the horse's mouth, either
+        # as a string or a list of lines:
+        if not isinstance(response, string_types):
+            response = ''.join(response)
+        self.raw = response
+        self._headers = None
+        self._multiheaders = None
+        self._data = None
+
+    @property
+    def response(self):
+        """The raw response as a list of lines"""
+        lines = self.raw.split('\n')
+        last = lines.pop()
+        lines = [line + '\n' for line in lines]
+        if last:
+            lines.append(last)
+        return lines
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self.parse()
+        return self._headers
+
+    @property
+    def data(self):
+        if self._headers is None:
+            self.parse()
+        return self._data
+
+    @property
+    def multiheaders(self):
+        if self._multiheaders is None:
+            multiheaders = {}
+            for k, v in _split_headers(self.raw)[0]:
+                multiheaders.setdefault(k, []).append(v)
+            for k in 'Event', 'Response':
+                if k in self.headers and k not in multiheaders:
+                    multiheaders[k] = [self.headers[k]]
+            self._multiheaders = multiheaders
+        return self._multiheaders
+
+    def _first_header(self):
+        """
+        Return the name and value of the first header without parsing
+        the message, asterisk sends 'Event' or 'Response' first.
+        """
+        raw = self.raw
+        eol = raw.find('\r\n')
+        k, sep, v = raw[:eol].partition(':')
+        if eol < 0 or not sep:
+            return None, None
+        return k.strip(), v.strip()
+
+    def is_event(self):
+        """Check if this is an event message, usually without parsing"""
+        if self._first_header()[0] == 'Event':
+            return True
+        # e.g. a response that carries an Event header
+        return self.has_header('Event')
+
+    def parse(self, response=None):
+        """
+        Parse a manager message, the stored one or the given raw
+        response which then replaces it
+        """
+        if response is not None:
+            if not isinstance(response, string_types):
+                response = ''.join(response)
+            self.raw = response
+            self._multiheaders = None
+
+        headers, pos = _split_headers(self.raw)
+        headers = dict(headers)
+        self._data = self.raw[pos:]
 
         # This is an unknown message, may happen if a command (notably
         # 'dialplan show something') contains a \n\r\n sequence in the
@@ -106,57 +209,47 @@ class ManagerMsg(_Msg):
         # commands sent and their expected return syntax. In that case
         # we could wait for --END COMMAND-- for 'command'.
         # B0rken in asterisk. This should be parseable without context.
-        if 'Event' not in self.headers and 'Response' not in self.headers:
+        if 'Event' not in headers and 'Response' not in headers:
             # there are commands that return the ActionID but not
             # 'Response', e.g., IAXpeers in Asterisk 1.4.X
-            if self.has_header('ActionID'):
-                self.headers['Response'] = 'Generated Header'
-                self.multiheaders ['Response'] = ['Generated Header']
-            elif '--END COMMAND--' in self.data:
-                self.headers['Event'] = 'NoClue'
-                self.multiheaders ['Event'] = ['NoClue']
+            if 'ActionID' in headers:
+                headers['Response'] = 'Generated Header'
+            elif '--END COMMAND--' in self._data:
+                headers['Event'] = 'NoClue'
             else:
-                self.headers['Response'] = 'Generated Header'
-                self.multiheaders ['Response'] = ['Generated Header']
-        
-    def parse(self, response):
-        """Parse a manager message"""
-
-        data = []
-        for n, line in enumerate (response):
-            # all valid header lines end in \r\n
-            if not line.endswith ('\r\n'):
-                data.extend(response[n:])
-                break
-            try:
-                k, v = (x.strip() for x in line.split(':',1))
-                if k not in self.multiheaders:
-                    self.multiheaders[k]=[]
-                self.headers[k] = v
-                self.multiheaders[k].append(v)
-            except ValueError:
-                # invalid header, start of multi-line data response
-                data.extend(response[n:])
-                break
-        self.data = ''.join(data)
+                headers['Response'] = 'Generated Header'
+        self._headers = headers
 
 
 class Event(_Msg):
     """Manager interface Events, __init__ expects and 'Event' message"""
+    __slots__ = ('message', 'name')
+
     def __init__(self, message):
 
         # store all of the event data
         self.message = message
-        self.data = message.data
-        self.headers = message.headers
-        self.multiheaders = message.multiheaders
-
-        # if this is not an event message we have a problem
-        if not message.has_header('Event'):
-            raise ManagerException('Trying to create event from non event message')
 
-        # get the event name
-        self.name = message.get_header('Event')
+        # get the event name, usually without parsing the message
+        k, name = message._first_header()
+        if k != 'Event':
+            # if this is not an event message we have a problem
+            if not message.has_header('Event'):
+                raise ManagerException('Trying to create event from non event message')
+            name = message.get_header('Event')
+        self.name = intern(name)
+
+    @property
+    def data(self):
+        return self.message.data
+
+    @property
+    def headers(self):
+        return self.message.headers
+
+    @property
+    def multiheaders(self):
+        return self.message.multiheaders
     
     def __repr__(self):
         return self.headers['Event']
@@ -164,339 +257,738 @@ class Event(_Msg):
     def get_action_id(self):
         return self.headers.get('ActionID',0000)
 
-class Manager(object):
-    def __init__(self):
-        self._sock = None     # our socket
-        self.title = None     # set by received greeting
-        self._connected = threading.Event()
-        self._running = threading.Event()
-        
-        # our hostname
-        self.hostname = socket.gethostname()
-        # pid -- used for unique naming of ActionID
-        self.pid      = os.getpid ()
-
-        # our queues
-        self._message_queue = Queue()
-        self._response_queue = Queue()
-        self._event_queue = Queue()
-
-        # callbacks for events
-        self._event_callbacks = {}
-
-        self._reswaiting = []  # who is waiting for a response
+class _Chunk(object):
+    """
+    Data of a streamed message, end is set for the last chunk.
+    """
+    __slots__ = ('actionid', 'text', 'end')
+
+    def __init__(self, actionid, text, end):
+        self.actionid = actionid
+        self.text = text
+        self.end = end
+
+
+class _Stream(Queue):
+    """
+    The bounded queue of the chunks of a streamed message or of the
+    events of a list action. Putting into a full queue waits for the
+    consumer unless it has given up.
+    """
+
+    def __init__(self, size):
+        Queue.__init__(self, size)
+        self.cancelled = False
+
+    def deliver(self, chunk):
+        # after cancel there is room for a put that was already on
+        # the way, later chunks are dropped
+        if not self.cancelled:
+            self.put(chunk)
+
+    def cancel(self):
+        """The consumer is gone, drop the queued and further chunks"""
+        self.mutex.acquire()
+        try:
+            self.cancelled = True
+            self.queue.clear()
+            self.not_full.notify_all()
+        finally:
+            self.mutex.release()
 
-        # sequence stuff
-        self._seqlock = threading.Lock()
-        self._seq = 0
-       
-        # some threads
-        self.message_thread = threading.Thread(target=self.message_loop)
-        self.event_dispatch_thread = threading.Thread(target=self.event_dispatch)
-        
-        self.message_thread.setDaemon(True)
-        self.event_dispatch_thread.setDaemon(True)
+    def terminate(self):
+        """The connection is lost, replace the queued chunks by None"""
+        self.mutex.acquire()
+        try:
+            self.queue.clear()
+            self.queue.append(None)
+            self.not_empty.notify()
+        finally:
+            self.mutex.release()
 
 
-    def __del__(self):
-        self.close()
+class _PendingActions(object):
+    """
+    The actions of a connection waiting for their response and the
+    list actions collecting their events, by ActionID. Shared by the
+    Manager and the servers of asterisk.multiplex.
+    """
 
-    def connected(self):
+    def __init__(self):
+        # responses are routed to the waiting action by ActionID,
+        # the table is ordered so that responses without an ActionID
+        # can still be handed to the oldest waiter
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        # events of running list actions are collected by ActionID
+        self.list_events = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def register(self, actions):
         """
-        Check if we are connected or not.
+        Register the deliver functions of actions, a list of ActionID
+        and deliver function.
         """
-        return self._connected.isSet()
-
-    def next_seq(self):
-        """Return the next number in the sequence, this is used for ActionID"""
-        self._seqlock.acquire()
+        self.lock.acquire()
         try:
-            return self._seq
+            for actionid, deliver in actions:
+                if actionid in self.pending:
+                    raise ManagerException('Duplicate ActionID %s' % actionid)
+            for actionid, deliver in actions:
+                self.pending[actionid] = deliver
         finally:
-            self._seq += 1
-            self._seqlock.release()
-        
-    def send_action(self, cdict={}, **kwargs):
-        """
-        Send a command to the manager
-        
-        If a list is passed to the cdict argument, each item in the list will
-        be sent to asterisk under the same header in the following manner:
-
-        cdict = {"Action": "Originate",
-                 "Variable": ["var1=value", "var2=value"]}
-        send_action(cdict)
-
-        ...
+            self.lock.release()
 
-        Action: Originate
-        Variable: var1=value
-        Variable: var2=value
+    def unregister(self, actionid):
         """
-
-        if not self._connected.isSet():
-            raise ManagerException("Not connected")
-        
-        # fill in our args
-        cdict.update(kwargs)
-
-        # set the action id
-        if not cdict.has_key('ActionID'):
-            cdict['ActionID'] = '%s-%04s-%08x' % (self.hostname,
-                self.pid, self.next_seq())
-        clist = []
-
-        # generate the command
-        for key, value in cdict.items():
-            if isinstance(value, list):
-               for item in value:
-                  item = tuple([key, item])
-                  clist.append('%s: %s' % item)
-            else:
-               item = tuple([key, value])
-               clist.append('%s: %s' % item)
-        clist.append(EOL)
-        command = EOL.join(clist)
-
-        # lock the socket and send our command
+        Stop waiting for the response of an action, return False if
+        the response has already been delivered.
+        """
+        self.lock.acquire()
         try:
-            self._sock.write(command)
-            self._sock.flush()
-        except socket.error as err:
-            errno, reason = err
-            raise ManagerSocketException(errno, reason)
-        
-        self._reswaiting.insert(0,1)
-        response = self._response_queue.get()
-        self._reswaiting.pop(0)
-
-        if not response:
-            raise ManagerSocketException(0, 'Connection Terminated')
-
-        return response
+            return self.pending.pop(actionid, None) is not None
+        finally:
+            self.lock.release()
 
-    def _receive_data(self):
+    def wait(self, actionid, waiter, timeout):
         """
-        Read the response from a command.
+        Return the response of an action put into the queue waiter,
+        raise ManagerTimeoutException if it doesn't arrive within
+        timeout seconds.
         """
-
-        multiline = False
-        wait_for_marker = False
-        eolcount = 0
-        # loop while we are sill running and connected
-        while self._running.isSet() and self._connected.isSet():
-            try:
-                lines = []
-                for line in self._sock :
-                    # check to see if this is the greeting line    
-                    if not self.title and '/' in line and not ':' in line:
-                        # store the title of the manager we are connecting to:
-                        self.title = line.split('/')[0].strip()
-                        # store the version of the manager we are connecting to:
-                        self.version = line.split('/')[1].strip()
-                        # fake message header
-                        lines.append ('Response: Generated Header\r\n')
-                        lines.append (line)
-                        break
-                    # If the line is EOL marker we have a complete message.
-                    # Some commands are broken and contain a \n\r\n
-                    # sequence, in the case wait_for_marker is set, we
-                    # have such a command where the data ends with the
-                    # marker --END COMMAND--, so we ignore embedded
-                    # newlines until we see that marker
-                    if line == EOL and not wait_for_marker :
-                        multiline = False
-                        if lines or not self._connected.isSet():
-                            break
-                        # ignore empty lines at start
-                        continue
-                    lines.append(line)
-                    # line not ending in \r\n or without ':' isn't a
-                    # valid header and starts multiline response
-                    if not line.endswith('\r\n') or ':' not in line:
-                        multiline = True
-                    # Response: Follows indicates we should wait for end
-                    # marker --END COMMAND--
-                    if not multiline and line.startswith('Response') and \
-                        line.split(':', 1)[1].strip() == 'Follows':
-                        wait_for_marker = True
-                    # same when seeing end of multiline response
-                    if multiline and line.startswith('--END COMMAND--'):
-                        wait_for_marker = False
-                        multiline = False
-                    if not self._connected.isSet():
-                        break
-                else:
-                    # EOF during reading
-                    self._sock.close()
-                    self._connected.clear()
-                # if we have a message append it to our queue
-                if lines and self._connected.isSet():
-                    self._message_queue.put(lines)
-                else:
-                    self._message_queue.put(None)
-            except socket.error:
-                self._sock.close()
-                self._connected.clear()
-                self._message_queue.put(None)
-
-    
-    def register_event(self, event, function):
+        try:
+            return waiter.get(True, timeout)
+        except Empty:
+            # give up the slot, unless the response is just arriving
+            if self.unregister(actionid):
+                raise ManagerTimeoutException \
+                    ('No response to %s within %ss' % (actionid, timeout))
+            return waiter.get()
+
+    def route(self, message):
         """
-        Register a callback for the specfied event.
-        If a callback function returns True, no more callbacks for that
-        event will be executed.
+        Return the deliver function of the action waiting for the
+        ActionID of a response (without ActionID of the oldest one),
+        None if nobody is waiting.
         """
+        actionid = message.get_header('ActionID')
+        self.lock.acquire()
+        try:
+            if actionid is None:
+                if self.pending:
+                    return self.pending.popitem(last=False)[1]
+                return None
+            return self.pending.pop(actionid, None)
+        finally:
+            self.lock.release()
 
-        # get the current value, or an empty list
-        # then add our new callback
-        current_callbacks = self._event_callbacks.get(event, [])
-        current_callbacks.append(function)
-        self._event_callbacks[event] = current_callbacks
+    def collector(self, event):
+        """The stream of the list action an event belongs to, if any"""
+        if self.list_events:
+            return self.list_events.get(event.get_header('ActionID'))
+        return None
 
-    def unregister_event(self, event, function):
+    def take(self, keep=()):
         """
-        Unregister a callback for the specified event.
+        Remove the actions waiting for a response except for the
+        ActionIDs in keep, return their deliver functions.
         """
-        current_callbacks = self._event_callbacks.get(event, [])
-        current_callbacks.remove(function)
-        self._event_callbacks[event] = current_callbacks
+        self.lock.acquire()
+        try:
+            return [self.pending.pop(actionid)
+                for actionid in list(self.pending) if actionid not in keep]
+        finally:
+            self.lock.release()
 
-    def message_loop(self):
+    def terminate(self, waiting):
         """
-        The method for the event thread.
-        This actually recieves all types of messages and places them
-        in the proper queues.
+        The connection is lost: wake up the actions with the deliver
+        functions waiting (see take) and end the collected lists.
         """
+        for deliver in waiting:
+            deliver(None)
+        for stream in list(self.list_events.values()):
+            stream.terminate()
 
-        # start a thread to recieve data
-        t = threading.Thread(target=self._receive_data)
-        t.setDaemon(True)
-        t.start()
-
+    def list_action(self, send_action, cdict, timeout, buffer=0):
+        """
+        Generator sending a list action (cdict with ActionID) with
+        send_action, yields the response followed by the events of
+        the list. At most buffer (unless 0) events are queued.
+        """
+        actionid = cdict['ActionID']
+        events = _Stream(buffer)
+        # register before sending, the events follow the response
+        self.list_events[actionid] = events
         try:
-            # loop getting messages from the queue
-            while self._running.isSet():
-                # get/wait for messages
-                data = self._message_queue.get()
+            response = send_action(cdict, timeout)
+            yield response
+            if response.get_header('Response') == 'Error':
+                return
+            while True:
+                try:
+                    event = events.get(True, timeout)
+                except Empty:
+                    raise ManagerTimeoutException \
+                        ('List %s incomplete after %ss' % (actionid, timeout))
+                if not event:
+                    raise ManagerSocketException(0, 'Connection Terminated')
+                if event.name.endswith('Complete') or \
+                    event.get_header('EventList') == 'Complete':
+                    return
+                yield event
+        finally:
+            self.list_events.pop(actionid, None)
+            # frees a reader waiting for room
+            events.cancel()
+
+
+class _Framer(object):
+    """
+    Split the byte stream of the manager interface into messages.
+
+    Data is appended with feed, which returns the complete messages as
+    strings ready for ManagerMsg. Messages end with an empty
+    line. Some commands are broken and contain a \n\r\n sequence in
+    their output, for a 'Response: Follows' the message only ends with
+    the first empty line after the --END COMMAND-- marker. The greeting
+    line is returned as a message with a generated header.
+
+    Messages with an ActionID in streams are not collected: feed
+    returns their data in _Chunks as it arrives, cut after complete
+    lines. The data of messages with an ActionID in discard (streams
+    nobody reads any more) is dropped, the ActionID is removed from
+    discard at the end of the message.
+    """
+
+    def __init__(self, streams=None, discard=None):
+        self.buffer = bytearray()
+        # ActionIDs of the messages to stream and to drop
+        self.streams = streams if streams is not None else {}
+        self.discard = discard if discard is not None else set()
+        # ActionID of the message streamed at the start of the buffer
+        self._stream = None
+        self.title = None     # set by received greeting
+        self.version = None
+        # state of the incomplete message at the start of the buffer:
+        # None while looking for the end of the headers, 'follows'
+        # while waiting for --END COMMAND--, 'tail' after the marker
+        self._state = None
+        # where to continue searching in the buffer
+        self._scan = 0
+
+    def feed(self, data):
+        """Append data, return the list of completed messages"""
+
+        buf = self.buffer
+        buf += data
+        messages = []
+        pos = 0
+        while pos < len(buf):
+            # check to see if this is the greeting line
+            if self.title is None:
+                eol = buf.find(b'\n', pos)
+                if eol < 0:
+                    break
+                line = to_str(bytes(buf[pos:eol + 1]))
+                if '/' in line and not ':' in line:
+                    # store the title and version of the manager
+                    self.title = line.split('/')[0].strip()
+                    self.version = line.split('/')[1].strip()
+                    # fake message header
+                    messages.append('Response: Generated Header\r\n' + line)
+                    pos = eol + 1
+                    continue
+            if self._stream is not None:
+                pos = self._stream_data(buf, pos, messages)
+                if self._stream is not None:
+                    break
+                continue
+            if (self.streams or self.discard) and self._state is None \
+                and self.title is not None:
+                # ignore empty lines at start
+                if buf.startswith(b'\r\n', pos):
+                    pos += 2
+                    continue
+                actionid = self._stream_start(buf, pos)
+                if actionid is False:
+                    break
+                if actionid is not None:
+                    self._stream = actionid
+                    if buf.startswith(b'Response: Follows', pos):
+                        self._state = 'follows'
+                    continue
+            # fast path: all messages up to the last empty line before
+            # a possible Follows response can be split in one go
+            elif self._state is None and self.title is not None:
+                follows = buf.find(b'Follows', pos)
+                if follows < 0:
+                    follows = len(buf)
+                last = buf.rfind(b'\n\r\n', pos, follows)
+                if last >= 0:
+                    texts = to_str(bytes(buf[pos:last + 3])).split('\n\r\n')
+                    # the last match may overlap with a previous one
+                    # (\n\r\n\r\n), then some data is left over
+                    pos = last + 3 - len(to_bytes(texts.pop()))
+                    for text in texts:
+                        text += '\n'
+                        # ignore empty lines at start
+                        while text.startswith('\r\n'):
+                            text = text[2:]
+                        if text:
+                            messages.append(text)
+                    self._scan = 0
+                    continue
+            # ignore empty lines at start
+            if buf.startswith(b'\r\n', pos):
+                pos += 2
+                continue
+            end = self._message_end(buf, pos)
+            if end < 0:
+                break
+            # the message without the empty line
+            messages.append(to_str(bytes(buf[pos:end])))
+            pos = end + 2
+        # drop consumed data in one go
+        if pos:
+            del buf[:pos]
+            self._scan = max(0, self._scan - pos)
+        return messages
+
+    def _message_end(self, buf, start):
+        """
+        Return the offset of the empty line ending the message starting
+        at start, -1 if the message is not complete yet.
+        """
 
-                # if we got None as our message we are done
-                if not data:
-                    # notify the other queues
-                    self._event_queue.put(None)
-                    for waiter in self._reswaiting:
-                        self._response_queue.put(None)
+        scan = max(start, self._scan)
+        if self._state is None:
+            end = buf.find(b'\n\r\n', scan)
+            if end < 0:
+                self._scan = max(start, len(buf) - 2)
+                return -1
+            if not self._follows(buf, start, end + 1):
+                self._scan = 0
+                return end + 1
+            self._state = 'follows'
+            scan = start
+        if self._state == 'follows':
+            # look for the marker at the start of a line
+            while True:
+                marker = buf.find(b'--END COMMAND--', scan)
+                if marker < 0:
+                    self._scan = max(start, len(buf) - 15)
+                    return -1
+                if marker == start or buf[marker - 1] == 10:
                     break
+                scan = marker + 1
+            self._state = 'tail'
+            scan = marker
+        end = buf.find(b'\n\r\n', scan)
+        if end < 0:
+            self._scan = max(scan, len(buf) - 2)
+            return -1
+        self._state = None
+        self._scan = 0
+        return end + 1
+
+    def _stream_start(self, buf, start):
+        """
+        Return the ActionID of the message starting at start if it is
+        to be streamed, None if not and False if its headers are not
+        complete yet.
+        """
 
-                # parse the data
-                message = ManagerMsg(data)
+        pos = start
+        while True:
+            eol = buf.find(b'\n', pos)
+            if eol < 0:
+                return False
+            line = bytes(buf[pos:eol + 1])
+            # end of the headers (empty line or command output)
+            if not line.endswith(b'\r\n') or b':' not in line:
+                return None
+            name, value = line.split(b':', 1)
+            if name == b'ActionID':
+                actionid = to_str(value.strip())
+                if actionid in self.streams or actionid in self.discard:
+                    return actionid
+                return None
+            pos = eol + 1
+
+    def _stream_data(self, buf, start, messages):
+        """
+        Append the data of the streamed message at start as a _Chunk,
+        return the offset of the data left over.
+        """
 
-                # check if this is an event message
-                if message.has_header('Event'):
-                    self._event_queue.put(Event(message))
-                # check if this is a response
-                elif message.has_header('Response'):
-                    self._response_queue.put(message)
-                else:
-                    print ('No clue what we got\n%s' % message.data)
+        if self._state is None:
+            end = buf.find(b'\n\r\n', max(start, self._scan))
+            if end < 0:
+                self._scan = max(start, len(buf) - 2)
+            else:
+                self._scan = 0
+                end += 1
+        else:
+            end = self._message_end(buf, start)
+        wanted = self._stream in self.streams
+        if end >= 0:
+            if wanted:
+                messages.append(_Chunk(self._stream,
+                    to_str(bytes(buf[start:end])), True))
+            else:
+                self.discard.discard(self._stream)
+            self._stream = None
+            return end + 2
+        # keep the last newline, the end of the message and the marker
+        # are found at the start of a line
+        cut = buf.rfind(b'\n', start)
+        if cut <= start:
+            return start
+        if wanted:
+            messages.append(_Chunk(self._stream,
+                to_str(bytes(buf[start:cut])), False))
+        return cut
+
+    def _follows(self, buf, start, stop):
+        """Check the headers in buf[start:stop] for Response: Follows"""
+
+        if buf.find(b'Follows', start, stop) < 0:
+            return False
+        pos = start
+        while pos < stop:
+            eol = buf.find(b'\n', pos, stop) + 1
+            line = bytes(buf[pos:eol])
+            # line not ending in \r\n or without ':' isn't a
+            # valid header and starts multiline response
+            if not line.endswith(b'\r\n') or b':' not in line:
+                return False
+            if line.startswith(b'Response') and \
+                line.split(b':', 1)[1].strip() == b'Follows':
+                return True
+            pos = eol
+        return False
+
+
+class _OverflowQueue(Queue):
+    """
+    A Queue with an optional size limit and a policy for putting items
+    into a full queue:
+
+    block       - the writer waits until there is room
+    drop_oldest - the oldest item is dropped
+    drop_newest - the new item is dropped
+    priority    - the item with the lowest priority (by name, see
+                  priorities, default 0) is dropped, the oldest one
+                  of several items with the same priority
+
+    The name function returns the name of an item (for priorities and
+    statistics) or None for items that must never be dropped, when
+    only such items are queued the limit is exceeded. None is used to
+    signal termination, it is always queued.
+    """
+
+    policies = ('block', 'drop_oldest', 'drop_newest', 'priority')
+
+    def __init__(self, limit=0, policy='block', name=None, priorities=None):
+        if policy not in self.policies:
+            raise ValueError('Invalid overflow policy: %s' % policy)
+        Queue.__init__(self)
+        self.limit = limit
+        self.policy = policy
+        self.name = name or (lambda item: item)
+        self.priorities = priorities or {}
+        self.high_water = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.dropped_by_name = {}
+
+    def _init(self, maxsize):
+        # the queue holds _Entries, dropped entries stay in it until
+        # they are skipped by get or the queue is compacted
+        self.queue = deque()
+        # the entries that may be dropped by priority (all under 0
+        # unless the policy is priority), oldest first
+        self._droppable = {}
+        self._live = 0
+        self._stale = 0
+
+    def _qsize(self, len=len):
+        return self._live
+
+    def _put(self, item):
+        self._append(item, None)
+
+    def _append(self, item, name):
+        entry = _Entry(item, name)
+        self.queue.append(entry)
+        self._live += 1
+        if name is not None:
+            if self.policy == 'priority':
+                entry.key = self.priorities.get(name, 0)
+            self._droppable.setdefault(entry.key, deque()).append(entry)
+
+    def _get(self):
+        while True:
+            entry = self.queue.popleft()
+            if entry.live:
+                break
+            self._stale -= 1
+        entry.live = False
+        self._live -= 1
+        if entry.name is not None:
+            # the oldest live entry is also the oldest of its priority
+            self._unindex(entry.key, self._droppable[entry.key].popleft)
+        return entry.item
+
+    def _unindex(self, key, pop):
+        """Take an entry from a deque of droppable entries"""
+        entry = pop()
+        if not self._droppable[key]:
+            del self._droppable[key]
+        return entry
+
+    def put(self, item, block=True, timeout=None):
+        self.not_full.acquire()
+        try:
+            name = None
+            if item is not None and self.limit and self.policy != 'block':
+                name = self.name(item)
+            if item is not None and self.limit and self._qsize() >= self.limit:
+                if self.policy == 'block':
+                    self._wait_for_room(block, timeout)
+                elif self._drop(name):
+                    return
+            self._append(item, name)
+            self.unfinished_tasks += 1
+            if self._qsize() > self.high_water:
+                self.high_water = self._qsize()
+            self.not_empty.notify()
         finally:
-            # wait for our data receiving thread to exit
-            t.join()
-                            
+            self.not_full.release()
+
+    def _wait_for_room(self, block, timeout):
+        """Wait until there is room like Queue.put, raise Full if not"""
+        if not block:
+            raise Full
+        self.blocked += 1
+        if timeout is None:
+            while self._qsize() >= self.limit:
+                self.not_full.wait()
+        elif timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        else:
+            end = clock() + timeout
+            while self._qsize() >= self.limit:
+                remaining = end - clock()
+                if remaining <= 0:
+                    raise Full
+                self.not_full.wait(remaining)
+
+    def _drop(self, name):
+        """
+        Drop an item according to our policy, return True if the new
+        item (with the given name) was dropped.
+        """
+        droppable = self._droppable
+        entry = None
+        if self.policy == 'drop_newest':
+            drop_new = name is not None
+            if not drop_new and droppable:
+                entry = self._unindex(0, droppable[0].pop)
+        elif self.policy == 'drop_oldest':
+            drop_new = not droppable and name is not None
+            if droppable:
+                entry = self._unindex(0, droppable[0].popleft)
+        else:
+            # few distinct priorities, the oldest one of the lowest
+            low = min(droppable) if droppable else None
+            drop_new = name is not None and \
+                (low is None or self.priorities.get(name, 0) < low)
+            if not drop_new and low is not None:
+                entry = self._unindex(low, droppable[low].popleft)
+        if drop_new:
+            self._count_drop(name)
+            return True
+        if entry is None:
+            return False
+        entry.live = False
+        self._live -= 1
+        self._stale += 1
+        self._count_drop(entry.name)
+        # nobody calls task_done for it
+        self.unfinished_tasks -= 1
+        if not self.unfinished_tasks:
+            self.all_tasks_done.notify_all()
+        # drop stale entries at the ends right away, compact when
+        # they are stuck behind items that can't be dropped
+        queue = self.queue
+        while queue and not queue[0].live:
+            queue.popleft()
+            self._stale -= 1
+        while queue and not queue[-1].live:
+            queue.pop()
+            self._stale -= 1
+        if self._stale > self._live:
+            self.queue = deque(e for e in queue if e.live)
+            self._stale = 0
+        return False
+
+    def _count_drop(self, name):
+        self.dropped += 1
+        self.dropped_by_name[name] = self.dropped_by_name.get(name, 0) + 1
+
+    def clear(self):
+        """Remove all items"""
+        self.mutex.acquire()
+        try:
+            self._init(0)
+            self.unfinished_tasks = 0
+            self.not_full.notify_all()
+        finally:
+            self.mutex.release()
 
-    def event_dispatch(self):
-        """This thread is responsible for dispatching events"""
+    def stats(self):
+        """Size, limit, high-water mark and drop counters"""
+        self.mutex.acquire()
+        try:
+            return dict \
+                ( size            = self._qsize()
+                , limit           = self.limit
+                , policy          = self.policy
+                , high_water      = self.high_water
+                , blocked         = self.blocked
+                , dropped         = self.dropped
+                , dropped_by_name = dict(self.dropped_by_name)
+                )
+        finally:
+            self.mutex.release()
 
-        # loop dispatching events
-        while self._running.isSet():
-            # get/wait for an event
-            ev = self._event_queue.get()
 
-            # if we got None as an event, we are finished
-            if not ev:
-                break
-            
-            # dispatch our events
+class _Entry(object):
+    """An item of an _OverflowQueue"""
+    __slots__ = ('item', 'name', 'key', 'live')
 
-            # first build a list of the functions to execute
-            callbacks = (self._event_callbacks.get(ev.name, [])
-                      +  self._event_callbacks.get('*', []))
+    def __init__(self, item, name):
+        self.item = item
+        # None if the item may not be dropped, key is its priority
+        self.name = name
+        self.key = 0
+        self.live = True
 
-            # now execute the functions  
-            for callback in callbacks:
-               if callback(ev, self):
-                  break
 
-    def connect(self, host, port=5038):
-        """Connect to the manager interface"""
+def _event_name(data):
+    """
+    The event name of a raw message, None if it is not an event (or
+    no message, e.g. streamed output which must never be dropped)
+    """
+    if isinstance(data, string_types) and data.startswith('Event:'):
+        return data[6:data.find('\r\n')].strip()
+    return None
 
-        if self._connected.isSet():
-            raise ManagerException('Already connected to manager')
 
-        # make sure host is a string
-        assert isinstance (host, string_types)
+def _dispatch_key(ev):
+    """Default key of parallel event dispatching"""
+    return ev.get_header('Uniqueid') or ev.get_header('Channel')
 
-        port = int(port)  # make sure port is an int
 
-        # create our socket and connect
-        try:
-            _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            _sock.connect((host,port))
-            self._sock = _sock.makefile ()
-            _sock.close ()
-        except socket.error as err:
-            errno, reason = err
-            raise ManagerSocketException(errno, reason)
+def _event_mask(mask):
+    """An event mask of the login and Events actions"""
+    if isinstance(mask, string_types):
+        return mask
+    return ','.join(mask)
 
-        # we are connected and running
-        self._connected.set()
-        self._running.set()
 
-        # start the event thread
-        self.message_thread.start()
+class _Actions(object):
+    """
+    Manager actions, shared by all flavors of manager. Each action
+    returns whatever send_action returns.
+    """
 
-        # start the event dispatching thread
-        self.event_dispatch_thread.start()
+    def _new_action_id(self):
+        """Return a unique ActionID"""
+        return '%s-%04s-%08x' % (self.hostname, self.pid, self.next_seq())
 
-        # get our initial connection response
-        return self._response_queue.get()
+    def _build_action(self, cdict, kwargs):
+        """Return the ActionID and the encoded command for an action"""
 
-    def close(self):
-        """Shutdown the connection to the manager"""
-        
-        # if we are still running, logout
-        if self._running.isSet() and self._connected.isSet():
-            self.logoff()
-         
-        if self._running.isSet():
-            # put None in the message_queue to kill our threads
-            self._message_queue.put(None)
+        # fill in our args, don't modify the dict of the caller (or
+        # the default argument) which would reuse the ActionID
+        cdict = dict(cdict)
+        cdict.update(kwargs)
 
-            # wait for the event thread to exit
-            self.message_thread.join()
+        # set the action id
+        if 'ActionID' not in cdict:
+            cdict['ActionID'] = self._new_action_id()
+        clist = []
 
-            # make sure we do not join our self (when close is called from event handlers)
-            if threading.currentThread() != self.event_dispatch_thread:
-                # wait for the dispatch thread to exit
-                self.event_dispatch_thread.join()
-            
-        self._running.clear()
+        # generate the command
+        for key, value in cdict.items():
+            if isinstance(value, list):
+               for item in value:
+                  item = tuple([key, item])
+                  clist.append('%s: %s' % item)
+            else:
+               item = tuple([key, value])
+               clist.append('%s: %s' % item)
+        clist.append(EOL)
+        return cdict['ActionID'], EOL.join(clist)
 
-# Manager actions
+    def login(self, username, secret, events=None):
+        """
+        Login to the manager, throws ManagerAuthException when login falis
 
-    def login(self, username, secret):
-        """Login to the manager, throws ManagerAuthException when login falis"""
+        events is the event mask of the session: 'on', 'off' or a list
+        of event classes, e.g. ['call', 'agent']. By default asterisk
+        sends the events of all classes we have read permission for.
+        """
            
         cdict = {'Action':'Login'}
         cdict['Username'] = username
         cdict['Secret'] = secret
-        response = self.send_action(cdict)
+        if events is not None:
+            cdict['Events'] = _event_mask(events)
+        response = self._send_login(cdict)
         
         if response.get_header('Response') == 'Error':
            raise ManagerAuthException(response.get_header('Message'))
-        
+
+        # remembered for logging in again after a reconnect
+        self._login_action = cdict
         return response
 
+    def _send_login(self, cdict):
+        """Send the login action, return the response"""
+        return self.send_action(cdict)
+
+    def events(self, mask):
+        """
+        Change the event mask of the session: 'on', 'off' or a list of
+        event classes, see login.
+        """
+        cdict = {'Action':'Events'}
+        cdict['EventMask'] = _event_mask(mask)
+        return self._send_event_action(cdict)
+
+    def filter(self, expression, operation='Add'):
+        """
+        Add a filter for the events of the session (asterisk 10 and
+        later). The expression is a regular expression matched against
+        the text of the events, once there is a filter only matching
+        events are sent. With a leading '!' matching events are
+        dropped instead. Filters can't be removed.
+        """
+        cdict = {'Action':'Filter'}
+        cdict['Operation'] = operation
+        cdict['Filter'] = expression
+        return self._send_event_action(cdict)
+
+    def _send_event_action(self, cdict):
+        """Send an action changing the events we get"""
+        return self.send_action(cdict)
+
     def ping(self):
         """Send a ping action to the manager"""
         cdict = {'Action':'Ping'}
@@ -542,9 +1034,16 @@ class Manager(object):
         
         return response
 
-    def originate(self, channel, exten, context='', priority='', timeout='', caller_id='', async=False, account='', variables={}):
+    def originate(self, channel, exten, context='', priority='', timeout='', caller_id='', async_=False, account='', variables={}, **kwargs):
         """Originate a call"""
 
+        # 'async' is a reserved word in newer python versions, but
+        # still accepted as a keyword argument
+        async_ = kwargs.pop('async', async_)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s'
+                % ', '.join(kwargs))
+
         cdict = {'Action':'Originate'}
         cdict['Channel'] = channel
         cdict['Exten'] = exten
@@ -552,7 +1051,7 @@ class Manager(object):
         if priority:  cdict['Priority'] = priority
         if timeout:   cdict['Timeout']  = timeout
         if caller_id: cdict['CallerID'] = caller_id
-        if async:     cdict['Async']    = 'yes'
+        if async_:    cdict['Async']    = 'yes'
         if account:   cdict['Account']  = account
         # join dict of vairables together in a string in the form of 'key=val|key=val'
         # with the latest CVS HEAD this is no longer necessary
@@ -629,7 +1128,1271 @@ class Manager(object):
         return response
 
 
+class _Flight(object):
+    """An action in flight shared by coalesced callers"""
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class _EventCallbacks(object):
+    """
+    Registration and running of event callbacks. The class using it
+    sets up _event_callbacks, _callback_lock, _dispatch_index,
+    _dispatch_default and stats.
+    """
+
+    def register_event(self, event, function, **headers):
+        """
+        Register a callback for the specfied event.
+        If a callback function returns True, no more callbacks for that
+        event will be executed.
+
+        The callback can be restricted to events with certain headers,
+        the value of a header keyword argument is either a string that
+        must match exactly, a compiled regular expression searched in
+        the header, or a function called with the header value:
+
+        manager.register_event('Newstate', handle_newstate,
+            Context='from-internal', Channel=re.compile('^SIP/'))
+        """
+
+        predicates = []
+        for hname, test in sorted(headers.items()):
+            if isinstance(test, string_types):
+                test = partial(operator.eq, test)
+            elif hasattr(test, 'search'):
+                test = test.search
+            predicates.append((hname, test))
+
+        self._callback_lock.acquire()
+        try:
+            # get the current value, or an empty list
+            # then add our new callback
+            current_callbacks = self._event_callbacks.get(event, [])
+            current_callbacks.append((function, tuple(predicates)))
+            self._event_callbacks[event] = current_callbacks
+            self._rebuild_dispatch_index()
+        finally:
+            self._callback_lock.release()
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        self._callback_lock.acquire()
+        try:
+            current_callbacks = self._event_callbacks.get(event, [])
+            for n, (callback, predicates) in enumerate(current_callbacks):
+                if callback == function:
+                    del current_callbacks[n]
+                    break
+            else:
+                raise ValueError('callback not registered for %s' % event)
+            self._event_callbacks[event] = current_callbacks
+            self._rebuild_dispatch_index()
+        finally:
+            self._callback_lock.release()
+
+    def _rebuild_dispatch_index(self):
+        """
+        Precompute the callbacks for each event name, the callbacks for
+        the name come first, then the catch-all callbacks. The dispatch
+        thread only ever sees complete indexes.
+        """
+        default = tuple(self._event_callbacks.get('*', []))
+        index = {}
+        for name, callbacks in self._event_callbacks.items():
+            if name != '*' and callbacks:
+                index[name] = tuple(callbacks) + default
+        self._dispatch_index = index
+        self._dispatch_default = default
+
+    def _run_callbacks(self, ev, source=None):
+        """
+        Run the callbacks registered for an event, they are called with
+        the event and the source (default self).
+        """
+        if source is None:
+            source = self
+
+        callbacks = self._dispatch_index.get(ev.name, self._dispatch_default)
+        stats = self.stats
+        if stats is not None:
+            start = clock()
+
+        # execute the functions whose header predicates match
+        for callback, predicates in callbacks:
+            for hname, test in predicates:
+                value = ev.get_header(hname)
+                if value is None or not test(value):
+                    break
+            else:
+                if stats is None:
+                    done = callback(ev, source)
+                else:
+                    called = clock()
+                    done = callback(ev, source)
+                    stats.record('callback', callback_name(callback),
+                        clock() - called)
+                if done:
+                    break
+
+        if stats is not None:
+            stats.record('dispatch', ev.name, clock() - start)
+
+
+class Manager(_Actions, _EventCallbacks):
+    # size of the reads from the socket
+    recv_size = 65536
+    # reconnecting: first delay, doubled up to the maximum, and the
+    # timeout of connecting and logging in again (seconds)
+    reconnect_delay = 0.5
+    reconnect_max_delay = 30.0
+    reconnect_timeout = 10.0
+    # actions that are safe to send again after a reconnect
+    idempotent_actions = frozenset \
+        (( 'Ping', 'Status', 'CoreStatus', 'CoreSettings'
+         , 'CoreShowChannels', 'Sippeers', 'SIPshowpeer', 'PJSIPShowEndpoints'
+         , 'QueueStatus', 'QueueSummary', 'ExtensionState', 'MailboxStatus'
+         , 'MailboxCount', 'Getvar', 'ListCommands'
+        ))
+
+    def __init__(self, dispatch_workers=0, dispatch_key=None,
+        max_messages=0, max_events=0, overflow='block', priorities=None,
+        stats=None, reconnect=False, resend=False, dual=False, timeout=None,
+        cache=None, coalesce=False):
+        """
+        By default all event callbacks run one after another in the
+        event dispatch thread. With dispatch_workers the callbacks run
+        in that many worker threads, events with the same key (by
+        default the Uniqueid or Channel, or the result of calling
+        dispatch_key with the event) are always handled by the same
+        worker in the order they arrived.
+
+        By default the queues of received messages and of events
+        waiting for dispatch are unbounded. max_messages and
+        max_events limit them, when a queue is full the overflow
+        policy is applied: 'block' stops reading from the socket until
+        there is room again (and lets asterisk do the buffering),
+        'drop_oldest' and 'drop_newest' drop events and 'priority'
+        drops the event with the lowest priority given by event name
+        in the priorities dict (default 0). Responses are never
+        dropped. Note that with 'block' an event callback waiting for
+        a response (e.g. by sending an action) while the event queue
+        is full waits forever. See queue_stats for the drop counters.
+
+        Pass an asterisk.stats.ManagerStats instance as stats to record
+        latency histograms of actions, event parsing, dispatching and
+        callbacks, see stats_snapshot.
+
+        With reconnect a lost connection is reestablished with jittered
+        exponential backoff (see reconnect_delay and friends), the
+        manager logs in again with the credentials of the last login,
+        registered event callbacks are kept. Actions waiting for a
+        response are failed with ManagerSocketException, with resend
+        the actions in idempotent_actions (or the set of action names
+        given as resend) are sent again on the new connection instead.
+        New actions fail with ManagerException while disconnected.
+
+        With dual two connections are used: actions are sent on a
+        connection logged in with 'Events: off', events are received
+        on the other one. Responses are then never queued behind
+        events. Losing either connection counts as losing both.
+
+        timeout is the default for connect and for waiting for the
+        response of an action (and the events of list actions) in
+        seconds, None waits forever. ManagerTimeoutException is raised
+        when it expires.
+
+        Pass an asterisk.cache.ActionCache as cache to answer repeated
+        read-only actions (e.g. MailboxCount or ExtensionState) from
+        memory until an event changes their state.
+
+        With coalesce identical actions (same action and arguments,
+        without an ActionID given by the caller) sent by several
+        threads at the same time are sent only once, all callers get
+        the one response. Only the actions in idempotent_actions (or
+        the set of action names given as coalesce) are coalesced.
+        """
+        self._sock = None     # our socket
+        self.title = None     # set by received greeting
+        self._connected = threading.Event()
+        self._running = threading.Event()
+        # set by close, ends reconnecting
+        self._stop = threading.Event()
+        # close and the end of a reconnect don't overlap
+        self._stop_lock = threading.Lock()
+        # the action connection and its reader in dual mode
+        self.dual = dual
+        self._action_sock = None
+        self._action_thread = None
+        
+        # our hostname
+        self.hostname = socket.gethostname()
+        # pid -- used for unique naming of ActionID
+        self.pid      = os.getpid ()
+
+        # our queues
+        self._message_queue = _OverflowQueue \
+            (max_messages, overflow, _event_name, priorities)
+        self._response_queue = _OverflowQueue()
+        self._event_queue = _OverflowQueue \
+            (max_events, overflow, operator.attrgetter('name'), priorities)
+
+        # callbacks for events, by event name a list of the callback
+        # and its header predicates
+        self._event_callbacks = {}
+        self._callback_lock = threading.Lock()
+        # precomputed callbacks to run by event name (including the
+        # catch-all callbacks) and for all other events
+        self._dispatch_index = {}
+        self._dispatch_default = ()
+        # events dropped unparsed as no callback is registered for them
+        self.events_skipped = 0
+        self.events_skipped_by_name = {}
+        # instrumentation, None when disabled
+        self.stats = stats
+        # default timeout of connect and actions
+        self.timeout = timeout
+        # bytes read from the (event) connection
+        self.bytes_received = 0
+        # filters added by apply_event_filters
+        self._event_filters = []
+        # responses of read-only actions, None when disabled
+        self.cache = cache
+        # actions in flight by action and arguments
+        if coalesce is True:
+            coalesce = self.idempotent_actions
+        self.coalesce_actions = frozenset(coalesce or ())
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # actions answered by the response of another caller
+        self.coalesced = 0
+
+        # actions waiting for their response and list actions
+        self._pending = _PendingActions()
+        # serialize writes to the socket
+        self._write_lock = threading.Lock()
+        # streamed command output is delivered by ActionID, the rest
+        # of the output of a stream given up is dropped, both guarded
+        # by the lock of the pending actions
+        self._streams = {}
+        self._discard = set()
+
+        # reconnecting
+        self.reconnect = reconnect
+        if resend is True:
+            resend = self.idempotent_actions
+        self.resend_actions = frozenset(resend or ())
+        self.reconnects = 0
+        self._address = None
+        self._login_action = None
+        # commands of pending actions to resend by ActionID
+        self._resend = {}
+        # set when the message loop has failed the pending actions of
+        # a lost connection
+        self._disconnect_done = threading.Event()
+
+        # sequence stuff
+        self._seqlock = threading.Lock()
+        self._seq = 0
+       
+        # some threads, started by connect
+        self.message_thread = None
+        self.event_dispatch_thread = None
+
+        # parallel event dispatching
+        self.dispatch_workers = dispatch_workers
+        self.dispatch_key = dispatch_key or _dispatch_key
+        self._dispatch_threads = []
+
+        if cache is not None:
+            cache.attach(self)
+
+
+    def __del__(self):
+        self.close()
+
+    def connected(self):
+        """
+        Check if we are connected or not.
+        """
+        return self._connected.isSet()
+
+    def next_seq(self):
+        """Return the next number in the sequence, this is used for ActionID"""
+        self._seqlock.acquire()
+        try:
+            return self._seq
+        finally:
+            self._seq += 1
+            self._seqlock.release()
+        
+    def send_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send a command to the manager and wait for the response, at
+        most timeout seconds (default see Manager) before raising
+        ManagerTimeoutException. A response arriving later is dropped.
+        
+        If a list is passed to the cdict argument, each item in the list will
+        be sent to asterisk under the same header in the following manner:
+
+        cdict = {"Action": "Originate",
+                 "Variable": ["var1=value", "var2=value"]}
+        send_action(cdict)
+
+        ...
+
+        Action: Originate
+        Variable: var1=value
+        Variable: var2=value
+        """
+        cache = self.cache
+        if cache is None and not self.coalesce_actions:
+            return self._send_action(cdict, kwargs, timeout=timeout)
+        merged = dict(cdict, **kwargs)
+        ticket = None
+        if cache is not None:
+            response, ticket = cache.get(merged)
+            if response is not None:
+                return response
+        response = None
+        try:
+            if merged.get('Action') in self.coalesce_actions \
+                and 'ActionID' not in merged:
+                response = self._coalesced_action(merged, timeout)
+            else:
+                response = self._send_action(cdict, kwargs, timeout=timeout)
+        finally:
+            # also return the ticket of a failed action
+            if ticket is not None:
+                cache.put(ticket, response)
+        return response
+
+    def _coalesced_action(self, cdict, timeout):
+        """
+        Send an action unless the same action is already in flight,
+        then wait for its response.
+        """
+        key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+            for k, v in cdict.items()))
+        self._flights_lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        finally:
+            self._flights_lock.release()
+
+        if leader:
+            try:
+                flight.response = self._send_action(cdict, {}, timeout=timeout)
+            except Exception as err:
+                flight.error = err
+                raise
+            finally:
+                self._flights_lock.acquire()
+                try:
+                    del self._flights[key]
+                finally:
+                    self._flights_lock.release()
+                flight.done.set()
+            return flight.response
+
+        if timeout is None:
+            timeout = self.timeout
+        flight.done.wait(timeout)
+        if not flight.done.isSet():
+            raise ManagerTimeoutException \
+                ('No response to %s within %ss' % (cdict['Action'], timeout))
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+
+    def _send_action(self, cdict, kwargs, sock=None, timeout=None):
+        """
+        Send an action on the given socket, by default the action
+        connection, and wait for the response.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        if not self._connected.isSet():
+            raise ManagerException("Not connected")
+        
+        actionid, command = self._build_action(cdict, kwargs)
+        if sock is None:
+            sock = self._action_sock or self._sock
+
+        # register for the response before sending, it may arrive
+        # before we get to wait for it
+        waiter = Queue()
+        self._register([(actionid, waiter.put,
+            cdict.get('Action', kwargs.get('Action')), command)])
+
+        stats = self.stats
+        if stats is not None:
+            start = clock()
+
+        # lock the socket and send our command
+        try:
+            self._write_lock.acquire()
+            try:
+                sock.sendall(to_bytes(command))
+            finally:
+                self._write_lock.release()
+        except socket.error as err:
+            self._unregister(actionid)
+            raise ManagerSocketException(err.errno, err.strerror)
+        
+        try:
+            response = self._pending.wait(actionid, waiter, timeout)
+        finally:
+            self._resend.pop(actionid, None)
+        if stats is not None:
+            stats.record('action', cdict.get('Action', kwargs.get('Action')),
+                clock() - start)
+
+        if not response:
+            raise ManagerSocketException(0, 'Connection Terminated')
+
+        return response
+
+    def _register(self, actions):
+        """
+        Register the deliver functions of actions by ActionID, a list
+        of ActionID, deliver function, action name and command.
+        """
+        self._pending.register([a[:2] for a in actions])
+        for actionid, deliver, name, command in actions:
+            if name in self.resend_actions:
+                self._resend[actionid] = command
+
+    def _unregister(self, actionid):
+        """
+        Stop waiting for the response of an action, return False if
+        the response has already been delivered.
+        """
+        self._resend.pop(actionid, None)
+        return self._pending.unregister(actionid)
+
+    def send_actions(self, actions, timeout=None):
+        """
+        Send a list of actions (dicts like the cdict of send_action)
+        with a single write and wait for all responses, at most
+        timeout seconds for the whole batch. Returns a list in the
+        order of the actions of the responses or, for actions that
+        failed, the ManagerTimeoutException or ManagerSocketException.
+
+        responses = manager.send_actions(
+            [{'Action': 'Getvar', 'Channel': c, 'Variable': 'FOO'}
+             for c in channels])
+        """
+        results = [None] * len(actions)
+        for index, result in self.iter_actions(actions, timeout):
+            results[index] = result
+        return results
+
+    def iter_actions(self, actions, timeout=None):
+        """
+        Send a list of actions with a single write like send_actions
+        and iterate over the index of the action and its response (or
+        exception) as the responses arrive.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        if not self._connected.isSet():
+            raise ManagerException("Not connected")
+
+        done = Queue()
+        batch = []
+        for index, cdict in enumerate(actions):
+            actionid, command = self._build_action(cdict, {})
+            deliver = partial(self._deliver_indexed, done.put, index)
+            batch.append((actionid, deliver, cdict.get('Action'), command))
+        self._register(batch)
+        sock = self._action_sock or self._sock
+
+        start = clock()
+        try:
+            self._write_lock.acquire()
+            try:
+                sock.sendall(to_bytes(''.join(a[3] for a in batch)))
+            finally:
+                self._write_lock.release()
+        except socket.error as err:
+            for actionid, deliver, name, command in batch:
+                self._unregister(actionid)
+            raise ManagerSocketException(err.errno, err.strerror)
+
+        waiting = set(range(len(batch)))
+        try:
+            while waiting:
+                if timeout is None:
+                    index, response = done.get()
+                else:
+                    try:
+                        index, response = done.get \
+                            (True, max(start + timeout - clock(), 0))
+                    except Empty:
+                        break
+                waiting.discard(index)
+                yield index, self._batch_result(batch[index], response, start)
+            # give up the slots of the actions that timed out, unless
+            # their response is just arriving
+            late = 0
+            for index in sorted(waiting):
+                actionid = batch[index][0]
+                if not self._unregister(actionid):
+                    late += 1
+                    continue
+                waiting.discard(index)
+                yield index, ManagerTimeoutException \
+                    ('No response to %s within %ss' % (actionid, timeout))
+            for n in range(late):
+                index, response = done.get()
+                waiting.discard(index)
+                yield index, self._batch_result(batch[index], response, start)
+        finally:
+            # the caller stopped iterating
+            for index in waiting:
+                self._unregister(batch[index][0])
+
+    def _deliver_indexed(self, put, index, response):
+        put((index, response))
+
+    def _batch_result(self, action, response, start):
+        """The result of an action of send_actions"""
+        actionid, deliver, name, command = action
+        self._resend.pop(actionid, None)
+        if not response:
+            return ManagerSocketException(0, 'Connection Terminated')
+        if self.stats is not None:
+            self.stats.record('action', name, clock() - start)
+        return response
+
+    def send_list_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send an action that replies with a list of events, e.g.
+        Sippeers, Status, CoreShowChannels or QueueStatus.
+
+        The events with the ActionID of the action are collected until
+        the list is complete (an event named '...Complete' or with
+        'EventList: Complete'), they are not dispatched to the
+        registered event callbacks. Returns the response and the list
+        of events (without the final event), on an 'Error' response
+        the list is empty. The timeout applies to the response and
+        between the events.
+
+        response, peers = manager.send_list_action(Action='Sippeers')
+        """
+        events = self._list_action(dict(cdict, **kwargs), timeout)
+        response = next(events)
+        return response, list(events)
+
+    def iter_list_action(self, cdict={}, timeout=None, buffer=64, **kwargs):
+        """
+        Send an action that replies with a list of events and iterate
+        over the events as they arrive, see send_list_action. At most
+        buffer events not yet consumed are kept in memory, reading
+        from the connection waits while they are not consumed: don't
+        wait for other actions of this manager within the loop. Raises
+        ManagerException if the action fails.
+
+        for peer in manager.iter_list_action(Action='Sippeers'):
+            print (peer['ObjectName'])
+        """
+        events = self._list_action(dict(cdict, **kwargs), timeout, buffer)
+        try:
+            response = next(events)
+            if response.get_header('Response') == 'Error':
+                raise ManagerException(response.get_header('Message'))
+            for event in events:
+                yield event
+        finally:
+            events.close()
+
+    def _list_action(self, cdict, timeout=None, buffer=0):
+        """
+        Generator sending a list action, yields the response followed
+        by the events of the list. At most buffer (unless 0) events
+        are queued.
+        """
+        if 'ActionID' not in cdict:
+            cdict['ActionID'] = self._new_action_id()
+        if timeout is None:
+            timeout = self.timeout
+        return self._pending.list_action \
+            (self.send_action, cdict, timeout, buffer)
+
+    def iter_command(self, command, timeout=None, buffer=16):
+        """
+        Execute a command and iterate over the lines of its output as
+        they arrive (without the --END COMMAND-- marker), the output is
+        never collected in memory. Leaving the loop early drops the rest
+        of the output. At most buffer pieces of output are kept, reading
+        from the connection waits while they are not consumed: don't
+        wait for other actions of this manager within the loop. The
+        timeout applies to each piece of output. Raises
+        ManagerException if the command fails.
+
+        for line in manager.iter_command('dialplan show'):
+            print (line)
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if not self._connected.isSet():
+            raise ManagerException("Not connected")
+
+        actionid, text = self._build_action \
+            ({'Action':'Command', 'Command':command}, {})
+        chunks = _Stream(buffer)
+        # register before sending, the output may arrive right away
+        self._streams[actionid] = chunks
+        sock = self._action_sock or self._sock
+        try:
+            try:
+                self._write_lock.acquire()
+                try:
+                    sock.sendall(to_bytes(text))
+                finally:
+                    self._write_lock.release()
+            except socket.error as err:
+                raise ManagerSocketException(err.errno, err.strerror)
+
+            headers = True
+            response = message = None
+            rest = ''
+            while True:
+                try:
+                    chunk = chunks.get(True, timeout)
+                except Empty:
+                    raise ManagerTimeoutException \
+                        ('No output of %s within %ss' % (actionid, timeout))
+                if chunk is None:
+                    raise ManagerSocketException(0, 'Connection Terminated')
+                lines = (rest + chunk.text).split('\n')
+                rest = lines.pop()
+                if chunk.end and rest:
+                    lines.append(rest)
+                for line in lines:
+                    if line.endswith('\r'):
+                        line = line[:-1]
+                    if headers:
+                        name, sep, value = line.partition(':')
+                        if name == 'Response':
+                            response = value.strip()
+                            continue
+                        # newer asterisk sends the output as Output
+                        # headers instead of a Follows response
+                        if response != 'Follows':
+                            if name == 'Output':
+                                yield value[1:] if value.startswith(' ') \
+                                    else value
+                            elif name == 'Message':
+                                message = value.strip()
+                            continue
+                        if sep and name in ('Privilege', 'ActionID'):
+                            continue
+                        headers = False
+                    if line != '--END COMMAND--':
+                        yield line
+                if chunk.end:
+                    break
+            if response == 'Error':
+                raise ManagerException(message)
+        finally:
+            # the framer drops the rest of the output until its end
+            self._pending.lock.acquire()
+            try:
+                if self._streams.pop(actionid, None) is not None:
+                    self._discard.add(actionid)
+            finally:
+                self._pending.lock.release()
+            # frees a reader waiting for room
+            chunks.cancel()
+
+    def _stream_chunk(self, chunk):
+        """Hand streamed output to its iter_command"""
+        self._pending.lock.acquire()
+        try:
+            if chunk.end:
+                stream = self._streams.pop(chunk.actionid, None)
+            else:
+                stream = self._streams.get(chunk.actionid)
+        finally:
+            self._pending.lock.release()
+        if stream is not None:
+            stream.deliver(chunk)
+
+    def _route_response(self, message):
+        """
+        Hand a response to the send_action waiting for its ActionID.
+        Responses without an ActionID go to the oldest waiter, if
+        nobody is waiting (e.g. the greeting) they are put into the
+        response queue.
+        """
+        deliver = self._pending.route(message)
+        if deliver:
+            deliver(message)
+        elif not message.has_header('ActionID'):
+            self._response_queue.put(message)
+        # else: a response nobody is waiting for any more
+
+    def _terminate_pending(self, keep=()):
+        """
+        Wake up everybody waiting for a response except for the
+        ActionIDs in keep, we are done.
+        """
+        self._pending.lock.acquire()
+        try:
+            # streamed output doesn't survive the connection
+            streams = list(self._streams.values())
+            self._streams.clear()
+            self._discard.clear()
+        finally:
+            self._pending.lock.release()
+        self._pending.terminate(self._pending.take(keep))
+        for stream in streams:
+            stream.terminate()
+
+    def _receive_data(self):
+        """
+        Read data from the socket and queue the complete messages.
+        """
+
+        framer = _Framer(self._streams, self._discard)
+        buf = bytearray(self.recv_size)
+        view = memoryview(buf)
+        # loop while we are sill running and connected
+        while self._running.isSet() and self._connected.isSet():
+            try:
+                n = self._sock.recv_into(buf)
+            except socket.error:
+                n = 0
+            self.bytes_received += n
+            if not n:
+                # EOF during reading
+                self._sock.close()
+                self._connected.clear()
+                self._shutdown(self._action_sock)
+                if not self.reconnect or self._stop.isSet():
+                    self._message_queue.put(None)
+                    break
+                # an empty message tells the message loop to fail the
+                # pending actions, then we try to get back
+                self._disconnect_done.clear()
+                self._message_queue.put('')
+                framer, messages = self._reconnect()
+                if framer is None:
+                    self._message_queue.put(None)
+                    break
+            else:
+                messages = framer.feed(view[:n])
+                if framer.title and not self.title:
+                    self.title = framer.title
+                    self.version = framer.version
+            for lines in messages:
+                self._message_queue.put(lines)
+
+    def _reconnect(self):
+        """
+        Reconnect with jittered exponential backoff until we succeed or
+        are closed, then send the actions to resend. Return the framer
+        and the first messages of the new connection, or None, None
+        when closed.
+        """
+        delay = self.reconnect_delay
+        while True:
+            # randomize the delay so that many clients don't come back
+            # at the same time
+            self._stop.wait(delay * random.uniform(0.5, 1.0))
+            if self._stop.isSet():
+                return None, None
+            try:
+                sock, framer, messages = self._handshake \
+                    (self._login_action, self.reconnect_timeout)
+                if self.dual:
+                    try:
+                        action = self._handshake \
+                            (self._action_login(), self.reconnect_timeout)
+                    except:
+                        sock.close()
+                        raise
+            except (socket.error, ManagerException):
+                delay = min(delay * 2, self.reconnect_max_delay)
+                continue
+            break
+
+        # new actions must not be failed with those of the old connection
+        self._disconnect_done.wait()
+        self._stop_lock.acquire()
+        try:
+            # closed during the handshake, drop the new connection
+            if self._stop.isSet():
+                sock.close()
+                if self.dual:
+                    action[0].close()
+                return None, None
+            self._sock = sock
+            if self.dual:
+                self._start_action_reader(*action)
+                sock = self._action_sock
+            self.reconnects += 1
+            # the filters of the old session, nobody waits for the responses
+            filters = [self._build_action({'Action' : 'Filter',
+                'Operation' : 'Add', 'Filter' : expression}, {})[1]
+                for expression in self._event_filters]
+            if filters:
+                try:
+                    self._sock.sendall(to_bytes(''.join(filters)))
+                except socket.error:
+                    pass # noticed by the next read
+            self._pending.lock.acquire()
+            try:
+                commands = [command
+                    for actionid, command in self._resend.items()
+                    if actionid in self._pending.pending]
+            finally:
+                self._pending.lock.release()
+            if commands:
+                self._write_lock.acquire()
+                try:
+                    sock.sendall(to_bytes(''.join(commands)))
+                except socket.error:
+                    pass # noticed by the next read
+                finally:
+                    self._write_lock.release()
+            # events may have been missed
+            if self.cache is not None:
+                self.cache.clear()
+            self._connected.set()
+        finally:
+            self._stop_lock.release()
+        return framer, messages
+
+    def _handshake(self, login, timeout):
+        """
+        Open another connection to the manager and send the login
+        action (unless None), waiting at most timeout seconds for each
+        step. Return the socket, its framer and the messages received
+        after the greeting and the login response.
+        """
+        sock = socket.create_connection(self._address, timeout)
+        try:
+            framer = _Framer(self._streams, self._discard)
+            actionid = None
+            if login:
+                actionid, command = self._build_action(login, {})
+                sock.sendall(to_bytes(command))
+            messages = []
+            while framer.title is None or actionid is not None:
+                data = sock.recv(self.recv_size)
+                if not data:
+                    raise ManagerSocketException(0, 'Connection Terminated')
+                for text in framer.feed(data):
+                    if actionid is not None:
+                        message = ManagerMsg(text)
+                        if message.get_header('ActionID') == actionid:
+                            if message.get_header('Response') == 'Error':
+                                raise ManagerAuthException \
+                                    (message.get_header('Message'))
+                            actionid = None
+                            continue
+                    messages.append(text)
+            sock.settimeout(None)
+        except:
+            sock.close()
+            raise
+        # without the greeting
+        return sock, framer, messages[1:]
+
+    def _action_login(self):
+        """The login action of the action connection"""
+        if not self._login_action:
+            return None
+        login = dict(self._login_action)
+        login['Events'] = 'off'
+        return login
+
+    def _send_login(self, cdict):
+        """In dual mode log in on both connections"""
+        if self._action_sock is None:
+            return self.send_action(cdict)
+        login = dict(cdict)
+        login['Events'] = 'off'
+        response = self.send_action(login)
+        if response.get_header('Response') == 'Error':
+            return response
+        return self._send_action(cdict, {}, self._sock)
+
+    def _send_event_action(self, cdict):
+        """In dual mode on the event connection"""
+        return self._send_action(cdict, {}, self._sock)
+
+    def _start_action_reader(self, sock, framer, messages):
+        self._action_sock = sock
+        self._action_thread = threading.Thread \
+            (target=self._receive_responses, args=(sock, framer, messages))
+        self._action_thread.setDaemon(True)
+        self._action_thread.start()
+
+    def _receive_responses(self, sock, framer, messages):
+        """
+        Read the action connection of dual mode. Responses (and the
+        events of list actions) are routed right here instead of being
+        queued behind the events of the event connection.
+        """
+        buf = bytearray(self.recv_size)
+        view = memoryview(buf)
+        while True:
+            for data in messages:
+                if data.__class__ is _Chunk:
+                    self._stream_chunk(data)
+                    continue
+                message = ManagerMsg(data)
+                if message.is_event():
+                    # there are no other events with Events: off
+                    collect = self._pending.collector(message)
+                    if collect:
+                        collect.deliver(Event(message))
+                elif message.has_header('Response'):
+                    self._route_response(message)
+            try:
+                n = sock.recv_into(buf)
+            except socket.error:
+                n = 0
+            if not n:
+                break
+            messages = framer.feed(view[:n])
+        sock.close()
+        # the reader of the event connection handles the lost connection
+        self._shutdown(self._sock)
+
+    def _shutdown(self, sock):
+        """Shut down a socket (if any), its reader will notice"""
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def queue_stats(self):
+        """
+        Return the statistics of the queues of received messages, of
+        responses without a waiting action and of events: current
+        size, limit, high-water mark, how often the reader was blocked
+        and the number of dropped events (in total and by event name).
+        """
+        return dict \
+            ( messages  = self._message_queue.stats()
+            , responses = self._response_queue.stats()
+            , events    = self._event_queue.stats()
+            )
+
+    def stats_snapshot(self):
+        """
+        Return the histograms recorded by the stats (by kind of
+        measurement and name, see asterisk.stats) together with the
+        queue statistics under 'queues'. Statistics are recorded while
+        the stats attribute is set, it may be changed at any time.
+        """
+        stats = self.stats
+        snapshot = stats.snapshot() if stats is not None else {}
+        snapshot['queues'] = self.queue_stats()
+        return snapshot
+
+    def apply_event_filters(self):
+        """
+        Let asterisk send only the events we have callbacks for: add a
+        filter (see filter) for every event name registered with
+        register_event. Nothing is filtered while a catch-all ('*')
+        callback is registered. Filters can't be removed, they stay when
+        callbacks are unregistered; call it again after registering
+        callbacks for more events. Filters are added again after a
+        reconnect. Returns the list of filters added.
+        """
+        self._callback_lock.acquire()
+        try:
+            names = [name for name, callbacks in self._event_callbacks.items()
+                if callbacks]
+        finally:
+            self._callback_lock.release()
+        if '*' in names:
+            return []
+        added = []
+        for name in sorted(names):
+            expression = '^Event: %s[[:space:]]' % name
+            if expression in self._event_filters:
+                continue
+            response = self.filter(expression)
+            if response.get_header('Response') == 'Error':
+                raise ManagerException(response.get_header('Message'))
+            self._event_filters.append(expression)
+            added.append(expression)
+        return added
+
+    def message_loop(self):
+        """
+        The method for the event thread.
+        This actually recieves all types of messages and places them
+        in the proper queues.
+        """
+
+        # start a thread to recieve data
+        t = threading.Thread(target=self._receive_data)
+        t.setDaemon(True)
+        t.start()
+
+        try:
+            # loop getting messages from the queue
+            while self._running.isSet():
+                # get/wait for messages
+                data = self._message_queue.get()
+
+                # if we got None as our message we are done
+                if data is None:
+                    # notify the other queues
+                    self._event_queue.put(None)
+                    self._terminate_pending()
+                    break
+
+                # the connection was lost and we are reconnecting, keep
+                # the actions to resend (but not list actions)
+                if not data:
+                    self._terminate_pending \
+                        (set(self._resend) - set(self._pending.list_events))
+                    self._disconnect_done.set()
+                    continue
+
+                if data.__class__ is _Chunk:
+                    self._stream_chunk(data)
+                    continue
+
+                # drop events nobody is interested in before parsing,
+                # asterisk always sends the Event header first
+                if not self._dispatch_default \
+                    and not self._pending.list_events \
+                    and data.startswith('Event:'):
+                    name = _event_name(data)
+                    if name not in self._dispatch_index:
+                        self.events_skipped += 1
+                        self.events_skipped_by_name[name] = \
+                            self.events_skipped_by_name.get(name, 0) + 1
+                        continue
+
+                stats = self.stats
+                if stats is not None:
+                    start = clock()
+
+                # parse the data
+                message = ManagerMsg(data)
+
+                # check if this is an event message
+                if message.is_event():
+                    event = Event(message)
+                    if stats is not None:
+                        # messages are parsed lazily, decode the
+                        # headers now so that they are timed as parsing
+                        message.headers
+                        stats.record('parse', event.name, clock() - start)
+                    # events of a list action go to its collector
+                    collect = self._pending.collector(event)
+                    if collect:
+                        collect.deliver(event)
+                        continue
+                    self._event_queue.put(event)
+                # check if this is a response
+                elif message.has_header('Response'):
+                    self._route_response(message)
+                else:
+                    print ('No clue what we got\n%s' % message.data)
+        finally:
+            # wait for our data receiving thread to exit
+            t.join()
+                            
+
+    def event_dispatch(self):
+        """This thread is responsible for dispatching events"""
+
+        # start the workers if we dispatch in parallel
+        workers = []
+        for n in range(self.dispatch_workers):
+            queue = Queue()
+            t = threading.Thread(target=self._dispatch_worker, args=(queue,))
+            t.setDaemon(True)
+            t.start()
+            workers.append(queue)
+            self._dispatch_threads.append(t)
+
+        try:
+            # loop dispatching events
+            while self._running.isSet():
+                # get/wait for an event
+                ev = self._event_queue.get()
+
+                # if we got None as an event, we are finished
+                if not ev:
+                    break
+
+                # dispatch our events
+                if workers:
+                    key = self.dispatch_key(ev)
+                    workers[hash(key) % len(workers)].put(ev)
+                else:
+                    self._run_callbacks(ev)
+        finally:
+            # stop the workers and wait for them unless we are one
+            for queue in workers:
+                queue.put(None)
+            for t in self._dispatch_threads:
+                if t != threading.currentThread():
+                    t.join()
+            self._dispatch_threads = []
+
+    def _dispatch_worker(self, queue):
+        """A worker thread of parallel event dispatching"""
+        while True:
+            ev = queue.get()
+            if not ev:
+                break
+            self._run_callbacks(ev)
+
+    def connect(self, host, port=5038, timeout=None):
+        """
+        Connect to the manager interface, return the greeting. Raises
+        ManagerTimeoutException if connecting or the greeting takes
+        longer than timeout seconds (default see Manager).
+        """
+
+        if self._connected.isSet():
+            raise ManagerException('Already connected to manager')
+
+        # make sure host is a string
+        assert isinstance (host, string_types)
+
+        port = int(port)  # make sure port is an int
+        if timeout is None:
+            timeout = self.timeout
+
+        # create our socket and connect
+        try:
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except socket.error as err:
+            raise ManagerSocketException(err.errno, err.strerror)
+        try:
+            _sock.settimeout(timeout)
+            _sock.connect((host,port))
+            _sock.settimeout(None)
+            self._sock = _sock
+        except socket.timeout:
+            _sock.close()
+            raise ManagerTimeoutException \
+                ('Connecting to %s:%s timed out' % (host, port))
+        except socket.error as err:
+            _sock.close()
+            raise ManagerSocketException(err.errno, err.strerror)
+        self._address = (host, port)
+
+        # the second connection for actions in dual mode
+        if self.dual:
+            try:
+                self._start_action_reader(*self._handshake(None, timeout))
+            except socket.timeout:
+                _sock.close()
+                raise ManagerTimeoutException \
+                    ('Connecting to %s:%s timed out' % (host, port))
+            except socket.error as err:
+                _sock.close()
+                raise ManagerSocketException(err.errno, err.strerror)
+            except ManagerException:
+                _sock.close()
+                raise
+
+        # forget the leftovers of a previous connection
+        self._event_filters = []
+        for queue in self._message_queue, self._response_queue, \
+            self._event_queue:
+            queue.clear()
+        self._stop.clear()
+
+        # we are connected and running
+        self._connected.set()
+        self._running.set()
+
+        # start the event thread
+        self.message_thread = threading.Thread(target=self.message_loop)
+        self.message_thread.setDaemon(True)
+        self.message_thread.start()
+
+        # start the event dispatching thread
+        self.event_dispatch_thread = threading.Thread(target=self.event_dispatch)
+        self.event_dispatch_thread.setDaemon(True)
+        self.event_dispatch_thread.start()
+
+        # get our initial connection response
+        try:
+            return self._response_queue.get(True, timeout)
+        except Empty:
+            # hang up without logging off
+            self._connected.clear()
+            self._shutdown(self._sock)
+            self.close()
+            raise ManagerTimeoutException \
+                ('No greeting from %s:%s within %ss' % (host, port, timeout))
+
+    def close(self):
+        """Shutdown the connection to the manager"""
+
+        # don't reconnect any more, a reconnect is either done or
+        # drops its new connection
+        self._stop_lock.acquire()
+        try:
+            self._stop.set()
+        finally:
+            self._stop_lock.release()
+        
+        # if we are still running, logout
+        if self._running.isSet() and self._connected.isSet():
+            try:
+                self.logoff()
+            except ManagerTimeoutException:
+                # asterisk is stuck, hang up
+                self._shutdown(self._sock)
+            # we logged off on the action connection, stop reading events
+            if self.dual:
+                self._shutdown(self._sock)
+         
+        if self._running.isSet():
+            # put None in the message_queue to kill our threads
+            self._message_queue.put(None)
+
+            # wait for the event thread to exit
+            self.message_thread.join()
+
+            # make sure we do not join our self (when close is called from event handlers)
+            current = threading.currentThread()
+            if current != self.event_dispatch_thread and \
+                current not in self._dispatch_threads:
+                # wait for the dispatch thread to exit
+                self.event_dispatch_thread.join()
+
+            if self._action_thread is not None:
+                self._shutdown(self._action_sock)
+                self._action_thread.join()
+                self._action_thread = None
+            
+        self._running.clear()
 class ManagerException(Exception): pass
 class ManagerSocketException(ManagerException): pass
 class ManagerAuthException(ManagerException): pass
+class ManagerTimeoutException(ManagerException): pass
 
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Many Manager Connections in one Thread
+
+A Multiplexer keeps the connections to many asterisk servers in a single
+I/O thread instead of the three threads per connection of a Manager.
+Messages are framed and parsed like in asterisk.manager, the events of
+all servers go through one set of event callbacks, which are called with
+the event and the Server it came from:
+
+   import asterisk.multiplex
+
+   def handle_event(event, server):
+      print ("%s: %s" % (server.name, event.name))
+
+   mux = asterisk.multiplex.Multiplexer()
+   mux.register_event('*', handle_event)
+   for name in 'pbx1', 'pbx2', 'pbx3':
+      mux.add_server(name, name, username = 'user', secret = 'secret')
+   mux.start()
+
+   pbx1 = mux.server('pbx1')
+   if pbx1.wait_connected(10):
+      print (pbx1.status())
+   mux.close()
+
+A Server has all the actions of asterisk.manager, they wait for the
+response and must not be used in the I/O thread, i.e. not in event
+callbacks. There queue_action sends an action and calls a function with
+the response later. Lost connections are reestablished with jittered
+exponential backoff and the server logs in again, actions waiting for a
+response are failed with ManagerSocketException.
+
+Instead of start the loop may be run in a thread of the caller with run
+or, integrated into another loop, with run_once.
+"""
+
+import errno
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from functools import partial
+from asterisk.compat import Queue, to_bytes, \
+    DefaultSelector, EVENT_READ, EVENT_WRITE
+from asterisk.manager import _Actions, _EventCallbacks, _Framer, \
+    _PendingActions, _event_name, _event_mask, ManagerMsg, Event, \
+    ManagerException, ManagerSocketException
+
+# errors of non-blocking sockets that only mean 'not now'
+_again = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EINTR)
+
+def _ignore(response):
+    pass
+
+
+class Server(_Actions):
+    """
+    The connection to one asterisk server of a Multiplexer. The
+    actions block the calling thread until the response arrives.
+    """
+
+    def __init__(self, mux, name, host, port, username, secret, events):
+        self.mux = mux
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.secret = secret
+        self.event_mask = events
+        self.title = None     # set by received greeting
+        self.version = None
+        # message of a failed login
+        self.error = None
+        self.reconnects = 0
+
+        # our hostname
+        self.hostname = socket.gethostname()
+        # pid -- used for unique naming of ActionID
+        self.pid      = os.getpid ()
+        self._seqlock = threading.Lock()
+        self._seq = 0
+
+        # the connection, only used by the I/O thread
+        self._sock = None
+        self._framer = None
+        self._state = 'down'
+        self._events = 0
+        self._delay = mux.reconnect_delay
+        self._up = threading.Event()
+
+        # data to write, guarded by the lock of the multiplexer
+        self._out = bytearray()
+        # actions waiting for their response and list actions
+        self._pending = _PendingActions()
+
+    def __repr__(self):
+        return '<Server %s %s:%s %s>' % \
+            (self.name, self.host, self.port, self._state)
+
+    @property
+    def timeout(self):
+        """The default timeout of the actions, see Multiplexer"""
+        return self.mux.timeout
+
+    def connected(self):
+        """Check if we are connected and logged in"""
+        return self._up.isSet()
+
+    def wait_connected(self, timeout=None):
+        """
+        Wait until we are connected and logged in, at most timeout
+        seconds. Returns connected().
+        """
+        self._up.wait(timeout)
+        return self._up.isSet()
+
+    def next_seq(self):
+        """Return the next number in the sequence, this is used for ActionID"""
+        self._seqlock.acquire()
+        try:
+            return self._seq
+        finally:
+            self._seq += 1
+            self._seqlock.release()
+
+    def queue_action(self, cdict={}, callback=None, **kwargs):
+        """
+        Send an action without waiting for the response, return its
+        ActionID. callback(response, server) is called in the I/O
+        thread with the response, with None if the connection is lost.
+        """
+        if not self.connected():
+            raise ManagerException("Not connected")
+        actionid, command = self._build_action(cdict, kwargs)
+        deliver = _ignore
+        if callback is not None:
+            deliver = lambda response: callback(response, self)
+        self.mux._send(self, actionid, command, deliver)
+        return actionid
+
+    def send_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send an action and wait for the response, see
+        Manager.send_action. The timeout defaults to the timeout of
+        the multiplexer.
+        """
+        self.mux._check_thread()
+        if timeout is None:
+            timeout = self.timeout
+        if not self.connected():
+            raise ManagerException("Not connected")
+
+        actionid, command = self._build_action(cdict, kwargs)
+        waiter = Queue()
+        self.mux._send(self, actionid, command, waiter.put)
+        response = self._pending.wait(actionid, waiter, timeout)
+
+        if not response:
+            raise ManagerSocketException(0, 'Connection Terminated')
+
+        return response
+
+    def send_list_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send an action that replies with a list of events, return the
+        response and the list of events, see Manager.send_list_action.
+        """
+        cdict = dict(cdict, **kwargs)
+        if 'ActionID' not in cdict:
+            cdict['ActionID'] = self._new_action_id()
+        if timeout is None:
+            timeout = self.timeout
+        # unbounded, the I/O thread must not wait for room
+        events = self._pending.list_action(self.send_action, cdict, timeout)
+        response = next(events)
+        return response, list(events)
+
+
+class Multiplexer(_EventCallbacks):
+    """
+    Connections to many asterisk servers driven by one selector loop.
+    """
+
+    # size of the reads from the sockets
+    recv_size = 65536
+    # reconnecting: first delay, doubled up to the maximum (seconds)
+    reconnect_delay = 0.5
+    reconnect_max_delay = 30.0
+
+    def __init__(self, timeout=None, stats=None):
+        """
+        timeout is the default for waiting for the response of an
+        action in seconds, None waits forever. Pass an
+        asterisk.stats.ManagerStats instance as stats to record the
+        dispatch and callback times of the events.
+        """
+        self.timeout = timeout
+        self.stats = stats
+        self._servers = OrderedDict()
+        self._selector = DefaultSelector()
+        self._lock = threading.Lock()
+        # functions to run in the I/O thread, queued by other threads
+        self._calls = []
+        # other threads wake up the loop with a byte on this pair
+        self._wakeup, self._wakeup_write = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self._selector.register(self._wakeup, EVENT_READ, None)
+        # reconnect time by server
+        self._retries = {}
+        self._closed = False
+        self._thread = None
+        # the thread running the loop
+        self._io_thread = None
+
+        # callbacks for events, see asterisk.manager.Manager
+        self._event_callbacks = {}
+        self._callback_lock = threading.Lock()
+        self._dispatch_index = {}
+        self._dispatch_default = ()
+        # events dropped unparsed as no callback is registered for them
+        self.events_skipped = 0
+
+    def add_server(self, name, host, port=5038, username=None, secret=None,
+        events=None):
+        """
+        Connect to the server at host and port under the given name
+        and log in if a username is given (with the event mask events,
+        see Manager.login). Returns the Server, the connection is made
+        by the loop.
+        """
+        if name in self._servers:
+            raise ManagerException('Duplicate server %s' % name)
+        server = Server(self, name, host, port, username, secret, events)
+        self._servers[name] = server
+        self._call(self._connect, server)
+        return server
+
+    def remove_server(self, name):
+        """Disconnect from a server and forget it"""
+        server = self._servers.pop(name)
+        self._call(self._remove, server)
+
+    def server(self, name):
+        """The server with the given name"""
+        return self._servers[name]
+
+    def servers(self):
+        """A list of all servers"""
+        return list(self._servers.values())
+
+    def __len__(self):
+        return len(self._servers)
+
+    def __contains__(self, name):
+        return name in self._servers
+
+    def __iter__(self):
+        return iter(self.servers())
+
+    def start(self):
+        """Run the loop in a new (daemon) thread"""
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def run(self):
+        """Run the loop until close is called"""
+        while not self._closed:
+            self.run_once()
+
+    def run_once(self, timeout=None):
+        """
+        Wait at most timeout seconds (forever for None) for the sockets,
+        handle everything that is ready.
+        """
+        self._io_thread = threading.current_thread()
+        self._lock.acquire()
+        try:
+            calls, self._calls = self._calls, []
+        finally:
+            self._lock.release()
+        for function, args in calls:
+            function(*args)
+
+        now = time.time()
+        for server, when in list(self._retries.items()):
+            if when <= now:
+                del self._retries[server]
+                server.reconnects += 1
+                self._connect(server)
+        if self._retries:
+            wait = max(min(self._retries.values()) - now, 0)
+            if timeout is None or wait < timeout:
+                timeout = wait
+
+        for key, events in self._selector.select(timeout):
+            server = key.data
+            if server is None:
+                self._drain_wakeup()
+            elif server._state == 'connecting':
+                self._connected(server)
+            else:
+                if events & EVENT_READ:
+                    self._read(server)
+                if events & EVENT_WRITE and server._sock is not None:
+                    self._flush(server)
+
+    def close(self):
+        """Stop the loop and close all connections"""
+        self._closed = True
+        self._wake()
+        if self._thread is not None and \
+            self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self._retries.clear()
+        for server in self._servers.values():
+            self._drop(server)
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_write.close()
+
+    def _check_thread(self):
+        if threading.current_thread() is self._io_thread \
+            and not self._closed:
+            raise ManagerException \
+                ('Waiting for a response in the I/O thread, use queue_action')
+
+    def _call(self, function, *args):
+        """Run the function in the I/O thread"""
+        self._lock.acquire()
+        try:
+            self._calls.append((function, args))
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b'x')
+        except socket.error:
+            # full, the loop wakes up anyway
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _send(self, server, actionid, command, deliver):
+        """Register the deliver function of an action and queue it"""
+        self._lock.acquire()
+        try:
+            server._pending.register([(actionid, deliver)])
+            idle = not server._out
+            server._out += to_bytes(command)
+        finally:
+            self._lock.release()
+        if idle:
+            self._call(self._flush, server)
+
+    def _interest(self, server, write):
+        """Select the socket of the server for reading (and writing)"""
+        events = EVENT_READ
+        if write:
+            events |= EVENT_WRITE
+        if events != server._events:
+            self._selector.modify(server._sock, events, server)
+            server._events = events
+
+    def _connect(self, server):
+        """Start connecting to a server, resolving its address first"""
+        if self._closed or server._sock is not None \
+            or server._state == 'resolving':
+            return
+        server._state = 'resolving'
+        # the lookup may take long, don't block the loop with it
+        thread = threading.Thread(target=self._resolve, args=(server,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _resolve(self, server):
+        """Look up the address of a server in a helper thread"""
+        try:
+            info = socket.getaddrinfo \
+                (server.host, server.port, 0, socket.SOCK_STREAM)[0]
+        except socket.error:
+            info = None
+        if not self._closed:
+            self._call(self._resolved, server, info)
+
+    def _resolved(self, server, info):
+        """Connect to the resolved address of a server"""
+        if server._state != 'resolving':
+            # removed in the meantime
+            return
+        server._state = 'down'
+        if self._closed or self._servers.get(server.name) is not server:
+            return
+        if info is None:
+            self._retry(server)
+            return
+        family, socktype, proto, name, address = info
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except socket.error:
+            self._retry(server)
+            return
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err and err not in _again:
+            sock.close()
+            self._retry(server)
+            return
+        server._sock = sock
+        server._framer = _Framer()
+        server._state = 'connecting'
+        server._events = EVENT_WRITE
+        self._selector.register(sock, EVENT_WRITE, server)
+
+    def _connected(self, server):
+        """The socket of a server is connected or has failed"""
+        err = server._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._lost(server)
+            return
+        server._state = 'greeting'
+        self._interest(server, False)
+
+    def _flush(self, server):
+        """Write as much of the queued data as the socket takes"""
+        if server._sock is None or server._state == 'connecting':
+            return
+        self._lock.acquire()
+        try:
+            try:
+                sent = server._sock.send(server._out)
+            except socket.error as err:
+                if err.args[0] not in _again:
+                    sent = None
+                else:
+                    sent = 0
+            if sent:
+                del server._out[:sent]
+            pending = bool(server._out)
+        finally:
+            self._lock.release()
+        if sent is None:
+            self._lost(server)
+        else:
+            self._interest(server, pending)
+
+    def _read(self, server):
+        try:
+            data = server._sock.recv(self.recv_size)
+        except socket.error as err:
+            if err.args[0] in _again:
+                return
+            data = b''
+        if not data:
+            self._lost(server)
+            return
+        for message in server._framer.feed(data):
+            self._message(server, message)
+            if server._sock is None:
+                break
+
+    def _message(self, server, data):
+        if server._state == 'greeting':
+            if server._framer.title:
+                server.title = server._framer.title
+                server.version = server._framer.version
+                self._login(server)
+            return
+
+        # drop events nobody is interested in before parsing
+        if not self._dispatch_default and not server._pending.list_events \
+            and data.startswith('Event:'):
+            if _event_name(data) not in self._dispatch_index:
+                self.events_skipped += 1
+                return
+
+        message = ManagerMsg(data)
+        if message.is_event():
+            event = Event(message)
+            # events of a list action go to its collector
+            collect = server._pending.collector(event)
+            if collect:
+                collect.deliver(event)
+                return
+            try:
+                self._run_callbacks(event, server)
+            except Exception:
+                # don't let one callback take down all connections
+                traceback.print_exc()
+        elif message.has_header('Response'):
+            self._route_response(server, message)
+        else:
+            print ('No clue what we got\n%s' % message.data)
+
+    def _route_response(self, server, message):
+        """
+        Hand a response to the action waiting for its ActionID, or
+        without ActionID to the oldest one.
+        """
+        deliver = server._pending.route(message)
+        if deliver:
+            try:
+                deliver(message)
+            except Exception:
+                traceback.print_exc()
+
+    def _login(self, server):
+        if server.username is None:
+            self._established(server)
+            return
+        server._state = 'login'
+        cdict = {'Action':'Login'}
+        cdict['Username'] = server.username
+        cdict['Secret'] = server.secret
+        if server.event_mask is not None:
+            cdict['Events'] = _event_mask(server.event_mask)
+        actionid, command = server._build_action(cdict, {})
+        self._send(server, actionid, command, partial(self._logged_in, server))
+
+    def _logged_in(self, server, response):
+        if response is None:
+            # lost, the connection is retried
+            return
+        if response.get_header('Response') == 'Error':
+            # don't retry with wrong credentials
+            server.error = response.get_header('Message')
+            self._drop(server)
+            return
+        self._established(server)
+
+    def _established(self, server):
+        server._state = 'up'
+        server.error = None
+        server._delay = self.reconnect_delay
+        server._up.set()
+
+    def _drop(self, server):
+        """Close the connection, fail the actions waiting for it"""
+        if server._sock is not None:
+            self._selector.unregister(server._sock)
+            server._sock.close()
+            server._sock = None
+        server._state = 'down'
+        server._events = 0
+        server._up.clear()
+        self._lock.acquire()
+        try:
+            waiting = server._pending.take()
+            del server._out[:]
+        finally:
+            self._lock.release()
+        server._pending.terminate(waiting)
+
+    def _lost(self, server):
+        """The connection of a server is lost, connect again later"""
+        self._drop(server)
+        self._retry(server)
+
+    def _retry(self, server):
+        if self._closed or self._servers.get(server.name) is not server:
+            return
+        # randomize the delay so that many clients don't come back
+        # at the same time after a restart of asterisk
+        self._retries[server] = \
+            time.time() + server._delay * random.uniform(0.5, 1.0)
+        server._delay = min(server._delay * 2, self.reconnect_max_delay)
+
+    def _remove(self, server):
+        self._retries.pop(server, None)
+        self._drop(server)
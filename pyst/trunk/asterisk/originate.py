@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Rate Governed Bulk Originate
+
+An asynchronous Originate is only queued by asterisk, the outcome of
+the call arrives later as an OriginateResponse event with the ActionID
+of the action. The OriginateEngine sends the originates of a campaign
+with a limited number of calls in progress, a limited rate in calls per
+second and limits per trunk, and hands out an OriginateCall for each
+call that completes with its OriginateResponse:
+
+   import asterisk.manager
+   import asterisk.originate
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   engine = asterisk.originate.OriginateEngine(manager, concurrency = 30,
+      rate = 5, trunk_limits = {'SIP/provider': 20})
+
+   specs = ({'Channel': 'SIP/provider/%s' % number, 'Context': 'campaign',
+      'Exten': 's', 'Priority': '1'} for number in numbers)
+   for call in engine.run(specs):
+      if not call.success:
+         print (call.spec['Channel'], call.reason)
+
+A call spec is a dict of the headers of the Originate action. The trunk
+of a call is derived from its Channel (see channel_trunk) unless the
+trunk function gives something else.
+
+The rate adapts to asterisk: it is halved (at most once per
+backoff_interval, down to min_rate) when the smoothed latency of the
+Originate responses exceeds latency_limit or an originate fails in
+asterisk (an error response, no response or a congestion or failure
+reason). It grows again by rate_step for every good response up to the
+configured rate.
+"""
+
+import threading
+from collections import deque
+from asterisk.manager import ManagerException, ManagerTimeoutException
+from asterisk.stats import clock
+
+# OriginateResponse reasons that tell asterisk could not place the call,
+# other failures (busy, no answer) are about the called party
+failure_reasons = frozenset(('0', '8'))
+
+def channel_trunk(channel):
+    """
+    The trunk of a dial string: SIP/provider/123 and
+    PJSIP/123@provider give SIP/provider and PJSIP/provider, a single
+    SIP/100 is its own trunk.
+    """
+    tech, sep, rest = channel.partition('/')
+    if '@' in rest:
+        return '%s/%s' % (tech, rest.split('@', 1)[1])
+    return '%s/%s' % (tech, rest.split('/', 1)[0])
+
+
+class OriginateCall(object):
+    """
+    One originate of the engine, a future that is done when the
+    OriginateResponse arrives or the originate failed.
+    """
+
+    def __init__(self, spec, trunk, actionid):
+        self.spec = spec
+        self.trunk = trunk
+        self.actionid = actionid
+        # the response to the action and the OriginateResponse
+        self.response = None
+        self.event = None
+        # exception when the originate failed in the manager
+        self.error = None
+        # when the action was sent and the seconds to its response
+        self.sent = None
+        self.latency = None
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def __repr__(self):
+        return '<OriginateCall %s %s>' % (self.spec.get('Channel'),
+            self.reason if self.done() else 'pending')
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """Wait at most timeout seconds for the call, return done()"""
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call, return the OriginateResponse event or raise
+        the exception of a failed originate.
+        """
+        if not self.wait(timeout):
+            raise ManagerTimeoutException \
+                ('Originate %s not done within %ss' % (self.actionid, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.event
+
+    @property
+    def success(self):
+        return self.event is not None \
+            and self.event.get_header('Response') == 'Success'
+
+    @property
+    def reason(self):
+        """The Reason of the OriginateResponse, the error otherwise"""
+        if self.event is not None:
+            return self.event.get_header('Reason')
+        return self.error
+
+    def add_done_callback(self, function):
+        """Call function(call) when the call is done"""
+        if self.done():
+            function(self)
+        else:
+            self._callbacks.append(function)
+
+
+class OriginateEngine(object):
+    """
+    Sends the originates of call specs with limits on concurrency,
+    rate and calls per trunk.
+    """
+
+    # rate adaption
+    min_rate = 0.2
+    rate_step = 0.05
+    latency_limit = 1.0
+    backoff_interval = 1.0
+
+    def __init__(self, manager, concurrency=10, rate=1.0, trunk_limits=None,
+        trunk=None, burst=1.0, timeout=10.0, answer_timeout=120.0):
+        """
+        Keep at most concurrency calls in progress (from sending the
+        originate to its OriginateResponse), send at most rate calls
+        per second (with bursts of burst calls) and at most
+        trunk_limits[trunk] calls in progress per trunk. trunk is a
+        function returning the trunk of a call spec (default see
+        channel_trunk). timeout is the timeout of the Originate action
+        and answer_timeout the time to wait for the OriginateResponse,
+        after that the call fails with ManagerTimeoutException.
+        """
+        self.manager = manager
+        self.concurrency = concurrency
+        self.max_rate = self.rate = float(rate)
+        self.trunk_limits = dict(trunk_limits or ())
+        self.trunk = trunk or self._trunk
+        self.burst = burst
+        self.timeout = timeout
+        self.answer_timeout = answer_timeout
+        self._cond = threading.Condition()
+        # calls waiting for their OriginateResponse by ActionID
+        self._calls = {}
+        self._by_trunk = {}
+        self._tokens = burst
+        self._refilled = clock()
+        self._slowed = None
+        # smoothed latency of the Originate responses
+        self.latency = None
+        # counters
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.slowdowns = 0
+        self.peak_inflight = 0
+        manager.register_event('OriginateResponse', self._originate_response)
+
+    def close(self):
+        """Stop listening to the OriginateResponse events"""
+        self.manager.unregister_event('OriginateResponse',
+            self._originate_response)
+
+    def _trunk(self, spec):
+        return channel_trunk(spec.get('Channel', ''))
+
+    def run(self, specs, callback=None, backlog=None):
+        """
+        Originate a call for each of the call specs, wait until all
+        calls are done and return the list of OriginateCalls in the
+        order of the specs. callback(call) is called for each call when
+        it is done. The specs are read lazily, calls of trunks at their
+        limit are passed by calls of other trunks among the next
+        backlog (default 2 * concurrency) specs.
+        """
+        if backlog is None:
+            backlog = 2 * self.concurrency
+        specs = iter(specs)
+        waiting = deque()
+        calls = []
+        while True:
+            for spec in specs:
+                waiting.append(spec)
+                if len(waiting) >= backlog:
+                    break
+            if not waiting:
+                break
+            call, cdict = self._next(waiting)
+            if callback is not None:
+                call.add_done_callback(callback)
+            self._send(call, cdict)
+            calls.append(call)
+        # wait for the calls in progress
+        self._cond.acquire()
+        try:
+            while self._calls:
+                self._cond.wait(self._expire())
+        finally:
+            self._cond.release()
+        return calls
+
+    def _next(self, waiting):
+        """
+        Wait until one of the waiting call specs may be sent, take it
+        and register its call. Returns the call and its action.
+        """
+        self._cond.acquire()
+        try:
+            while True:
+                delay = self._expire()
+                if len(self._calls) < self.concurrency:
+                    index, trunk = self._eligible(waiting)
+                    if index is not None:
+                        wait = self._token()
+                        if not wait:
+                            break
+                        delay = min(delay, wait)
+                self._cond.wait(delay)
+            spec = waiting[index]
+            del waiting[index]
+            cdict = dict(spec)
+            cdict['Action'] = 'Originate'
+            cdict['Async'] = 'true'
+            if 'ActionID' not in cdict:
+                cdict['ActionID'] = self.manager._new_action_id()
+            call = OriginateCall(spec, trunk, cdict['ActionID'])
+            # register first, the event may overtake the response
+            self._calls[call.actionid] = call
+            self._by_trunk[trunk] = self._by_trunk.get(trunk, 0) + 1
+            self.peak_inflight = max(self.peak_inflight, len(self._calls))
+            self.sent += 1
+            return call, cdict
+        finally:
+            self._cond.release()
+
+    def _eligible(self, waiting):
+        """The index and trunk of the first spec whose trunk has room"""
+        for index, spec in enumerate(waiting):
+            trunk = self.trunk(spec)
+            limit = self.trunk_limits.get(trunk)
+            if limit is None or self._by_trunk.get(trunk, 0) < limit:
+                return index, trunk
+        return None, None
+
+    def _token(self):
+        """Take a token, return 0 or the seconds until there is one"""
+        now = clock()
+        self._tokens = min(self.burst,
+            self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _expire(self):
+        """
+        Fail the calls waiting too long for their OriginateResponse,
+        return the seconds until the next one expires (at most 1).
+        """
+        now = clock()
+        delay = 1.0
+        for call in list(self._calls.values()):
+            if call.sent is None:
+                continue
+            left = call.sent + self.answer_timeout - now
+            if left <= 0:
+                self._finish(call, error = ManagerTimeoutException
+                    ('No OriginateResponse for %s' % call.actionid))
+            else:
+                delay = min(delay, left)
+        return delay
+
+    def _send(self, call, cdict):
+        start = clock()
+        try:
+            response = self.manager.send_action(cdict, self.timeout)
+        except ManagerException as err:
+            self._cond.acquire()
+            try:
+                self._slow_down()
+                self._finish(call, error = err)
+            finally:
+                self._cond.release()
+            return
+        self._cond.acquire()
+        try:
+            call.response = response
+            call.sent = start
+            call.latency = clock() - start
+            if self.latency is None:
+                self.latency = call.latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * call.latency
+            if response.get_header('Response') == 'Error':
+                self._slow_down()
+                self._finish(call, error = ManagerException
+                    (response.get_header('Message')))
+            elif self.latency > self.latency_limit:
+                self._slow_down()
+            else:
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+        finally:
+            self._cond.release()
+
+    def _slow_down(self):
+        now = clock()
+        if self._slowed is not None and \
+            now - self._slowed < self.backoff_interval:
+            return
+        self._slowed = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.slowdowns += 1
+
+    def _finish(self, call, event=None, error=None):
+        """Complete a call and free its slot, called with the lock held"""
+        if self._calls.pop(call.actionid, None) is None:
+            return
+        call.event = event
+        call.error = error
+        if call.success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        count = self._by_trunk.get(call.trunk, 0) - 1
+        if count > 0:
+            self._by_trunk[call.trunk] = count
+        else:
+            self._by_trunk.pop(call.trunk, None)
+        self._cond.notifyAll()
+        call._done.set()
+        for function in call._callbacks:
+            function(call)
+
+    def _originate_response(self, event, manager):
+        self._cond.acquire()
+        try:
+            call = self._calls.get(event.get_header('ActionID'))
+            if call is None:
+                return
+            if event.get_header('Response') != 'Success' and \
+                event.get_header('Reason') in failure_reasons:
+                self._slow_down()
+            self._finish(call, event = event)
+        finally:
+            self._cond.release()
+
+    def snapshot(self):
+        """
+        The current rate, the calls in progress (in total and by
+        trunk) and the counters of the engine.
+        """
+        self._cond.acquire()
+        try:
+            return dict \
+                ( rate          = self.rate
+                , latency       = self.latency
+                , inflight      = len(self._calls)
+                , by_trunk      = dict(self._by_trunk)
+                , peak_inflight = self.peak_inflight
+                , sent          = self.sent
+                , succeeded     = self.succeeded
+                , failed        = self.failed
+                , slowdowns     = self.slowdowns
+                )
+        finally:
+            self._cond.release()
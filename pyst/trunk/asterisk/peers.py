@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+SIP/PJSIP Peer Table for the Asterisk Manager
+
+A PeerRegistry loads the SIP peers (Sippeers) and PJSIP endpoints
+(PJSIPShowEndpoints) once and keeps them current from the PeerStatus,
+ContactStatus and Registry events instead of polling sippeers and
+sipshowpeer:
+
+   import asterisk.manager
+   import asterisk.peers
+
+   def changed(peer, old, new):
+      if new is None or new['State'] == 'unreachable':
+         print ("%s is gone" % peer)
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   peers = asterisk.peers.PeerRegistry(manager)
+   peers.add_listener(changed)
+
+   print (peers.get('SIP/100')['Address'])
+   print ([p['Peer'] for p in peers.by_state('unreachable')])
+
+Peers are dicts keyed by technology and name (e.g. 'SIP/100') with the
+headers of the list and status events and a few normalized entries:
+Peer, Technology, Name, Address and Port (None if unknown), Status
+(the last status reported by asterisk) and State, one of
+
+   reachable, lagged, unreachable, registered, unregistered, rejected,
+   unmonitored, unknown
+
+Like the channels of asterisk.channels the dicts are replaced on
+changes and never modified. For PJSIP endpoints with several contacts
+the last reported contact wins. Outbound registrations from the Registry
+events are kept in registrations, by Username@Domain.
+"""
+
+import threading
+
+# normalized State by prefix of the (lower case) status
+_states = \
+    ( ('ok',           'reachable')
+    , ('reachable',    'reachable')
+    , ('not in use',   'reachable')
+    , ('in use',       'reachable')
+    , ('busy',         'reachable')
+    , ('ringing',      'reachable')
+    , ('lagged',       'lagged')
+    , ('unreachable',  'unreachable')
+    , ('unavailable',  'unreachable')
+    , ('unregistered', 'unregistered')
+    , ('removed',      'unregistered')
+    , ('registered',   'registered')
+    , ('rejected',     'rejected')
+    , ('unmonitored',  'unmonitored')
+    )
+
+def peer_state(status):
+    """Normalized state of a peer status reported by asterisk"""
+    status = (status or '').lower()
+    for prefix, state in _states:
+        if status.startswith(prefix):
+            return state
+    return 'unknown'
+
+def split_address(address):
+    """
+    Split ip:port, [ipv6]:port or a SIP URI into the address and port
+    (None if not given), return None, None for unknown addresses.
+    """
+    if not address or address in ('-none-', '(null)', '(Unspecified)'):
+        return None, None
+    if ':' in address and address.split(':', 1)[0].lower() in ('sip', 'sips'):
+        # sip:user@host:port;params
+        address = address.split(':', 1)[1].split(';')[0].split('@')[-1]
+    if address.startswith('['):
+        host, sep, rest = address[1:].partition(']')
+        return host, rest[1:] or None
+    if address.count(':') == 1:
+        host, port = address.split(':')
+        return host, port
+    return address, None
+
+
+class PeerRegistry(object):
+    """
+    SIP and PJSIP peers by name, with indexes by address and state.
+    """
+
+    # headers that are not about the peer
+    ignored = frozenset \
+        (('Event', 'Privilege', 'ActionID', 'EventList', 'Response'))
+
+    def __init__(self, manager=None, seed=True):
+        """
+        Attach to the manager (if given) and load the current peers if
+        seed is true, the manager must be logged in then.
+        """
+        self._lock = threading.Lock()
+        self._peers = {}
+        self._by_address = {}
+        self._by_state = {}
+        # peers whose details were fetched with show
+        self._detailed = set()
+        self.registrations = {}
+        self.listeners = []
+        # updates received while loading the peers, replayed over them
+        self._seed_updates = None
+        self.manager = None
+        if manager is not None:
+            self.attach(manager)
+            if seed:
+                self.seed()
+
+    def attach(self, manager):
+        """Keep the table up to date from the events of the manager"""
+        self.manager = manager
+        for name, handler in self._handlers():
+            manager.register_event(name, handler)
+
+    def detach(self):
+        """Stop listening to the events of our manager"""
+        for name, handler in self._handlers():
+            self.manager.unregister_event(name, handler)
+        self.manager = None
+
+    def _handlers(self):
+        return \
+            ( ('PeerStatus',    self._peer_status)
+            , ('ContactStatus', self._contact_status)
+            , ('Registry',      self._registry)
+            , ('FullyBooted',   self._fully_booted)
+            )
+
+    def add_listener(self, listener):
+        """
+        Call listener(peer, old, new) for every changed peer, old is
+        None for new peers and new is None for removed peers.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def seed(self):
+        """Replace the table by the peers and endpoints of asterisk"""
+        self._lock.acquire()
+        try:
+            self._seed_updates = []
+        finally:
+            self._lock.release()
+        try:
+            peers, registrations = self._load()
+        except:
+            self._seed_updates = None
+            raise
+
+        self._lock.acquire()
+        try:
+            old = self._peers
+            self._peers = {}
+            self._by_address.clear()
+            self._by_state.clear()
+            self._detailed.clear()
+            for peer in peers.values():
+                self._store(peer)
+            self.registrations = registrations
+            # the snapshot may be older than the updates
+            for update, args in self._seed_updates:
+                update(*args)
+            self._seed_updates = None
+            new = self._peers
+        finally:
+            self._lock.release()
+        for key in set(old) | set(new):
+            if old.get(key) != new.get(key):
+                self._notify(key, old.get(key), new.get(key))
+
+    def _load(self):
+        """The peers and registrations reported by asterisk"""
+        peers = {}
+        for action, tech in ('Sippeers', 'SIP'), ('PJSIPShowEndpoints', 'PJSIP'):
+            response, events = self.manager.send_list_action(Action = action)
+            # the channel driver may not be loaded
+            if response.get_header('Response') == 'Error':
+                continue
+            for event in events:
+                name = event.get_header('ObjectName')
+                if name is None:
+                    continue
+                peer = self._peer(None, event.headers, tech, name)
+                if tech == 'SIP':
+                    address, port = split_address(event.get_header('IPaddress'))
+                    port = address and event.get_header('IPport') or None
+                    status = event.get_header('Status')
+                else:
+                    # Contacts: aor/sip:100@192.0.2.1:5060,...
+                    contact = (event.get_header('Contacts') or '').split(',')[0]
+                    address, port = split_address(contact.split('/', 1)[-1])
+                    status = event.get_header('DeviceState')
+                peer['Address'] = address
+                peer['Port'] = port
+                peer['Status'] = status
+                peer['State'] = peer_state(status)
+                peers[peer['Peer']] = peer
+        response, events = self.manager.send_list_action \
+            (Action = 'SIPshowregistry')
+        registrations = {}
+        if response.get_header('Response') != 'Error':
+            for event in events:
+                registration = dict((header, value)
+                    for header, value in event.headers.items()
+                    if header not in self.ignored)
+                registration['Status'] = event.get_header('State')
+                registrations[self._registration_key(event)] = registration
+        return peers, registrations
+
+    def _fully_booted(self, event, manager):
+        self.seed()
+
+    def _peer(self, peer, headers, tech, name):
+        """The peer updated with the headers"""
+        peer = dict(peer or ())
+        for header, value in headers.items():
+            if header not in self.ignored:
+                peer[header] = value
+        peer['Peer'] = '%s/%s' % (tech, name)
+        peer['Technology'] = tech
+        peer['Name'] = name
+        return peer
+
+    def _store(self, peer):
+        key = peer['Peer']
+        old = self._peers.get(key)
+        if old is not None:
+            self._unindex(old)
+        self._peers[key] = peer
+        if peer.get('Address'):
+            self._by_address.setdefault(peer['Address'], set()).add(key)
+        self._by_state.setdefault(peer['State'], set()).add(key)
+        return old
+
+    def _unindex(self, peer):
+        key = peer['Peer']
+        for index, value in \
+            (self._by_address, peer.get('Address')), \
+            (self._by_state, peer['State']):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+    def _update(self, tech, name, headers, status, address, port):
+        """Update or create a peer, notify the listeners of changes"""
+        args = (tech, name, headers, status, address, port)
+        self._lock.acquire()
+        try:
+            if self._seed_updates is not None:
+                self._seed_updates.append((self._apply, args))
+            key, old, peer = self._apply(*args)
+        finally:
+            self._lock.release()
+        if peer is not old:
+            self._notify(key, old, peer)
+
+    def _apply(self, tech, name, headers, status, address, port):
+        """Update a peer, return its key, the old and the new peer"""
+        key = '%s/%s' % (tech, name)
+        old = self._peers.get(key)
+        peer = self._peer(old, headers, tech, name)
+        peer['Status'] = status
+        peer['State'] = peer_state(status)
+        # unregistered peers have no address any more
+        if peer['State'] == 'unregistered':
+            peer['Address'] = peer['Port'] = None
+        elif address is not None:
+            peer['Address'] = address
+            peer['Port'] = port
+        peer.setdefault('Address', None)
+        peer.setdefault('Port', None)
+        if peer == old:
+            return key, old, old
+        self._store(peer)
+        return key, old, peer
+
+    def _notify(self, key, old, new):
+        for listener in self.listeners:
+            listener(key, old, new)
+
+    def _peer_status(self, event, manager):
+        # Peer: SIP/100
+        tech, sep, name = (event.get_header('Peer') or '').partition('/')
+        if not name:
+            return
+        address, port = split_address(event.get_header('Address'))
+        headers = dict(event.headers)
+        headers.pop('Peer', None)
+        headers.pop('Address', None)
+        self._update(tech, name, headers,
+            event.get_header('PeerStatus'), address, port)
+
+    def _contact_status(self, event, manager):
+        name = event.get_header('EndpointName') or event.get_header('AOR')
+        if not name:
+            return
+        status = event.get_header('ContactStatus')
+        address, port = split_address(event.get_header('URI'))
+        self._update('PJSIP', name, event.headers, status, address, port)
+
+    def _registration_key(self, event):
+        return '%s@%s' % (event.get_header('Username'),
+            event.get_header('Domain'))
+
+    def _registry(self, event, manager):
+        self._lock.acquire()
+        try:
+            if self._seed_updates is not None:
+                self._seed_updates.append((self._apply_registry, (event,)))
+            self._apply_registry(event)
+        finally:
+            self._lock.release()
+
+    def _apply_registry(self, event):
+        key = self._registration_key(event)
+        registrations = dict(self.registrations)
+        registration = dict(registrations.get(key, ()))
+        for header, value in event.headers.items():
+            if header not in self.ignored:
+                registration[header] = value
+        registrations[key] = registration
+        self.registrations = registrations
+
+    def get(self, peer, default=None):
+        """
+        The peer with the given name, either with the technology (e.g.
+        SIP/100) or without, then a SIP peer is preferred.
+        """
+        if '/' not in peer:
+            return self._peers.get('SIP/' + peer) \
+                or self._peers.get('PJSIP/' + peer, default)
+        return self._peers.get(peer, default)
+
+    def _lookup(self, index, value):
+        self._lock.acquire()
+        try:
+            return [self._peers[key] for key in index.get(value, ())]
+        finally:
+            self._lock.release()
+
+    def by_address(self, address):
+        """All peers at the given IP address"""
+        return self._lookup(self._by_address, address)
+
+    def by_state(self, state):
+        """All peers in the given normalized state"""
+        return self._lookup(self._by_state, state)
+
+    def show(self, peer):
+        """
+        The details of a peer as returned by sipshowpeer (or the
+        EndpointDetail of PJSIPShowEndpoint) merged with its current
+        state. The details are fetched from asterisk only once.
+        """
+        peer = self.get(peer)
+        if peer is None or peer['Peer'] in self._detailed:
+            return peer
+        if peer['Technology'] == 'SIP':
+            details = self.manager.sipshowpeer(peer['Name']).headers
+        else:
+            response, events = self.manager.send_list_action \
+                (Action = 'PJSIPShowEndpoint', Endpoint = peer['Name'])
+            details = {}
+            for event in events:
+                if event.name == 'EndpointDetail':
+                    details = event.headers
+        self._lock.acquire()
+        try:
+            current = self._peers.get(peer['Peer'])
+            if current is None:
+                return peer
+            detailed = dict(details)
+            # the state is kept current from the events
+            detailed.update(current)
+            for header in self.ignored:
+                detailed.pop(header, None)
+            self._store(detailed)
+            self._detailed.add(peer['Peer'])
+            return detailed
+        finally:
+            self._lock.release()
+
+    def peers(self):
+        """A list of all peers"""
+        return list(self._peers.values())
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, peer):
+        return self.get(peer) is not None
+
+    def __iter__(self):
+        return iter(self.peers())
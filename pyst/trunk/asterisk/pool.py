@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Pool of Manager Connections to one Asterisk
+
+A single Manager connection serializes all writes on one socket. A
+ManagerPool keeps several logged in Manager sessions to the same
+asterisk and sends each action on the session with the fewest actions
+waiting for a response:
+
+   import asterisk.pool
+
+   pool = asterisk.pool.ManagerPool('host', username = 'user',
+      secret = 'secret', size = 4, timeout = 10)
+   pool.start()
+   pool.originate('SIP/100', '200', context = 'internal', async_ = True)
+   print (pool.pool_stats())
+   pool.close()
+
+The pool has the actions of asterisk.manager. The sessions log in with
+the event mask events ('off' by default), the pool is meant for sending
+actions; use a separate Manager for events. A health thread pings every
+session each health_interval seconds and replaces sessions that are
+disconnected or don't answer, right away when an action failed with a
+lost connection.
+"""
+
+import threading
+from asterisk.manager import _Actions, Manager, ManagerException, \
+    ManagerSocketException
+
+class ManagerPool(_Actions):
+    """
+    A pool of Manager sessions to one asterisk with least outstanding
+    routing of the actions.
+    """
+
+    # seconds between health checks, and to wait for the ping of a
+    # health check when the pool has no timeout
+    health_interval = 10.0
+    health_timeout = 5.0
+
+    def __init__(self, host, port=5038, username=None, secret=None, size=4,
+        events='off', timeout=None, **kwargs):
+        """
+        Keep size sessions to asterisk at host and port, logged in with
+        the username and secret (if given) and event mask events. The
+        timeout and further keyword arguments are passed to each
+        Manager.
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+        self.size = size
+        self.events = events
+        self.timeout = timeout
+        self.manager_args = kwargs
+        self._lock = threading.Lock()
+        self._members = [None] * size
+        # actions waiting for a response by member
+        self._outstanding = [0] * size
+        # metrics
+        self.actions = 0
+        self.peak_outstanding = 0
+        self.replacements = 0
+        self.health_failures = 0
+        # health checking
+        self._stop = threading.Event()
+        self._check = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Connect the sessions and start the health thread. Sessions that
+        fail to connect are retried by the health thread, raises the
+        error if none connects.
+        """
+        errors = []
+        for index in range(self.size):
+            try:
+                self._members[index] = self._new_member()
+            except ManagerException as err:
+                errors.append(err)
+        if len(errors) == self.size:
+            raise errors[-1]
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._health)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the health thread and close all sessions"""
+        self._stop.set()
+        self._check.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._lock.acquire()
+        try:
+            members = self._members
+            self._members = [None] * self.size
+        finally:
+            self._lock.release()
+        for manager in members:
+            if manager is not None:
+                manager.close()
+
+    def connected(self):
+        """Check if at least one session is connected"""
+        return any(m is not None and m.connected() for m in self._members)
+
+    def members(self):
+        """A list of the current sessions"""
+        return [m for m in self._members if m is not None]
+
+    def _new_member(self):
+        manager = Manager(timeout=self.timeout, **self.manager_args)
+        manager.connect(self.host, self.port)
+        try:
+            if self.username is not None:
+                manager.login(self.username, self.secret, self.events)
+        except:
+            manager.close()
+            raise
+        return manager
+
+    def _acquire(self):
+        """Pick the connected session with the fewest outstanding actions"""
+        self._lock.acquire()
+        try:
+            candidates = [index for index, m in enumerate(self._members)
+                if m is not None and m.connected()]
+            if not candidates:
+                raise ManagerException \
+                    ('No connection to %s available' % self.host)
+            index = min(candidates, key=self._outstanding.__getitem__)
+            self._outstanding[index] += 1
+            self.actions += 1
+            self.peak_outstanding = max(self.peak_outstanding,
+                sum(self._outstanding))
+            return index, self._members[index]
+        finally:
+            self._lock.release()
+
+    def _release(self, index):
+        self._lock.acquire()
+        try:
+            self._outstanding[index] -= 1
+        finally:
+            self._lock.release()
+
+    def _route(self, method, *args, **kwargs):
+        """Call a method of the least loaded session"""
+        index, manager = self._acquire()
+        try:
+            return getattr(manager, method)(*args, **kwargs)
+        except ManagerSocketException:
+            # check the sessions now
+            self._check.set()
+            raise
+        finally:
+            self._release(index)
+
+    def send_action(self, cdict={}, timeout=None, **kwargs):
+        """Send an action on the least loaded session, see Manager"""
+        return self._route('send_action', cdict, timeout, **kwargs)
+
+    def send_list_action(self, cdict={}, timeout=None, **kwargs):
+        """Send a list action on the least loaded session, see Manager"""
+        return self._route('send_list_action', cdict, timeout, **kwargs)
+
+    def send_actions(self, actions, timeout=None):
+        """Send a batch of actions on the least loaded session, see Manager"""
+        return self._route('send_actions', actions, timeout)
+
+    def login(self, username, secret, events=None):
+        """The sessions are logged in by the pool"""
+        raise ManagerException('Pass username and secret to the pool')
+
+    def _health(self):
+        while not self._stop.isSet():
+            self._check.wait(self.health_interval)
+            self._check.clear()
+            if self._stop.isSet():
+                break
+            self.check()
+
+    def _alive(self, manager):
+        if not manager.connected():
+            return False
+        try:
+            response = manager.send_action({'Action':'Ping'},
+                self.timeout or self.health_timeout)
+        except ManagerException:
+            return False
+        return response.get_header('Response') != 'Error'
+
+    def check(self):
+        """
+        Ping all sessions, replace those that don't answer. Called by
+        the health thread.
+        """
+        for index in range(self.size):
+            manager = self._members[index]
+            if manager is not None:
+                if self._alive(manager):
+                    continue
+                self.health_failures += 1
+                self._lock.acquire()
+                try:
+                    self._members[index] = None
+                finally:
+                    self._lock.release()
+                try:
+                    manager.close()
+                except ManagerException:
+                    pass
+            if self._stop.isSet():
+                return
+            try:
+                manager = self._new_member()
+            except ManagerException:
+                # again with the next check
+                continue
+            self._lock.acquire()
+            try:
+                self._members[index] = manager
+                self.replacements += 1
+            finally:
+                self._lock.release()
+
+    def pool_stats(self):
+        """
+        Utilization of the pool: the number of sessions (size and
+        connected), the outstanding actions (in total, by session and
+        the peak), the share of sessions busy with an action
+        (utilization), the number of actions sent, of failed health
+        checks and of replaced sessions.
+        """
+        self._lock.acquire()
+        try:
+            outstanding = list(self._outstanding)
+            connected = sum(1 for m in self._members
+                if m is not None and m.connected())
+            return dict \
+                ( size             = self.size
+                , connected        = connected
+                , outstanding      = sum(outstanding)
+                , by_member        = outstanding
+                , peak_outstanding = self.peak_outstanding
+                , utilization      =
+                    float(sum(1 for n in outstanding if n)) / self.size
+                , actions          = self.actions
+                , health_failures  = self.health_failures
+                , replacements     = self.replacements
+                )
+        finally:
+            self._lock.release()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Real-time Queue Statistics for the Asterisk Manager
+
+QueueStats aggregates the queue and agent events of a Manager into the
+current state of every queue (callers waiting, longest wait, members
+available) and rolling statistics over fixed windows (answered and
+abandoned calls, service level, average hold and talk time) without
+polling QueueStatus:
+
+   import asterisk.manager
+   import asterisk.queues
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   queues = asterisk.queues.QueueStats(manager, intervals = (900, 3600))
+
+   for name, queue in queues.snapshot().items():
+      print (name, queue['waiting'], queue['available'],
+         queue['windows'][900]['service_level'])
+
+Each window is a ring buffer of a fixed number of slots, so memory does
+not grow with the number of calls and old calls drop out of a window
+one slot (interval / slots seconds) at a time. The service level is
+the share of calls answered within service_level seconds of all
+answered and abandoned calls of the window.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class _Window(object):
+    """Counters of a queue over the last length seconds"""
+
+    fields = ('answered', 'answered_within', 'abandoned', 'completed',
+        'hold_time', 'talk_time')
+
+    __slots__ = ('width', 'epochs', 'counters')
+
+    def __init__(self, length, slots):
+        self.width = float(length) / slots
+        self.epochs = [None] * slots
+        self.counters = dict((field, [0] * slots) for field in self.fields)
+
+    def add(self, now, field, value=1):
+        epoch = int(now // self.width)
+        slot = epoch % len(self.epochs)
+        if self.epochs[slot] != epoch:
+            # the slot is reused for a new period
+            self.epochs[slot] = epoch
+            for counters in self.counters.values():
+                counters[slot] = 0
+        self.counters[field][slot] += value
+
+    def totals(self, now):
+        oldest = int(now // self.width) - len(self.epochs)
+        current = [n for n, epoch in enumerate(self.epochs)
+            if epoch is not None and epoch > oldest]
+        return dict((field, sum(counters[n] for n in current))
+            for field, counters in self.counters.items())
+
+
+class _Queue(object):
+    """Current state and windows of one queue"""
+
+    __slots__ = ('waiting', 'members', 'available', 'paused', 'windows')
+
+    def __init__(self, intervals, slots):
+        # join time by Uniqueid, oldest first
+        self.waiting = OrderedDict()
+        # status and paused flag by interface
+        self.members = {}
+        self.available = set()
+        self.paused = set()
+        self.windows = dict((i, _Window(i, slots)) for i in intervals)
+
+    def set_member(self, interface, status, paused):
+        old_status, old_paused = self.members.get(interface, (None, None))
+        if status is None:
+            status = old_status
+        if paused is None:
+            paused = old_paused
+        self.members[interface] = (status, paused)
+        for members, member in \
+            (self.paused, paused == '1'), \
+            (self.available, status == '1' and paused != '1'):
+            if member:
+                members.add(interface)
+            else:
+                members.discard(interface)
+
+    def remove_member(self, interface):
+        self.members.pop(interface, None)
+        self.available.discard(interface)
+        self.paused.discard(interface)
+
+    def add(self, now, field, value=1):
+        for window in self.windows.values():
+            window.add(now, field, value)
+
+
+class QueueStats(object):
+    """
+    Per queue state and windowed statistics from the queue events.
+    """
+
+    def __init__(self, manager=None, intervals=(900, 3600), service_level=20,
+        slots=60, seed=True, clock=time.time):
+        """
+        Keep statistics over windows of the given intervals (seconds),
+        each a ring buffer of slots. Attach to the manager (if given)
+        and load the current queues with QueueStatus if seed is true,
+        the manager must be logged in then.
+        """
+        self.intervals = tuple(intervals)
+        self.service_level = service_level
+        self.slots = slots
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._queues = {}
+        self.manager = None
+        if manager is not None:
+            self.attach(manager)
+            if seed:
+                self.seed()
+
+    def _handlers(self):
+        return \
+            ( ('QueueCallerJoin',    self._join)
+            , ('Join',               self._join)
+            , ('QueueCallerLeave',   self._leave)
+            , ('Leave',              self._leave)
+            , ('QueueCallerAbandon', self._abandon)
+            , ('AgentConnect',       self._connect)
+            , ('AgentComplete',      self._complete)
+            , ('QueueMemberStatus',  self._member)
+            , ('QueueMemberAdded',   self._member)
+            , ('QueueMemberPause',   self._member)
+            , ('QueueMemberPaused',  self._member)
+            , ('QueueMemberRemoved', self._member_removed)
+            , ('FullyBooted',        self._fully_booted)
+            )
+
+    def attach(self, manager):
+        """Update the statistics from the events of the manager"""
+        self.manager = manager
+        for name, handler in self._handlers():
+            manager.register_event(name, handler)
+
+    def detach(self):
+        """Stop listening to the events of our manager"""
+        for name, handler in self._handlers():
+            self.manager.unregister_event(name, handler)
+        self.manager = None
+
+    def _queue(self, event):
+        """The queue of an event, created on first use"""
+        name = event.get_header('Queue')
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = self._queues[name] = _Queue(self.intervals, self.slots)
+        return queue
+
+    def seed(self):
+        """
+        Load the members and waiting callers of all queues, the
+        windowed statistics are kept.
+        """
+        response, events = self.manager.send_list_action(Action = 'QueueStatus')
+        if response.get_header('Response') == 'Error':
+            return
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            for queue in self._queues.values():
+                queue.waiting.clear()
+                for interface in list(queue.members):
+                    queue.remove_member(interface)
+            for event in events:
+                if event.name == 'QueueParams':
+                    self._queue(event)
+                elif event.name == 'QueueMember':
+                    self._queue(event).set_member(self._interface(event),
+                        event.get_header('Status'), event.get_header('Paused'))
+                elif event.name == 'QueueEntry':
+                    wait = float(event.get_header('Wait') or 0)
+                    self._queue(event).waiting[event.get_header('Uniqueid')] \
+                        = now - wait
+        finally:
+            self._lock.release()
+
+    def _fully_booted(self, event, manager):
+        self.seed()
+
+    def _interface(self, event):
+        return event.get_header('Interface') or event.get_header('Location') \
+            or event.get_header('StateInterface')
+
+    def _join(self, event, manager):
+        self._lock.acquire()
+        try:
+            self._queue(event).waiting[event.get_header('Uniqueid')] = \
+                self.clock()
+        finally:
+            self._lock.release()
+
+    def _leave(self, event, manager):
+        self._lock.acquire()
+        try:
+            self._queue(event).waiting.pop(event.get_header('Uniqueid'), None)
+        finally:
+            self._lock.release()
+
+    def _abandon(self, event, manager):
+        self._lock.acquire()
+        try:
+            queue = self._queue(event)
+            queue.waiting.pop(event.get_header('Uniqueid'), None)
+            queue.add(self.clock(), 'abandoned')
+        finally:
+            self._lock.release()
+
+    def _connect(self, event, manager):
+        hold = int(event.get_header('HoldTime') or 0)
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            queue = self._queue(event)
+            queue.waiting.pop(event.get_header('Uniqueid'), None)
+            queue.add(now, 'answered')
+            queue.add(now, 'hold_time', hold)
+            if hold <= self.service_level:
+                queue.add(now, 'answered_within')
+        finally:
+            self._lock.release()
+
+    def _complete(self, event, manager):
+        talk = int(event.get_header('TalkTime') or 0)
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            queue = self._queue(event)
+            queue.add(now, 'completed')
+            queue.add(now, 'talk_time', talk)
+        finally:
+            self._lock.release()
+
+    def _member(self, event, manager):
+        self._lock.acquire()
+        try:
+            self._queue(event).set_member(self._interface(event),
+                event.get_header('Status'), event.get_header('Paused'))
+        finally:
+            self._lock.release()
+
+    def _member_removed(self, event, manager):
+        self._lock.acquire()
+        try:
+            self._queue(event).remove_member(self._interface(event))
+        finally:
+            self._lock.release()
+
+    def _summary(self, queue, now):
+        waiting = len(queue.waiting)
+        longest = 0
+        if waiting:
+            longest = now - next(iter(queue.waiting.values()))
+        windows = {}
+        for interval, window in queue.windows.items():
+            w = window.totals(now)
+            offered = w['answered'] + w['abandoned']
+            w['service_level'] = \
+                float(w['answered_within']) / offered if offered else None
+            w['average_hold'] = \
+                float(w['hold_time']) / w['answered'] if w['answered'] else None
+            w['average_talk'] = \
+                float(w['talk_time']) / w['completed'] if w['completed'] else None
+            windows[interval] = w
+        return dict \
+            ( waiting      = waiting
+            , longest_wait = longest
+            , members      = len(queue.members)
+            , available    = len(queue.available)
+            , paused       = len(queue.paused)
+            , windows      = windows
+            )
+
+    def queue(self, name):
+        """The snapshot of one queue, None if unknown"""
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            queue = self._queues.get(name)
+            if queue is None:
+                return None
+            return self._summary(queue, now)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        A dict by queue name of the callers waiting, the longest wait
+        (seconds), the number of members, available and paused members
+        and the window statistics by interval: answered (and
+        answered_within the service level), abandoned and completed
+        calls, service_level, hold_time and talk_time (totals and
+        average_hold, average_talk).
+        """
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            return dict((name, self._summary(queue, now))
+                for name, queue in self._queues.items())
+        finally:
+            self._lock.release()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+
+"""
+Instrumentation for the Asterisk Manager
+
+Statistics are disabled by default. Pass a ManagerStats instance to the
+Manager to record latency histograms of the actions (from sending the
+action to the matched response), of the parsing and dispatching of
+events by event name and of the run time of the event callbacks:
+
+   import asterisk.manager
+   import asterisk.stats
+
+   def slow(kind, name, seconds):
+      if seconds > 0.5:
+         print ("slow %s %s: %.3fs" % (kind, name, seconds))
+
+   stats = asterisk.stats.ManagerStats()
+   stats.add_hook(slow)
+   manager = asterisk.manager.Manager(stats = stats)
+   ...
+   print (manager.stats_snapshot())
+
+Hooks are called with the kind of the measurement ('action', 'parse',
+'dispatch' or 'callback'), the action, event or callback name and the
+time in seconds. They run in the thread that took the measurement and
+should return quickly.
+
+Messages are otherwise parsed lazily, on the first access to a header.
+While statistics are recorded the headers of events are decoded right
+away, so that 'parse' measures the header parsing and not only the
+creation of the message.
+"""
+
+import threading
+from bisect import bisect_left
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+class Histogram(object):
+    """
+    A histogram of times in seconds with logarithmic buckets, the
+    upper bound of the buckets doubles from one microsecond to about
+    a minute, the last bucket takes everything above.
+    """
+
+    bounds = tuple(1e-6 * 2 ** k for k in range(27))
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket containing the given percentile
+        (limited by the maximum seen), None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict \
+            ( count   = self.count
+            , total   = self.total
+            , mean    = self.total / self.count if self.count else None
+            , min     = self.min
+            , max     = self.max
+            , p50     = self.percentile(50)
+            , p90     = self.percentile(90)
+            , p99     = self.percentile(99)
+            , buckets = dict((b, n) for b, n in
+                zip(self.bounds + (None,), self.counts) if n)
+            )
+
+
+class ManagerStats(object):
+    """
+    Histograms of a Manager by kind of measurement and name.
+    """
+
+    kinds = ('action', 'parse', 'dispatch', 'callback')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict((kind, {}) for kind in self.kinds)
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """Call hook(kind, name, seconds) for every measurement"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, kind, name, seconds):
+        histograms = self._histograms[kind]
+        self._lock.acquire()
+        try:
+            h = histograms.get(name)
+            if h is None:
+                h = histograms[name] = Histogram()
+            h.add(seconds)
+        finally:
+            self._lock.release()
+        for hook in self.hooks:
+            hook(kind, name, seconds)
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            for histograms in self._histograms.values():
+                histograms.clear()
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Return a dict by kind of dicts by name of the histogram
+        summaries (count, total, mean, min, max, percentiles and the
+        non-empty buckets by upper bound).
+        """
+        self._lock.acquire()
+        try:
+            return dict \
+                ((kind, dict((name, h.snapshot())
+                    for name, h in histograms.items()))
+                 for kind, histograms in self._histograms.items()
+                )
+        finally:
+            self._lock.release()
+
+
+def callback_name(function):
+    """Name of an event callback used in the statistics"""
+    name = getattr(function, '__name__', None)
+    if name is None:
+        return repr(function)
+    owner = getattr(function, '__self__', None)
+    if owner is not None:
+        name = '%s.%s' % (owner.__class__.__name__, name)
+    return '%s.%s' % (getattr(function, '__module__', None), name)
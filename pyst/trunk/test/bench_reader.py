@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Benchmark the manager message reader.
+
+Compares the line based reader formerly used in Manager._receive_data
+(iterating over socket.makefile) with the chunked _Framer now in use.
+Both read the same stream of events and command output from a socket
+pair and must produce the same message boundaries.
+
+    python test/bench_reader.py [number of events]
+"""
+from __future__ import print_function
+import os
+import sys
+import socket
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asterisk.manager import _Framer, EOL
+from asterisk.compat import to_str
+
+event = \
+    ( 'Event: Newexten\r\n'
+      'Privilege: dialplan,all\r\n'
+      'Channel: Local/102@from-queue-a8ca;2\r\n'
+      'Context: macro-dial-one\r\n'
+      'Extension: zap2dahdi\r\n'
+      'Priority: 9\r\n'
+      'Application: GotoIf\r\n'
+      'AppData: 0?begin2\r\n'
+      'Uniqueid: 1325950970.698\r\n'
+      '\r\n'
+    )
+command = \
+    ( 'Response: Follows\r\n'
+      'Privilege: Command\r\n'
+      'ActionID: bench-1\r\n'
+    + 'lcr/556  s@attendoparse:9  Up  Read(dtmf,,30,noanswer,,2)\n' * 20
+    + '\r\n'
+      '1 active channel\n'
+      '--END COMMAND--\r\n'
+      '\r\n'
+    )
+
+def stream(n):
+    chunks = ['Asterisk Call Manager/1.1\r\n']
+    for k in range(n):
+        chunks.append(command if k % 100 == 99 else event)
+    return ''.join(chunks).encode('ascii')
+
+def line_reader(sock):
+    """ The reader formerly used by Manager._receive_data """
+    f = sock.makefile('rb')
+    title = None
+    messages = []
+    wait_for_marker = multiline = False
+    lines = []
+    for line in f:
+        line = to_str(line)
+        if not title and '/' in line and not ':' in line:
+            title = line.split('/')[0].strip()
+            messages.append('Response: Generated Header\r\n' + line)
+            continue
+        if line == EOL and not wait_for_marker:
+            multiline = False
+            if lines:
+                messages.append(''.join(lines))
+                lines = []
+            continue
+        lines.append(line)
+        if not line.endswith('\r\n') or ':' not in line:
+            multiline = True
+        if not multiline and line.startswith('Response') and \
+            line.split(':', 1)[1].strip() == 'Follows':
+            wait_for_marker = True
+        if multiline and line.startswith('--END COMMAND--'):
+            wait_for_marker = False
+            multiline = False
+    return messages
+
+def framer_reader(sock):
+    """ The reader now used by Manager._receive_data """
+    framer = _Framer()
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    messages = []
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        messages.extend(framer.feed(view[:n]))
+    return messages
+
+def run(reader, data):
+    a, b = socket.socketpair()
+    def writer():
+        a.sendall(data)
+        a.close()
+    t = threading.Thread(target=writer)
+    t.start()
+    start = time()
+    messages = reader(b)
+    elapsed = time() - start
+    t.join()
+    b.close()
+    return elapsed, messages
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = stream(n)
+    results = {}
+    for reader in line_reader, framer_reader:
+        elapsed, messages = run(reader, data)
+        results[reader.__name__] = messages
+        print("%-14s %8d messages %7.3fs %9.0f msg/s"
+            % (reader.__name__, len(messages), elapsed, len(messages) / elapsed))
+    assert results['line_reader'] == results['framer_reader']
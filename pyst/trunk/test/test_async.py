@@ -0,0 +1,105 @@
+import unittest
+from   asterisk.astemu import Event, AsteriskEmu
+try:
+    import asyncio
+    from asterisk.asyncmanager import AsyncManager
+except (ImportError, SyntaxError):
+    asyncio = None
+
+class Test_AsyncManager(unittest.TestCase):
+    """ Test the asyncio variant of the asterisk management interface.
+    """
+
+    default_events = AsteriskEmu.default_events
+
+    def setUp(self):
+        self.astemu  = None
+        self.manager = None
+        self.events  = []
+        self.loop    = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        if self.manager:
+            self.wait(self.manager.close())
+        if self.astemu:
+            self.astemu.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10))
+
+    def run_manager(self, chatscript):
+        self.astemu = AsteriskEmu (chatscript)
+        self.manager = AsyncManager()
+        self.wait(self.manager.connect('localhost', port = self.astemu.port))
+        self.assertEqual(self.manager.title, 'Asterisk Call Manager')
+
+    def test_login_command(self):
+        events = dict \
+            ( Command =
+                ( Event
+                    ( Response  = ('Follows',)
+                    , Privilege = ('Command',)
+                    , CONTENT   =
+"""Channel              Location             State   Application(Data)
+0 active channels\r
+
+0 active calls
+--END COMMAND--\r
+"""
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        r = self.wait(self.manager.login('account', 'geheim'))
+        self.assertEqual(r['Response'], 'Success')
+        r = self.wait(self.manager.command('core show channels'))
+        self.assertEqual(r['Response'], 'Follows')
+        self.assertEqual(r.data, events['Command'][0]['CONTENT'])
+
+    def test_events(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('AgentCalled',)
+                    , Queue     = ('test',)
+                    , Variable  = ('data1=456789', 'data2=test')
+                    )
+                , Event
+                    ( Event     = ('Hangup',)
+                    , Channel   = ('lcr/558',)
+                    )
+                )
+            )
+        done = asyncio.Event()
+        def handler(event, manager):
+            self.events.append(event)
+        def awaitable_handler(event, manager):
+            # the result is only known after another loop iteration
+            self.events.append(event)
+            done.set()
+            result = self.loop.create_future()
+            self.loop.call_soon(result.set_result, True)
+            return result
+        self.run_manager(events)
+        self.manager.register_event('Hangup', awaitable_handler)
+        self.manager.register_event('*', handler)
+        self.wait(self.manager.login('account', 'geheim'))
+        self.wait(done.wait())
+        self.assertEqual([e.name for e in self.events],
+            ['AgentCalled', 'Hangup'])
+        self.assertEqual(self.events[0].multiheaders['Variable'],
+            ['data1=456789', 'data2=test'])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    if asyncio is not None:
+        suite.addTest (unittest.makeSuite (Test_AsyncManager))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,25 @@
+import re
 import sys
+import random
 import socket
+import threading
+import time
 import unittest
-from   asterisk.manager import Manager
-from   asterisk.compat import Queue
+from   asterisk.manager import Manager, ManagerMsg, Event as AmiEvent, _Framer
+from   asterisk.manager import _Chunk, ManagerException
+from   asterisk.manager import _OverflowQueue, ManagerSocketException
+from   asterisk.manager import ManagerTimeoutException
+from   asterisk.compat import Queue, Full
+from   asterisk.stats import ManagerStats
 from   asterisk.astemu import Event, AsteriskEmu
 
+def wait_for(condition, timeout=5):
+    """Poll condition until it is true or the timeout expires"""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
 class Test_Manager(unittest.TestCase):
     """ Test the asterisk management interface.
     """
@@ -32,15 +47,15 @@ class Test_Manager(unittest.TestCase):
         self.queue.put(self.evcount)
         self.evcount += 1
 
-    def run_manager(self, chatscript):
+    def run_manager(self, chatscript, **kw):
         self.astemu = AsteriskEmu (chatscript)
         self.port = self.astemu.port
-        self.manager = Manager()
+        self.manager = Manager(**kw)
         self.manager.connect('localhost', port = self.port)
         self.manager.register_event ('*', self.handler)
 
     def compare_result(self, r_event, event):
-        for k, v in event.iteritems():
+        for k, v in event.items():
             if k == 'CONTENT':
                 self.assertEqual(r_event.data, v)
             elif isinstance(v, str):
@@ -81,6 +96,91 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
         self.assertEqual(self.events, [])
         self.compare_result(r, events['Command'][0])
 
+    def test_iter_command(self):
+        output, events = self.command_script(5000)
+        self.run_manager(events)
+        lines = list(self.manager.iter_command('core show channels'))
+        self.assertEqual(lines, output.split('\n')[:-1])
+        # stop after the first line, the rest is dropped
+        for line in self.manager.iter_command('core show channels'):
+            self.assertEqual(line, 'SIP/0-00000001  s@default:1  Up')
+            break
+        self.assertEqual(self.manager._streams, {})
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        # the framer has dropped the output up to its end
+        self.assertEqual(self.manager._discard, set())
+        self.assertEqual(self.events, [])
+
+    def command_script(self, lines):
+        output = ''.join('SIP/%d-00000001  s@default:1  Up\n' % n
+            for n in range(lines))
+        events = dict \
+            ( Command =
+                ( Event
+                    ( Response  = ('Follows',)
+                    , Privilege = ('Command',)
+                    , CONTENT   = output + '--END COMMAND--\r\n'
+                    )
+                ,
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        return output, events
+
+    def test_iter_command_slow(self):
+        output, events = self.command_script(20000)
+        self.run_manager(events, timeout = 5)
+        # the reader waits for room while we sleep, leaving the loop
+        # must let it go on
+        for line in self.manager.iter_command('core show channels',
+            buffer = 2):
+            time.sleep(0.5)
+            break
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(self.manager._streams, {})
+
+    def test_iter_command_overflow(self):
+        # chunks are never dropped from a full message queue
+        output, events = self.command_script(20000)
+        self.run_manager(events, timeout = 5, max_messages = 2,
+            overflow = 'drop_oldest')
+        lines = list(self.manager.iter_command('core show channels',
+            buffer = 1))
+        self.assertEqual(lines, output.split('\n')[:-1])
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+
+    def test_iter_command_output(self):
+        events = dict \
+            ( Command =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Message   = ('Command output follows',)
+                    , Output    = ('Name/username  Host', '100  (Unspecified)')
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        lines = list(self.manager.iter_command('sip show peers'))
+        self.assertEqual(lines, ['Name/username  Host', '100  (Unspecified)'])
+        self.close()
+        events['Command'] = \
+            ( Event
+                ( Response  = ('Error',)
+                , Message   = ('Permission denied',)
+                )
+            ,
+            )
+        self.run_manager(events)
+        self.assertRaises(ManagerException, list,
+            self.manager.iter_command('sip show peers'))
+
     def test_redirect(self):
         d = dict
         events = dict \
@@ -217,6 +317,612 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
             n = self.queue.get()
             self.compare_result(self.events[n], events['Originate'][n+1])
 
+    def test_concurrent_actions(self):
+        events = dict \
+            ( Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        results = Queue()
+        def pinger():
+            for k in range(20):
+                actionid = 'ping-%s-%s' % (threading.currentThread().name, k)
+                r = self.manager.send_action(Action='Ping', ActionID=actionid)
+                results.put((actionid, r.get_header('ActionID')))
+        threads = [threading.Thread(target=pinger) for k in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.qsize(), 100)
+        while not results.empty():
+            sent, received = results.get()
+            self.assertEqual(sent, received)
+        self.assertEqual(self.manager._pending.pending, {})
+        self.assertEqual(self.events, [])
+
+    def test_list_action(self):
+        events = dict \
+            ( Sippeers =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    , Message    = ('Peer status list will follow',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('100',)
+                    , Status     = ('OK (5 ms)',)
+                    )
+                , Event
+                    ( Event      = ('Newchannel',)
+                    , Channel    = ('SIP/100-00000001',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('trunk1',)
+                    , Status     = ('UNREACHABLE',)
+                    )
+                , Event
+                    ( Event      = ('PeerlistComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    , ListItems  = ('2',)
+                    )
+                )
+            )
+        self.run_manager(events)
+        r, peers = self.manager.send_list_action(Action='Sippeers')
+        self.assertEqual(r['Response'], 'Success')
+        self.assertEqual([p['ObjectName'] for p in peers], ['100', 'trunk1'])
+        peers = self.manager.iter_list_action({'Action' : 'Sippeers'})
+        self.assertEqual(next(peers)['ObjectName'], '100')
+        self.assertEqual([p['ObjectName'] for p in peers], ['trunk1'])
+        self.assertEqual(self.manager._pending.list_events, {})
+        # only the unrelated events were dispatched
+        for k in range(2):
+            n = self.queue.get()
+        self.assertEqual([e.name for e in self.events], ['Newchannel'] * 2)
+
+    def test_iter_list_action_slow(self):
+        events = dict \
+            ( Sippeers = tuple
+                ( [ Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                  ]
+                + [ Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = (str(n),)
+                    )
+                    for n in range(3000)
+                  ]
+                + [ Event
+                    ( Event      = ('PeerlistComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    )
+                  ]
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events, timeout = 5)
+        peers = self.manager.iter_list_action({'Action' : 'Sippeers'},
+            buffer = 10)
+        self.assertEqual(next(peers)['ObjectName'], '0')
+        # the stalled consumer holds back the reader
+        queued = list(self.manager._pending.list_events.values())[0]
+        time.sleep(0.5)
+        self.assertTrue(queued.qsize() <= 10)
+        self.assertEqual(len(list(peers)), 2999)
+        # and so does one leaving the loop early
+        for peer in self.manager.iter_list_action({'Action' : 'Sippeers'},
+            buffer = 10):
+            time.sleep(0.5)
+            break
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(self.manager._pending.list_events, {})
+
+    def test_parallel_dispatch(self):
+        newstate = []
+        for k in range(6):
+            for uid in '1332366541.558', '1332366541.559':
+                newstate.append(Event
+                    ( Event            = ('Newstate',)
+                    , Channel          = ('lcr/%s' % uid[-3:],)
+                    , ChannelState     = (str(k),)
+                    , Uniqueid         = (uid,)
+                    ))
+        events = dict(Login = (self.default_events['Login'][0],) + tuple(newstate))
+        # make sure the two channels go to different workers
+        key = lambda event: int(event['Uniqueid'][-1])
+        self.run_manager(events, dispatch_workers = 4, dispatch_key = key)
+        release = threading.Event()
+        def slow(event, manager):
+            # block the events of one channel until the other is done
+            if event['Uniqueid'] == '1332366541.558':
+                release.wait(10)
+        def stop(event, manager):
+            self.handler(event, manager)
+            return True
+        self.manager.register_event('Newstate', slow)
+        self.manager.register_event('Newstate', stop)
+        self.manager.login('account', 'geheim')
+        for k in range(6):
+            self.queue.get()
+        self.assertEqual(set(e['Uniqueid'] for e in self.events),
+            set(['1332366541.559']))
+        release.set()
+        for k in range(6):
+            self.queue.get()
+        for uid in '1332366541.558', '1332366541.559':
+            self.assertEqual \
+                ( [e['ChannelState'] for e in self.events if e['Uniqueid'] == uid]
+                , [str(k) for k in range(6)]
+                )
+        # the catch-all handler is never reached
+        self.manager.close()
+        self.assertEqual(len(self.events), 12)
+
+    def test_event_predicates(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event            = ('Newstate',)
+                    , Channel          = ('SIP/100-00000001',)
+                    , Context          = ('from-internal',)
+                    )
+                , Event
+                    ( Event            = ('Newstate',)
+                    , Channel          = ('DAHDI/1-1',)
+                    , Context          = ('from-internal',)
+                    )
+                , Event
+                    ( Event            = ('Newstate',)
+                    , Channel          = ('SIP/101-00000002',)
+                    , Context          = ('from-trunk',)
+                    )
+                , Event
+                    ( Event            = ('Newstate',)
+                    , Channel          = ('SIP/102-00000003',)
+                    )
+                , Event
+                    ( Event            = ('Hangup',)
+                    , Channel          = ('SIP/100-00000001',)
+                    )
+                )
+            )
+        matched = []
+        def handler(event, manager):
+            matched.append(event['Channel'])
+        self.run_manager(events)
+        self.manager.register_event('Newstate', handler,
+            Context = 'from-internal', Channel = re.compile('^SIP/'))
+        self.manager.register_event('Newstate', handler,
+            Channel = lambda v: v.startswith('SIP/102'))
+        self.manager.login('account', 'geheim')
+        for k in range(5):
+            self.queue.get()
+        self.assertEqual(matched, ['SIP/100-00000001', 'SIP/102-00000003'])
+        self.manager.unregister_event('Newstate', handler)
+        self.assertEqual(len(self.manager._dispatch_index['Newstate']), 2)
+        self.manager.unregister_event('Newstate', handler)
+        self.manager.unregister_event('*', self.handler)
+        self.assertEqual(self.manager._dispatch_index, {})
+        self.assertEqual(self.manager._dispatch_default, ())
+
+    def test_skip_events(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('VarSet',)
+                    , Variable  = ('MACRO_DEPTH',)
+                    )
+                , Event
+                    ( Event     = ('Newexten',)
+                    , Context   = ('macro-dial-one',)
+                    )
+                , Event
+                    ( Event     = ('VarSet',)
+                    , Variable  = ('MACRO_DEPTH',)
+                    )
+                , Event
+                    ( Event     = ('Hangup',)
+                    , Channel   = ('lcr/558',)
+                    )
+                )
+            )
+        self.run_manager(events)
+        self.manager.unregister_event('*', self.handler)
+        self.manager.register_event('Hangup', self.handler)
+        self.manager.login('account', 'geheim')
+        self.queue.get()
+        self.assertEqual([e.name for e in self.events], ['Hangup'])
+        self.assertEqual(self.manager.events_skipped, 3)
+        self.assertEqual(self.manager.events_skipped_by_name,
+            dict(VarSet = 2, Newexten = 1))
+
+    def test_bounded_events(self):
+        events = dict \
+            ( Login = (self.default_events['Login'][0],) + tuple
+                ( Event
+                    ( Event     = ('Newstate',)
+                    , Uniqueid  = ('1332366541.%s' % k,)
+                    )
+                for k in range(10)
+                )
+            )
+        self.run_manager(events, max_events = 3, overflow = 'drop_oldest')
+        release = threading.Event()
+        def slow(event, manager):
+            release.wait(10)
+        self.manager.register_event('Newstate', slow)
+        self.manager.login('account', 'geheim')
+        # the first event blocks the dispatcher, wait for the rest
+        def queued():
+            stats = self.manager.queue_stats()['events']
+            return stats['size'] + stats['dropped'] + 1 >= 10
+        self.assertTrue(wait_for(queued))
+        stats = self.manager.queue_stats()['events']
+        release.set()
+        while len(self.events) + stats['dropped'] < 10:
+            self.queue.get(True, 5)
+        uids = [e['Uniqueid'][-1] for e in self.events]
+        self.assertEqual(uids[-3:], ['7', '8', '9'])
+        self.assertEqual(uids, sorted(uids))
+        stats = self.manager.queue_stats()['events']
+        self.assertEqual(stats['high_water'], 3)
+        self.assertEqual(stats['dropped_by_name'],
+            dict(Newstate = 10 - len(self.events)))
+
+    def test_stats(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('Hangup',)
+                    , Channel   = ('lcr/558',)
+                    )
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events, stats = ManagerStats())
+        self.manager.login('account', 'geheim')
+        self.manager.ping()
+        self.queue.get()
+        self.manager.close()
+        s = self.manager.stats_snapshot()
+        self.assertEqual(sorted(s['action']), ['Login', 'Logoff', 'Ping'])
+        self.assertEqual(s['action']['Ping']['count'], 1)
+        self.assertEqual(list(s['parse']), ['Hangup'])
+        # the headers were parsed while timing 'parse'
+        self.assertNotEqual(self.events[0].message._headers, None)
+        self.assertEqual(s['dispatch']['Hangup']['count'], 1)
+        self.assertEqual(list(s['callback']),
+            ['test.test_base.Test_Manager.handler'])
+        self.assertEqual(s['queues']['events']['high_water'], 1)
+        self.assertEqual(s['queues']['responses']['high_water'], 1)
+        self.manager.stats = None
+        self.assertEqual(list(self.manager.stats_snapshot()), ['queues'])
+
+    def test_reconnect(self):
+        pong = dict \
+            ( Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(pong, reconnect = True, resend = True)
+        self.manager.reconnect_delay = 0.05
+        self.manager.login('account', 'geheim')
+        # actions that never get a response from the first asterisk
+        results = Queue()
+        def action(name):
+            try:
+                results.put((name, self.manager.send_action(Action = name)))
+            except ManagerSocketException as err:
+                results.put((name, err))
+        for name in 'Status', 'Redirect':
+            t = threading.Thread(target=action, args=(name,))
+            t.setDaemon(True)
+            t.start()
+        self.assertTrue(wait_for(lambda: len(self.manager._pending) >= 2))
+        # restart asterisk
+        self.astemu.close()
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('FullyBooted',)
+                    , Status    = ('Fully Booted',)
+                    )
+                )
+            , Status =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Message   = ('Channel status will follow',)
+                    )
+                ,
+                )
+            )
+        events.update(pong)
+        self.astemu = AsteriskEmu(events, port = self.port)
+        r = dict(results.get() for k in range(2))
+        self.assertTrue(isinstance(r['Redirect'], ManagerSocketException))
+        self.assertEqual(r['Status']['Message'], 'Channel status will follow')
+        # logged in again and the callbacks are still there
+        self.queue.get()
+        self.assertEqual(self.events[0].name, 'FullyBooted')
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(self.manager.reconnects, 1)
+
+    def test_close_reconnecting(self):
+        self.run_manager({}, reconnect = True)
+        self.manager.reconnect_delay = 0.05
+        self.manager.login('account', 'geheim')
+        handshake = self.manager._handshake
+        started = threading.Event()
+        def slow_handshake(login, timeout):
+            started.set()
+            # close is called while we talk to asterisk
+            wait_for(self.manager._stop.isSet)
+            return handshake(login, timeout)
+        self.manager._handshake = slow_handshake
+        self.astemu.close()
+        self.astemu = AsteriskEmu({}, port = self.port)
+        self.assertTrue(started.wait(5))
+        t = threading.Thread(target=self.manager.close)
+        t.setDaemon(True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertFalse(self.manager.connected())
+        self.assertEqual(self.manager.reconnects, 0)
+        # no reference cycle through the patched method
+        del self.manager._handshake
+        self.manager = None
+
+    def test_connect_again(self):
+        self.run_manager({})
+        self.manager.login('account', 'geheim')
+        self.manager.close()
+        self.astemu.close()
+        self.astemu = AsteriskEmu({}, port = self.port)
+        self.manager.connect('localhost', port = self.port)
+        r = self.manager.login('account', 'geheim')
+        self.assertEqual(r['Response'], 'Success')
+
+    def test_dual(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('FullyBooted',)
+                    , Status    = ('Fully Booted',)
+                    )
+                )
+            , Sippeers =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('100',)
+                    )
+                , Event
+                    ( Event      = ('PeerlistComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    )
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events, dual = True)
+        self.assertTrue(self.manager._action_sock is not None)
+        self.manager.login('account', 'geheim')
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        r, peers = self.manager.send_list_action(Action = 'Sippeers')
+        self.assertEqual([p['ObjectName'] for p in peers], ['100'])
+        self.queue.get()
+        self.manager.close()
+        # only the event connection gets events
+        self.assertEqual([e.name for e in self.events], ['FullyBooted'])
+        self.assertEqual(self.manager._action_thread, None)
+
+    def test_dual_timeout(self):
+        # the action connection gets the timeout of connect
+        self.astemu = AsteriskEmu({})
+        self.port = self.astemu.port
+        self.manager = Manager(dual = True)
+        handshake = self.manager._handshake
+        timeouts = []
+        def record_handshake(login, timeout):
+            timeouts.append(timeout)
+            return handshake(login, timeout)
+        self.manager._handshake = record_handshake
+        self.manager.connect('localhost', port = self.port, timeout = 3)
+        self.assertEqual(timeouts, [3])
+        del self.manager._handshake
+
+    def test_event_filters(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('FullyBooted',)
+                    , Status    = ('Fully Booted',)
+                    )
+                )
+            , Filter =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Message   = ('Filter Added Successfully',)
+                    )
+                ,
+                )
+            , Events =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Events    = ('On',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        self.manager.login('account', 'geheim', events = 'off')
+        self.assertEqual(self.manager.events(['call', 'agent'])['Events'], 'On')
+        # nothing is filtered with a catch-all callback
+        self.assertEqual(self.manager.apply_event_filters(), [])
+        self.manager.unregister_event('*', self.handler)
+        self.manager.register_event('Hangup', self.handler)
+        self.manager.register_event('Newstate', self.handler)
+        self.assertEqual(self.manager.apply_event_filters(),
+            [ '^Event: Hangup[[:space:]]'
+            , '^Event: Newstate[[:space:]]'
+            ])
+        self.manager.register_event('Newchannel', self.handler)
+        self.assertEqual(self.manager.apply_event_filters(),
+            ['^Event: Newchannel[[:space:]]'])
+        self.assertTrue(self.manager.bytes_received > 0)
+        self.manager.close()
+        # logged in with Events: off
+        self.assertEqual(self.events, [])
+
+    def test_send_actions(self):
+        events = dict \
+            ( Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        actions = [{'Action' : 'Ping', 'ActionID' : 'ping-%d' % n}
+            for n in range(20)]
+        # no response for Status
+        actions.insert(5, {'Action' : 'Status'})
+        results = self.manager.send_actions(actions, timeout = 0.3)
+        self.assertEqual(len(results), 21)
+        self.assertTrue(isinstance(results[5], ManagerTimeoutException))
+        del results[5]
+        for n, r in enumerate(results):
+            self.assertEqual(r['Ping'], 'Pong')
+            self.assertEqual(r['ActionID'], 'ping-%d' % n)
+        self.assertEqual(len(self.manager._pending), 0)
+        results = dict(self.manager.iter_actions(actions[:3]))
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertEqual(results[2]['ActionID'], 'ping-2')
+
+    def test_coalesce(self):
+        events = dict \
+            ( Getvar =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Variable  = ('FOO',)
+                    , Value     = ('bar',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events, coalesce = True)
+        # ExtensionState is never answered
+        results = Queue()
+        def action():
+            try:
+                self.manager.send_action(Action = 'ExtensionState',
+                    Exten = '100', Context = 'hints', timeout = 2)
+            except ManagerTimeoutException as err:
+                results.put(err)
+        threads = [threading.Thread(target=action) for n in range(5)]
+        for t in threads:
+            t.start()
+        self.assertTrue(wait_for(lambda: self.manager.coalesced >= 4))
+        # only one is on the wire
+        self.assertEqual(len(self.manager._pending), 1)
+        for t in threads:
+            t.join()
+        self.assertEqual(results.qsize(), 5)
+        self.assertEqual(self.manager._flights, {})
+        r = self.manager.send_action(Action = 'Getvar', Variable = 'FOO')
+        self.assertEqual(r['Value'], 'bar')
+        self.assertEqual(self.manager.coalesced, 4)
+
+    def test_timeout(self):
+        events = dict \
+            ( Sippeers =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('100',)
+                    )
+                )
+            )
+        self.run_manager(events, timeout = 0.2)
+        # no response for Status
+        self.assertRaises(ManagerTimeoutException,
+            self.manager.send_action, Action = 'Status')
+        self.assertRaises(ManagerTimeoutException,
+            self.manager.send_action, {'Action' : 'Status'}, 0.1)
+        self.assertEqual(len(self.manager._pending), 0)
+        # the list is never complete
+        self.assertRaises(ManagerTimeoutException,
+            self.manager.send_list_action, Action = 'Sippeers')
+        self.assertEqual(self.manager._pending.list_events, {})
+        r = self.manager.login('account', 'geheim')
+        self.assertEqual(r['Response'], 'Success')
+
+    def test_connect_timeout(self):
+        # a server that never greets
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(1)
+        self.astemu = server
+        self.manager = Manager()
+        self.assertRaises(ManagerTimeoutException, self.manager.connect,
+            'localhost', port = server.getsockname()[1], timeout = 0.2)
+        self.assertFalse(self.manager.message_thread.is_alive())
+        self.assertFalse(self.manager.connected())
+
     def test_misc_events(self):
         d = dict
         # Events from SF bug 3470641 
@@ -481,7 +1187,7 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
         for s in events['Login'][3]['Privilege'].split('\r\n'):
             if s.startswith('Event:'):
                 evnames.append(s.split(':')[1].strip())
-        for k in xrange(30):
+        for k in range(30):
             n = self.queue.get()
             e = self.events[n]
             if n < 2:
@@ -526,9 +1232,309 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
             n = self.queue.get()
             self.compare_result(self.events[n], events['Login'][n+1])
 
+class Test_Framer(unittest.TestCase):
+    """ Test splitting of the byte stream into messages.
+    """
+
+    stream = \
+        ( b'Asterisk Call Manager/1.1\r\n'
+          b'Response: Success\r\n'
+          b'Message: Authentication accepted\r\n'
+          b'\r\n'
+          b'\r\n'
+          b'Event: FullyBooted\r\n'
+          b'Status: Fully Booted\r\n'
+          b'\r\n'
+          b'Response: Follows\r\n'
+          b'Privilege: Command\r\n'
+          b'Context \'default\' created by \'pbx_config\'\n'
+          b'\r\n'
+          b'  \'100\' =>  1. Dial(SIP/100)\n'
+          b'--END COMMAND--\r\n'
+          b'\r\n'
+          b'Event: Newexten\r\n'
+          b'AppData: Follows\r\n'
+          b'\r\n'
+        )
+
+    messages = \
+        [ 'Response: Generated Header\r\nAsterisk Call Manager/1.1\r\n'
+        , 'Response: Success\r\nMessage: Authentication accepted\r\n'
+        , 'Event: FullyBooted\r\nStatus: Fully Booted\r\n'
+        , 'Response: Follows\r\n'
+          'Privilege: Command\r\n'
+          "Context 'default' created by 'pbx_config'\n"
+          '\r\n'
+          "  '100' =>  1. Dial(SIP/100)\n"
+          '--END COMMAND--\r\n'
+        , 'Event: Newexten\r\nAppData: Follows\r\n'
+        ]
+
+    def test_chunks(self):
+        for size in 1, 2, 3, 7, 16, 1000:
+            framer = _Framer()
+            messages = []
+            for k in range(0, len(self.stream), size):
+                messages.extend(framer.feed(self.stream[k:k+size]))
+            self.assertEqual(messages, self.messages)
+            self.assertEqual(framer.title, 'Asterisk Call Manager')
+            self.assertEqual(framer.version, '1.1')
+            self.assertEqual(len(framer.buffer), 0)
+
+    def test_stream(self):
+        stream = self.stream.replace(b'Privilege: Command\r\n',
+            b'Privilege: Command\r\nActionID: 7\r\n')
+        text = self.messages[3].replace('Privilege: Command\r\n',
+            'Privilege: Command\r\nActionID: 7\r\n')
+        for size in 1, 2, 3, 7, 16, 1000:
+            framer = _Framer({'7' : None})
+            messages = []
+            for k in range(0, len(stream), size):
+                messages.extend(framer.feed(stream[k:k+size]))
+            chunks = [m for m in messages if isinstance(m, _Chunk)]
+            others = [m for m in messages if not isinstance(m, _Chunk)]
+            self.assertEqual(others, self.messages[:3] + self.messages[4:])
+            self.assertEqual(''.join(c.text for c in chunks), text)
+            self.assertEqual([c.end for c in chunks if c.end], [True])
+            self.assertTrue(chunks[-1].end)
+            self.assertEqual(set(c.actionid for c in chunks), set(['7']))
+            if size == 16:
+                # handed out while the output arrives
+                self.assertTrue(len(chunks) > 1)
+            self.assertEqual(len(framer.buffer), 0)
+
+    def test_discard(self):
+        stream = self.stream.replace(b'Privilege: Command\r\n',
+            b'Privilege: Command\r\nActionID: 7\r\n')
+        for size in 1, 2, 3, 7, 16, 1000:
+            framer = _Framer({'7' : None})
+            messages = []
+            given_up = None
+            for k in range(0, len(stream), size):
+                messages.extend(framer.feed(stream[k:k+size]))
+                if framer._stream is not None and framer.streams:
+                    # given up while the output arrives
+                    framer.streams.clear()
+                    framer.discard.add('7')
+                    given_up = len(messages)
+            if size < 1000:
+                self.assertTrue(given_up is not None)
+                self.assertFalse([m for m in messages[given_up:]
+                    if isinstance(m, _Chunk)])
+            others = [m for m in messages if not isinstance(m, _Chunk)]
+            self.assertEqual(others, self.messages[:3] + self.messages[4:])
+            self.assertEqual(framer.discard, set())
+            self.assertEqual(len(framer.buffer), 0)
+        # given up before the output arrives
+        framer = _Framer({}, set(['7']))
+        messages = framer.feed(stream)
+        self.assertEqual(messages, self.messages[:3] + self.messages[4:])
+        self.assertEqual(framer.discard, set())
+
+class Test_ManagerMsg(unittest.TestCase):
+    """ Test lazy parsing of manager messages.
+    """
+
+    raw = \
+        ( 'Event: AgentCalled\r\n'
+          'Queue: test\r\n'
+          'Variable: data1=456789\r\n'
+          'Variable: data2=test\r\n'
+        )
+
+    def test_lazy(self):
+        m = ManagerMsg(self.raw)
+        e = AmiEvent(m)
+        self.assertEqual(e.name, 'AgentCalled')
+        self.assertTrue(m.is_event())
+        self.assertEqual(m._headers, None)
+        self.assertEqual(e['Queue'], 'test')
+        self.assertEqual(e.get_header('Variable'), 'data2=test')
+        self.assertEqual(m._multiheaders, None)
+        self.assertEqual(e.multiheaders['Variable'],
+            ['data1=456789', 'data2=test'])
+        self.assertEqual(e.data, '')
+        self.assertRaises(AttributeError, setattr, e, 'foo', 1)
+        # header names are shared between messages
+        other = ManagerMsg(''.join(self.raw))
+        for k in m.headers:
+            self.assertTrue([x for x in other.headers if x is k])
+
+    def test_lines(self):
+        lines = \
+            [ 'Response: Follows\r\n'
+            , 'Privilege: Command\r\n'
+            , 'No such command\n'
+            , '--END COMMAND--\r\n'
+            ]
+        m = ManagerMsg(lines)
+        self.assertFalse(m.is_event())
+        self.assertEqual(m.response, lines)
+        self.assertEqual(m['Response'], 'Follows')
+        self.assertEqual(m.multiheaders['Privilege'], ['Command'])
+        self.assertEqual(m.data, ''.join(lines[2:]))
+        m = ManagerMsg(lines[2:])
+        self.assertEqual(m['Event'], 'NoClue')
+        self.assertEqual(m.multiheaders['Event'], ['NoClue'])
+
+    def test_response_event(self):
+        # any message with an Event header is an event
+        raw = 'Response: Success\r\nEvent: Test\r\nActionID: 1\r\n'
+        m = ManagerMsg(raw)
+        self.assertTrue(m.is_event())
+        self.assertEqual(AmiEvent(m).name, 'Test')
+        m = ManagerMsg('Response: Success\r\n')
+        self.assertFalse(m.is_event())
+        self.assertRaises(ManagerException, AmiEvent, m)
+
+    def test_parse(self):
+        m = ManagerMsg('Response: Success\r\n')
+        m.parse()
+        self.assertEqual(m.headers, dict(Response = 'Success'))
+        m.parse(['Event: Test\r\n', 'Queue: test\r\n'])
+        self.assertEqual(m['Queue'], 'test')
+        self.assertEqual(m.multiheaders['Event'], ['Test'])
+        self.assertTrue(m.is_event())
+
+class Test_OverflowQueue(unittest.TestCase):
+    """ Test the overflow policies of bounded queues.
+    """
+
+    priorities = dict(Hangup = 2, Newstate = 1)
+
+    def fill(self, policy, items):
+        name = lambda item: item[0] if item[0] != 'Response' else None
+        q = _OverflowQueue(3, policy, name, self.priorities)
+        for k, item in enumerate(items):
+            q.put((item, k))
+        result = []
+        while not q.empty():
+            result.append(q.get())
+        return q, result
+
+    def test_policies(self):
+        items = ['Newstate', 'VarSet', 'Response', 'Hangup', 'VarSet']
+        q, r = self.fill('drop_oldest', items)
+        self.assertEqual(r, [('Response', 2), ('Hangup', 3), ('VarSet', 4)])
+        self.assertEqual(q.dropped_by_name, dict(Newstate = 1, VarSet = 1))
+        q, r = self.fill('drop_newest', items)
+        self.assertEqual(r, [('Newstate', 0), ('VarSet', 1), ('Response', 2)])
+        self.assertEqual(q.dropped_by_name, dict(Hangup = 1, VarSet = 1))
+        q, r = self.fill('priority', items)
+        self.assertEqual(r, [('Newstate', 0), ('Response', 2), ('Hangup', 3)])
+        self.assertEqual(q.dropped_by_name, dict(VarSet = 2))
+        self.assertEqual(q.stats()['high_water'], 3)
+        self.assertRaises(ValueError, _OverflowQueue, 3, 'drop_random')
+
+    def test_keep(self):
+        # responses and the terminating None are never dropped
+        q, r = self.fill('drop_oldest', ['Response'] * 5)
+        self.assertEqual(len(r), 5)
+        self.assertEqual(q.dropped, 0)
+        q.put(None)
+        self.assertEqual(q.get(), None)
+
+    def test_block_timeout(self):
+        q = _OverflowQueue(2)
+        q.put(1)
+        q.put(2)
+        self.assertRaises(Full, q.put, 3, False)
+        start = time.time()
+        self.assertRaises(Full, q.put, 3, True, 0.1)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get(), 1)
+        q.put(3, True, 0.1)
+        self.assertEqual([q.get(), q.get()], [2, 3])
+
+    def test_join(self):
+        # dropped items don't keep join waiting
+        for policy in 'drop_oldest', 'drop_newest', 'priority':
+            q, r = self.fill(policy, ['Newstate', 'VarSet', 'Hangup',
+                'VarSet', 'Newstate'])
+            for item in r:
+                q.task_done()
+            self.assertEqual(q.unfinished_tasks, 0)
+            q.join()
+
+    def model(self, policy, ops):
+        """The items left by the policies, scanning the whole queue"""
+        name = lambda item: item[0] if item[0] != 'Response' else None
+        queue = []
+        result = []
+        for op in ops:
+            if op is None:
+                if queue:
+                    result.append(queue.pop(0))
+                continue
+            if len(queue) >= 3:
+                names = [(n, name(x)) for n, x in enumerate(queue)
+                    if name(x) is not None]
+                if name(op) is not None:
+                    names.append((None, name(op)))
+                if names:
+                    if policy == 'drop_newest':
+                        n = names[-1][0]
+                    elif policy == 'drop_oldest':
+                        n = names[0][0]
+                    else:
+                        n = min(names,
+                            key = lambda x: self.priorities.get(x[1], 0))[0]
+                    if n is None:
+                        continue
+                    del queue[n]
+            queue.append(op)
+        return result + queue
+
+    def test_model(self):
+        rnd = random.Random(4711)
+        names = ['Newstate', 'VarSet', 'Response', 'Hangup']
+        for policy in 'drop_oldest', 'drop_newest', 'priority':
+            ops = [None if rnd.random() < 0.3
+                else (rnd.choice(names), k) for k in range(2000)]
+            q = _OverflowQueue(3, policy,
+                lambda item: item[0] if item[0] != 'Response' else None,
+                self.priorities)
+            result = []
+            for op in ops:
+                if op is None:
+                    if not q.empty():
+                        result.append(q.get())
+                else:
+                    q.put(op)
+            while not q.empty():
+                result.append(q.get())
+            self.assertEqual(result, self.model(policy, ops))
+
+    def test_stale(self):
+        # dropped items stuck behind a response don't pile up
+        q = _OverflowQueue(3, 'drop_oldest', lambda item: item or None)
+        q.put('')
+        for k in range(1000):
+            q.put('VarSet')
+        self.assertEqual(q.qsize(), 3)
+        self.assertTrue(len(q.queue) < 10)
+        self.assertEqual([q.get() for k in range(3)], ['', 'VarSet', 'VarSet'])
+        self.assertTrue(q.empty())
+
+    def test_block(self):
+        q = _OverflowQueue(1, 'block')
+        q.put(1)
+        t = threading.Thread(target=q.put, args=(2,))
+        t.start()
+        self.assertTrue(wait_for(lambda: q.blocked))
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get(), 1)
+        t.join()
+        self.assertEqual(q.get(), 2)
+        self.assertEqual(q.stats()['high_water'], 1)
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest (unittest.makeSuite (Test_Manager))
+    suite.addTest (unittest.makeSuite (Test_Framer))
+    suite.addTest (unittest.makeSuite (Test_ManagerMsg))
+    suite.addTest (unittest.makeSuite (Test_OverflowQueue))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+import unittest
+from   asterisk.manager import Manager, ManagerMsg, ManagerTimeoutException
+from   asterisk.cache import ActionCache
+from   asterisk.compat import Queue
+from   asterisk.astemu import Event, AsteriskEmu
+
+def message(text):
+    return ManagerMsg(text.replace('\n', '\r\n') + '\r\n')
+
+class Test_ActionCache(unittest.TestCase):
+    """ Test the response cache of read-only actions.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ActionCache(size = 2, ttl = 10,
+            ttls = {'SIPshowpeer' : 1}, clock = lambda: self.now)
+
+    def lookup(self, **cdict):
+        response, ticket = self.cache.get(cdict)
+        if response is None and ticket is not None:
+            self.cache.put(ticket, message('Response: Success\n'))
+        return response
+
+    def test_ttl_lru(self):
+        self.assertEqual(self.lookup(Action = 'MailboxCount', Mailbox = '100'),
+            None)
+        self.assertNotEqual(self.lookup(Action = 'MailboxCount',
+            Mailbox = '100'), None)
+        self.lookup(Action = 'SIPshowpeer', Peer = '100')
+        self.now += 2
+        # expired
+        self.assertEqual(self.lookup(Action = 'SIPshowpeer', Peer = '100'),
+            None)
+        self.assertNotEqual(self.lookup(Action = 'MailboxCount',
+            Mailbox = '100'), None)
+        self.lookup(Action = 'ExtensionState', Exten = '100', Context = 'h')
+        # the least recently used peer was evicted
+        self.assertNotEqual(self.lookup(Action = 'MailboxCount',
+            Mailbox = '100'), None)
+        self.assertEqual(self.lookup(Action = 'SIPshowpeer', Peer = '100'),
+            None)
+        self.assertEqual(len(self.cache), 2)
+        s = self.cache.cache_stats()
+        self.assertEqual(s['evictions'], 2)
+        self.assertEqual(s['hits'], 3)
+        # not cached
+        self.assertEqual(self.cache.get({'Action' : 'Originate'}),
+            (None, None))
+        self.assertEqual(self.cache.get({'Action' : 'MailboxCount',
+            'Mailbox' : '100', 'ActionID' : 'x'}), (None, None))
+
+    def test_invalidate(self):
+        self.lookup(Action = 'MailboxCount', Mailbox = '100')
+        self.lookup(Action = 'SIPshowpeer', Peer = '100')
+        self.cache.invalidate(('mailbox', '100@default'))
+        self.assertEqual(len(self.cache), 1)
+        # an action on the way while its state changes is not stored
+        response, ticket = self.cache.get({'Action' : 'SIPshowpeer',
+            'Peer' : '200'})
+        self.cache.invalidate(('peer', '200'))
+        self.cache.put(ticket, message('Response: Success\n'))
+        self.assertEqual(len(self.cache), 1)
+        response, ticket = self.cache.get({'Action' : 'SIPshowpeer',
+            'Peer' : '200'})
+        self.cache.clear()
+        self.cache.put(ticket, message('Response: Success\n'))
+        self.assertEqual(len(self.cache), 0)
+        # states without actions on the way are not remembered
+        for n in range(100):
+            self.cache.invalidate(('peer', str(n)))
+        response, ticket = self.cache.get({'Action' : 'SIPshowpeer',
+            'Peer' : '300'})
+        self.cache.put(ticket, None)
+        self.assertEqual(self.cache._generations, {})
+
+    def test_manager(self):
+        events = dict \
+            ( MailboxCount =
+                ( Event
+                    ( Response     = ('Success',)
+                    , Mailbox      = ('100@default',)
+                    , NewMessages  = ('1',)
+                    )
+                ,
+                )
+            , Ping =
+                ( Event
+                    ( Response     = ('Success',)
+                    , Ping         = ('Pong',)
+                    )
+                , Event
+                    ( Event        = ('MessageWaiting',)
+                    , Mailbox      = ('100@default',)
+                    , Waiting      = ('1',)
+                    )
+                )
+            )
+        astemu = AsteriskEmu(events)
+        manager = Manager(cache = self.cache)
+        try:
+            manager.connect('localhost', port = astemu.port)
+            seen = Queue()
+            manager.register_event('MessageWaiting',
+                lambda event, manager: seen.put(event))
+            r = manager.mailbox_count('100')
+            self.assertTrue(manager.mailbox_count('100') is r)
+            self.assertEqual(self.cache.cache_stats()['hits'], 1)
+            manager.ping()
+            seen.get(True, 5)
+            self.assertEqual(len(self.cache), 0)
+            self.assertFalse(manager.mailbox_count('100') is r)
+            # the ticket of a failed action is returned
+            self.assertRaises(ManagerTimeoutException, manager.send_action,
+                Action = 'SIPshowpeer', Peer = '100', timeout = 0.1)
+            self.assertEqual(self.cache._generations, {})
+        finally:
+            manager.close()
+            astemu.close()
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ActionCache))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
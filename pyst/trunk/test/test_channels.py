@@ -0,0 +1,187 @@
+import unittest
+from   asterisk.manager import Manager
+from   asterisk.channels import ChannelRegistry
+from   asterisk.compat import Queue
+from   asterisk.astemu import Event, AsteriskEmu
+from   test.test_base import wait_for
+
+class Test_ChannelRegistry(unittest.TestCase):
+    """ Test the live channel table.
+    """
+
+    default_events = AsteriskEmu.default_events
+
+    def setUp(self):
+        self.astemu  = None
+        self.manager = None
+        self.events  = []
+        self.queue   = Queue()
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def handler(self, event, manager):
+        self.events.append(event)
+        self.queue.put(event)
+
+    def channel(self, name, uniqueid):
+        return Event \
+            ( Event            = ('CoreShowChannel',)
+            , ActionID         = ('',)
+            , Channel          = (name,)
+            , Uniqueid         = (uniqueid,)
+            , Linkedid         = ('1332366541.1',)
+            , ChannelStateDesc = ('Ring',)
+            )
+
+    def test_registry(self):
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event
+                    ( Event     = ('FullyBooted',)
+                    , Status    = ('Fully Booted',)
+                    )
+                )
+            , CoreShowChannels =
+                ( Event
+                    ( Response  = ('Success',)
+                    , EventList = ('start',)
+                    )
+                , self.channel('SIP/100-00000001', '1332366541.1')
+                , self.channel('SIP/200-00000002', '1332366541.2')
+                , Event
+                    ( Event     = ('CoreShowChannelsComplete',)
+                    , ActionID  = ('',)
+                    , EventList = ('Complete',)
+                    )
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                , Event
+                    ( Event     = ('Newchannel',)
+                    , Channel   = ('Local/300@default-00000001;1',)
+                    , Uniqueid  = ('1332366541.3',)
+                    , Linkedid  = ('1332366541.3',)
+                    , ChannelStateDesc = ('Down',)
+                    )
+                , Event
+                    ( Event     = ('Newstate',)
+                    , Channel   = ('SIP/100-00000001',)
+                    , Uniqueid  = ('1332366541.1',)
+                    , ChannelStateDesc = ('Up',)
+                    )
+                , Event
+                    ( Event     = ('Rename',)
+                    , Channel   = ('SIP/200-00000002',)
+                    , Newname   = ('SIP/300-00000002',)
+                    , Uniqueid  = ('1332366541.2',)
+                    )
+                , Event
+                    ( Event     = ('Hangup',)
+                    , Channel   = ('SIP/100-00000001',)
+                    , Uniqueid  = ('1332366541.1',)
+                    )
+                )
+            )
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        channels = ChannelRegistry(self.manager, seed = False)
+        self.manager.register_event('*', self.handler)
+        self.manager.login('account', 'geheim')
+        # loaded when asterisk is fully booted
+        self.assertEqual(self.queue.get().name, 'FullyBooted')
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(channels.get('1332366541.1')['Channel'],
+            'SIP/100-00000001')
+        self.assertEqual(sorted(c['Uniqueid']
+            for c in channels.by_linkedid('1332366541.1')),
+            ['1332366541.1', '1332366541.2'])
+        first = channels.by_channel('SIP/100-00000001')
+        self.manager.ping()
+        for k in range(4):
+            self.queue.get()
+        self.assertEqual(len(channels), 2)
+        self.assertFalse('1332366541.1' in channels)
+        self.assertEqual(channels.by_channel('SIP/100-00000001'), None)
+        self.assertEqual(channels.by_channel('SIP/200-00000002'), None)
+        c = channels.by_channel('SIP/300-00000002')
+        self.assertEqual(c['Uniqueid'], '1332366541.2')
+        self.assertFalse('Newname' in c)
+        self.assertEqual([c['Uniqueid']
+            for c in channels.by_linkedid('1332366541.1')], ['1332366541.2'])
+        c = channels.by_channel('Local/300@default-00000001;1')
+        self.assertEqual(c['ChannelStateDesc'], 'Down')
+        # channels are replaced, not modified
+        self.assertEqual(first['ChannelStateDesc'], 'Ring')
+        channels.detach()
+        self.assertEqual(self.manager._dispatch_index.get('Newstate'), None)
+
+    def test_seed_race(self):
+        events = dict \
+            ( CoreShowChannels =
+                ( Event
+                    ( Response  = ('Success',)
+                    , EventList = ('start',)
+                    )
+                , self.channel('SIP/100-00000001', '1332366541.1')
+                , Event
+                    ( Event     = ('CoreShowChannelsComplete',)
+                    , ActionID  = ('',)
+                    , EventList = ('Complete',)
+                    )
+                )
+            , Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                , Event
+                    ( Event     = ('Newchannel',)
+                    , Channel   = ('SIP/200-00000002',)
+                    , Uniqueid  = ('1332366541.2',)
+                    , ChannelStateDesc = ('Down',)
+                    )
+                , Event
+                    ( Event     = ('Newstate',)
+                    , Channel   = ('SIP/100-00000001',)
+                    , Uniqueid  = ('1332366541.1',)
+                    , ChannelStateDesc = ('Up',)
+                    )
+                )
+            )
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        channels = ChannelRegistry(self.manager, seed = False)
+        send_list_action = self.manager.send_list_action
+        def snapshot(*args, **kw):
+            result = send_list_action(*args, **kw)
+            # events arriving while the snapshot is on the way
+            self.manager.ping()
+            self.assertTrue(wait_for(lambda: '1332366541.2' in channels
+                and channels.get('1332366541.1')['ChannelStateDesc'] == 'Up'))
+            return result
+        self.manager.send_list_action = snapshot
+        channels.seed()
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(channels.by_channel('SIP/200-00000002')['Uniqueid'],
+            '1332366541.2')
+        self.assertEqual(channels.get('1332366541.1')['ChannelStateDesc'], 'Up')
+        self.assertEqual(channels._seed_events, None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ChannelRegistry))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from   asterisk.manager import Manager, ManagerTimeoutException
+from   asterisk.cluster import Cluster, is_error
+from   asterisk.astemu import Event, AsteriskEmu
+
+class Test_Cluster(unittest.TestCase):
+    """ Test actions on many managers at once.
+    """
+
+    scripts = dict \
+        ( a = {}
+        , b = dict
+            ( SIPshowpeer =
+                ( Event
+                    ( Response    = ('Success',)
+                    , ObjectName  = ('100',)
+                    )
+                ,
+                )
+            )
+        , c = dict
+            ( SIPshowpeer =
+                ( Event
+                    ( Response    = ('Error',)
+                    , Message     = ('Peer 100 not found.',)
+                    )
+                ,
+                )
+            )
+        )
+
+    def setUp(self):
+        self.emus = []
+        self.cluster = Cluster(timeout = 0.5)
+        for name, script in sorted(self.scripts.items()):
+            emu = AsteriskEmu(script)
+            self.emus.append(emu)
+            manager = Manager()
+            manager.connect('localhost', port = emu.port)
+            self.cluster.add(name, manager)
+
+    def tearDown(self):
+        for name in self.cluster:
+            self.cluster[name].close()
+        for emu in self.emus:
+            emu.close()
+
+    def test_send_action(self):
+        results = self.cluster.send_action(Action = 'SIPshowpeer', Peer = '100')
+        self.assertEqual(list(results), ['a', 'b', 'c'])
+        # a never answers
+        self.assertTrue(isinstance(results['a'], ManagerTimeoutException))
+        self.assertEqual(results['b']['ObjectName'], '100')
+        self.assertEqual(results['c']['Response'], 'Error')
+        self.assertEqual([is_error(r) for r in results.values()],
+            [True, False, True])
+        results = self.cluster.send_action({'Action' : 'SIPshowpeer'},
+            servers = ['c'])
+        self.assertEqual(list(results), ['c'])
+
+    def test_first(self):
+        name, response = self.cluster.first(Action = 'SIPshowpeer')
+        self.assertEqual(name, 'b')
+        self.assertEqual(self.cluster.first
+            (Action = 'SIPshowpeer', servers = ['a', 'c'], timeout = 0.2),
+            None)
+        results = self.cluster.call(lambda manager: manager.title)
+        self.assertEqual(set(results.values()), set(['Asterisk Call Manager']))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_Cluster))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import socket
+import threading
+import unittest
+from   asterisk.manager import ManagerException
+from   asterisk.multiplex import Multiplexer
+from   asterisk.compat import Queue
+from   asterisk.astemu import Event, AsteriskEmu
+
+def chatscript(name):
+    return dict \
+        ( Ping =
+            ( Event
+                ( Response  = ('Success',)
+                , Ping      = ('Pong',)
+                )
+            , Event
+                ( Event     = ('Newchannel',)
+                , Channel   = ('SIP/%s-00000001' % name,)
+                )
+            )
+        , Sippeers =
+            ( Event
+                ( Response   = ('Success',)
+                , EventList  = ('start',)
+                )
+            , Event
+                ( Event      = ('PeerEntry',)
+                , ActionID   = ('',)
+                , ObjectName = (name,)
+                )
+            , Event
+                ( Event      = ('PeerlistComplete',)
+                , ActionID   = ('',)
+                , EventList  = ('Complete',)
+                )
+            )
+        )
+
+class Test_Multiplexer(unittest.TestCase):
+    """ Test many manager connections in one thread.
+    """
+
+    def setUp(self):
+        self.emus = {}
+        self.events = Queue()
+        self.mux = Multiplexer(timeout = 5)
+        self.mux.reconnect_delay = 0.05
+        self.mux.register_event('*', self.handler)
+        for name in 'a', 'b':
+            self.emus[name] = AsteriskEmu(chatscript(name))
+            self.mux.add_server(name, 'localhost', self.emus[name].port,
+                username = 'account', secret = 'geheim')
+        self.mux.start()
+        for server in self.mux:
+            self.assertTrue(server.wait_connected(5))
+
+    def tearDown(self):
+        self.mux.close()
+        for emu in self.emus.values():
+            emu.close()
+
+    def handler(self, event, server):
+        self.events.put((server.name, event))
+
+    def test_actions(self):
+        for name in 'a', 'b':
+            r = self.mux.server(name).ping()
+            self.assertEqual(r['Ping'], 'Pong')
+            server, event = self.events.get(True, 5)
+            self.assertEqual(server, name)
+            self.assertEqual(event['Channel'], 'SIP/%s-00000001' % name)
+        response, peers = self.mux.server('b').send_list_action \
+            (Action = 'Sippeers')
+        self.assertEqual([p['ObjectName'] for p in peers], ['b'])
+        self.assertEqual(self.mux.server('a').title, 'Asterisk Call Manager')
+
+    def test_queue_action(self):
+        results = Queue()
+        def pong(response, server):
+            results.put((server.name, response['Ping']))
+            # waiting for a response would block the I/O thread
+            try:
+                server.ping()
+            except ManagerException as err:
+                results.put(err)
+        self.mux.server('a').queue_action(Action = 'Ping', callback = pong)
+        self.assertEqual(results.get(True, 5), ('a', 'Pong'))
+        self.assertTrue(isinstance(results.get(True, 5), ManagerException))
+
+    def test_reconnect(self):
+        server = self.mux.server('a')
+        port = self.emus['a'].port
+        self.emus['a'].close()
+        self.assertRaises(ManagerException, server.ping)
+        self.emus['a'] = AsteriskEmu(chatscript('a'), port)
+        self.assertTrue(server.wait_connected(5))
+        self.assertEqual(server.ping()['Ping'], 'Pong')
+        self.assertTrue(server.reconnects >= 1)
+        # the other server didn't notice
+        self.assertEqual(self.mux.server('b').reconnects, 0)
+        self.mux.remove_server('a')
+        self.assertFalse('a' in self.mux)
+
+    def test_slow_lookup(self):
+        # resolving an address doesn't hold up the other servers
+        lookup = socket.getaddrinfo
+        release = threading.Event()
+        def getaddrinfo(host, *args):
+            if host == 'slow':
+                release.wait(5)
+                raise socket.gaierror('slow lookup failed')
+            return lookup(host, *args)
+        socket.getaddrinfo = getaddrinfo
+        try:
+            self.mux.add_server('c', 'slow', 5038)
+            for name in 'a', 'b':
+                r = self.mux.server(name).send_action \
+                    (Action = 'Ping', timeout = 2)
+                self.assertEqual(r['Ping'], 'Pong')
+        finally:
+            release.set()
+            socket.getaddrinfo = lookup
+        self.mux.remove_server('c')
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_Multiplexer))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
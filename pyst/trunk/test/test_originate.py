@@ -0,0 +1,98 @@
+import time
+import unittest
+from   asterisk.manager import Manager, ManagerException
+from   asterisk.originate import OriginateEngine, channel_trunk
+from   asterisk.astemu import Event, AsteriskEmu
+
+class Test_OriginateEngine(unittest.TestCase):
+    """ Test the bulk originate engine.
+    """
+
+    def setUp(self):
+        self.astemu = self.manager = self.engine = None
+
+    def run_engine(self, response, reason = '4', **kw):
+        originate = \
+            [ Event
+                ( Response  = (response,)
+                , Message   = ('Originate successfully queued',)
+                )
+            ]
+        if response == 'Success':
+            originate.append(Event
+                ( Event     = ('OriginateResponse',)
+                , ActionID  = ('',)
+                , Response  = (reason == '4' and 'Success' or 'Failure',)
+                , Reason    = (reason,)
+                ))
+        events = dict(Originate = originate)
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.engine = OriginateEngine(self.manager, **kw)
+
+    def tearDown(self):
+        if self.engine:
+            self.engine.close()
+            self.manager.close()
+            self.astemu.close()
+
+    def specs(self, trunk, n):
+        return [{'Channel' : 'SIP/%s/%d' % (trunk, k), 'Exten' : 's'}
+            for k in range(n)]
+
+    def test_campaign(self):
+        self.run_engine('Success', concurrency = 3, rate = 1000, burst = 5,
+            trunk_limits = {'SIP/b' : 1})
+        done = []
+        calls = self.engine.run(self.specs('a', 20) + self.specs('b', 5),
+            callback = done.append)
+        self.assertEqual(len(calls), 25)
+        self.assertEqual(len(done), 25)
+        self.assertTrue(all(call.success for call in calls))
+        self.assertEqual(calls[0].reason, '4')
+        self.assertEqual(calls[-1].trunk, 'SIP/b')
+        self.assertEqual(calls[-1].result()['Reason'], '4')
+        s = self.engine.snapshot()
+        self.assertEqual(s['sent'], 25)
+        self.assertEqual(s['succeeded'], 25)
+        self.assertEqual(s['inflight'], 0)
+        self.assertTrue(s['peak_inflight'] <= 3)
+
+    def test_rate(self):
+        self.run_engine('Success', concurrency = 10, rate = 20)
+        start = time.time()
+        self.engine.run(self.specs('a', 5))
+        # the first call goes out right away
+        self.assertTrue(time.time() - start >= 4 / 20.0 * 0.9)
+
+    def test_slow_down(self):
+        self.run_engine('Error', concurrency = 2, rate = 50)
+        calls = self.engine.run(self.specs('a', 3))
+        self.assertTrue(isinstance(calls[0].error, ManagerException))
+        self.assertRaises(ManagerException, calls[0].result)
+        s = self.engine.snapshot()
+        self.assertEqual(s['failed'], 3)
+        # halved once, the following errors are within backoff_interval
+        self.assertEqual(s['rate'], 25)
+        self.assertEqual(s['slowdowns'], 1)
+
+    def test_congestion(self):
+        self.run_engine('Success', reason = '8', rate = 50)
+        call, = self.engine.run(self.specs('a', 1))
+        self.assertFalse(call.success)
+        self.assertEqual(call.reason, '8')
+        self.assertEqual(self.engine.snapshot()['slowdowns'], 1)
+
+    def test_channel_trunk(self):
+        self.assertEqual(channel_trunk('SIP/provider/0123'), 'SIP/provider')
+        self.assertEqual(channel_trunk('PJSIP/0123@provider'), 'PJSIP/provider')
+        self.assertEqual(channel_trunk('SIP/100'), 'SIP/100')
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_OriginateEngine))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
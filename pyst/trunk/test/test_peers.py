@@ -0,0 +1,256 @@
+import unittest
+from   asterisk.manager import Manager
+from   asterisk.peers import PeerRegistry, peer_state, split_address
+from   asterisk.compat import Queue
+from   asterisk.astemu import Event, AsteriskEmu
+from   test.test_base import wait_for
+
+class Test_PeerRegistry(unittest.TestCase):
+    """ Test the SIP/PJSIP peer table.
+    """
+
+    default_events = AsteriskEmu.default_events
+
+    def setUp(self):
+        self.astemu  = None
+        self.manager = None
+        self.queue   = Queue()
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def handler(self, event, manager):
+        self.queue.put(event)
+
+    def test_helpers(self):
+        self.assertEqual(peer_state('OK (5 ms)'), 'reachable')
+        self.assertEqual(peer_state('UNREACHABLE'), 'unreachable')
+        self.assertEqual(peer_state('Unregistered'), 'unregistered')
+        self.assertEqual(peer_state('Registered'), 'registered')
+        self.assertEqual(peer_state(None), 'unknown')
+        self.assertEqual(split_address('192.0.2.1:5060'), ('192.0.2.1', '5060'))
+        self.assertEqual(split_address('[2001:db8::1]:5061'),
+            ('2001:db8::1', '5061'))
+        self.assertEqual(split_address('sip:100@192.0.2.1:5060;ob'),
+            ('192.0.2.1', '5060'))
+        self.assertEqual(split_address('-none-'), (None, None))
+
+    def test_registry(self):
+        events = dict \
+            ( Sippeers =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , Channeltype = ('SIP',)
+                    , ObjectName = ('100',)
+                    , IPaddress  = ('192.0.2.1',)
+                    , IPport     = ('5060',)
+                    , Status     = ('OK (5 ms)',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , Channeltype = ('SIP',)
+                    , ObjectName = ('trunk1',)
+                    , IPaddress  = ('-none-',)
+                    , IPport     = ('0',)
+                    , Status     = ('UNREACHABLE',)
+                    )
+                , Event
+                    ( Event      = ('PeerlistComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    )
+                )
+            , PJSIPShowEndpoints =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                , Event
+                    ( Event      = ('EndpointList',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('200',)
+                    , Contacts   = ('200/sip:200@192.0.2.1:5062,',)
+                    , DeviceState = ('Not in use',)
+                    )
+                , Event
+                    ( Event      = ('EndpointListComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    )
+                )
+            , SIPshowregistry =
+                ( Event
+                    ( Response   = ('Error',)
+                    , Message    = ('Invalid/unknown command',)
+                    )
+                ,
+                )
+            , SIPshowpeer =
+                ( Event
+                    ( Response   = ('Success',)
+                    , ObjectName = ('100',)
+                    , Context    = ('from-internal',)
+                    , Status     = ('OK (6 ms)',)
+                    )
+                ,
+                )
+            , Ping =
+                ( Event
+                    ( Response   = ('Success',)
+                    , Ping       = ('Pong',)
+                    )
+                , Event
+                    ( Event      = ('PeerStatus',)
+                    , ChannelType = ('SIP',)
+                    , Peer       = ('SIP/trunk1',)
+                    , PeerStatus = ('Registered',)
+                    , Address    = ('198.51.100.7:5060',)
+                    )
+                , Event
+                    ( Event      = ('PeerStatus',)
+                    , ChannelType = ('SIP',)
+                    , Peer       = ('SIP/100',)
+                    , PeerStatus = ('Unreachable',)
+                    , Time       = ('-1',)
+                    )
+                , Event
+                    ( Event      = ('ContactStatus',)
+                    , URI        = ('sip:200@192.0.2.1:5062',)
+                    , ContactStatus = ('Removed',)
+                    , AOR        = ('200',)
+                    , EndpointName = ('200',)
+                    )
+                , Event
+                    ( Event      = ('Registry',)
+                    , ChannelType = ('SIP',)
+                    , Username   = ('4930123',)
+                    , Domain     = ('sip.example.com',)
+                    , Status     = ('Registered',)
+                    )
+                )
+            )
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        peers = PeerRegistry(self.manager)
+        changes = []
+        peers.add_listener(lambda peer, old, new: changes.append(peer))
+        self.manager.register_event('*', self.handler)
+        self.assertEqual(len(peers), 3)
+        self.assertEqual(peers.get('100')['Address'], '192.0.2.1')
+        self.assertEqual(peers.get('SIP/trunk1')['Address'], None)
+        self.assertEqual(peers.get('200')['Port'], '5062')
+        self.assertEqual(sorted(p['Peer'] for p in peers.by_state('reachable')),
+            ['PJSIP/200', 'SIP/100'])
+        self.assertEqual(sorted(p['Peer'] for p in peers.by_address('192.0.2.1')),
+            ['PJSIP/200', 'SIP/100'])
+        # the details are only fetched once
+        self.assertEqual(peers.show('SIP/100')['Context'], 'from-internal')
+        self.assertEqual(peers.show('SIP/100')['Status'], 'OK (5 ms)')
+
+        self.manager.ping()
+        for k in range(4):
+            self.queue.get()
+        self.assertEqual(changes, ['SIP/trunk1', 'SIP/100', 'PJSIP/200'])
+        trunk = peers.get('trunk1')
+        self.assertEqual((trunk['State'], trunk['Address'], trunk['Port']),
+            ('registered', '198.51.100.7', '5060'))
+        self.assertEqual([p['Peer'] for p in peers.by_state('unreachable')],
+            ['SIP/100'])
+        # still known with its details
+        self.assertEqual(peers.get('100')['Context'], 'from-internal')
+        self.assertEqual(peers.get('200')['State'], 'unregistered')
+        self.assertEqual(peers.by_address('192.0.2.1'),
+            [peers.get('SIP/100')])
+        self.assertEqual(peers.registrations['4930123@sip.example.com']
+            ['Status'], 'Registered')
+
+    def test_seed_race(self):
+        events = dict \
+            ( Sippeers =
+                ( Event
+                    ( Response   = ('Success',)
+                    , EventList  = ('start',)
+                    )
+                , Event
+                    ( Event      = ('PeerEntry',)
+                    , ActionID   = ('',)
+                    , ObjectName = ('100',)
+                    , IPaddress  = ('192.0.2.1',)
+                    , IPport     = ('5060',)
+                    , Status     = ('OK (5 ms)',)
+                    )
+                , Event
+                    ( Event      = ('PeerlistComplete',)
+                    , ActionID   = ('',)
+                    , EventList  = ('Complete',)
+                    )
+                )
+            , Ping =
+                ( Event
+                    ( Response   = ('Success',)
+                    , Ping       = ('Pong',)
+                    )
+                , Event
+                    ( Event      = ('PeerStatus',)
+                    , Peer       = ('SIP/100',)
+                    , PeerStatus = ('Unreachable',)
+                    )
+                , Event
+                    ( Event      = ('PeerStatus',)
+                    , Peer       = ('SIP/300',)
+                    , PeerStatus = ('Registered',)
+                    , Address    = ('192.0.2.3:5060',)
+                    )
+                )
+            )
+        for action in 'PJSIPShowEndpoints', 'SIPshowregistry':
+            events[action] = \
+                ( Event
+                    ( Response   = ('Error',)
+                    , Message    = ('Invalid/unknown command',)
+                    )
+                ,
+                )
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager(timeout = 5)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        peers = PeerRegistry(self.manager, seed = False)
+        changes = []
+        peers.add_listener(lambda peer, old, new: changes.append(peer))
+        send_list_action = self.manager.send_list_action
+        def snapshot(*args, **kw):
+            result = send_list_action(*args, **kw)
+            if kw.get('Action') == 'SIPshowregistry':
+                # updates arriving while the peers are loaded
+                self.manager.ping()
+                self.assertTrue(wait_for(lambda: 'SIP/300' in peers))
+            return result
+        self.manager.send_list_action = snapshot
+        peers.seed()
+        self.assertEqual(sorted(p['Peer'] for p in peers), ['SIP/100', 'SIP/300'])
+        self.assertEqual(peers.get('100')['State'], 'unreachable')
+        self.assertEqual(peers.get('100')['Address'], '192.0.2.1')
+        self.assertEqual(peers.get('300')['Address'], '192.0.2.3')
+        # live updates and the seed itself were reported
+        self.assertEqual(changes, ['SIP/100', 'SIP/300', 'SIP/100'])
+        self.assertEqual(peers._seed_updates, None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_PeerRegistry))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import unittest
+from   asterisk.manager import ManagerException, ManagerTimeoutException
+from   asterisk.manager import ManagerSocketException
+from   asterisk.pool import ManagerPool
+from   asterisk.compat import Queue
+from   asterisk.astemu import Event, AsteriskEmu
+from   test.test_base import wait_for
+
+class Test_ManagerPool(unittest.TestCase):
+    """ Test the pool of manager sessions.
+    """
+
+    events = dict \
+        ( Ping =
+            ( Event
+                ( Response  = ('Success',)
+                , Ping      = ('Pong',)
+                )
+            ,
+            )
+        )
+
+    def setUp(self):
+        self.astemu = AsteriskEmu(self.events)
+        self.pool = ManagerPool('localhost', self.astemu.port,
+            username = 'account', secret = 'geheim', size = 3, timeout = 5)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.close()
+        self.astemu.close()
+
+    def test_routing(self):
+        self.assertEqual(self.pool.ping()['Ping'], 'Pong')
+        # actions that are never answered keep their session busy
+        results = Queue()
+        def status():
+            try:
+                self.pool.send_action({'Action' : 'Status'}, 2)
+            except ManagerTimeoutException as err:
+                results.put(err)
+        threads = [threading.Thread(target=status) for n in range(3)]
+        for t in threads:
+            t.start()
+        self.assertTrue(wait_for
+            (lambda: self.pool.pool_stats()['outstanding'] >= 3))
+        s = self.pool.pool_stats()
+        self.assertEqual(s['by_member'], [1, 1, 1])
+        self.assertEqual(s['utilization'], 1.0)
+        for t in threads:
+            t.join()
+        self.assertEqual(results.qsize(), 3)
+        s = self.pool.pool_stats()
+        self.assertEqual(s['outstanding'], 0)
+        self.assertEqual(s['actions'], 4)
+        self.assertEqual(s['peak_outstanding'], 3)
+        self.assertEqual(s['connected'], 3)
+
+    def test_health(self):
+        dead = self.pool.members()[1]
+        dead.close()
+        self.pool.check()
+        self.assertFalse(dead in self.pool.members())
+        s = self.pool.pool_stats()
+        self.assertEqual(s['connected'], 3)
+        self.assertEqual(s['health_failures'], 1)
+        self.assertEqual(s['replacements'], 1)
+        self.assertRaises(ManagerException, self.pool.login, 'a', 'b')
+
+    def test_down(self):
+        # a refused connection is a ManagerException for the health
+        # thread, also on python 3
+        self.astemu.close()
+        self.pool.check()
+        self.assertEqual(self.pool.pool_stats()['connected'], 0)
+        pool = ManagerPool('localhost', self.astemu.port, size = 1)
+        self.assertRaises(ManagerSocketException, pool.start)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ManagerPool))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
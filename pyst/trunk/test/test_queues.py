@@ -0,0 +1,76 @@
+import unittest
+from   asterisk.manager import ManagerMsg, Event
+from   asterisk.queues import QueueStats
+
+class Test_QueueStats(unittest.TestCase):
+    """ Test the queue statistics aggregated from events.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.stats = QueueStats(intervals = (60, 600), slots = 6,
+            clock = lambda: self.now)
+        self.handlers = dict(self.stats._handlers())
+
+    def event(self, name, **headers):
+        raw = 'Event: %s\r\n' % name + ''.join \
+            ('%s: %s\r\n' % item for item in sorted(headers.items()))
+        self.handlers[name](Event(ManagerMsg(raw)), None)
+
+    def test_queue(self):
+        for interface in 'SIP/100', 'SIP/101', 'SIP/102':
+            self.event('QueueMemberAdded', Queue = 'support',
+                Interface = interface, Status = '1', Paused = '0')
+        self.event('QueueMemberPause', Queue = 'support',
+            Interface = 'SIP/102', Paused = '1')
+        self.event('QueueMemberStatus', Queue = 'support',
+            Interface = 'SIP/101', Status = '2', Paused = '0')
+        self.event('QueueCallerJoin', Queue = 'support', Uniqueid = 'a')
+        self.now += 5
+        self.event('QueueCallerJoin', Queue = 'support', Uniqueid = 'b')
+        self.event('Join', Queue = 'sales', Uniqueid = 'c')
+        self.now += 10
+        s = self.stats.snapshot()
+        self.assertEqual(sorted(s), ['sales', 'support'])
+        q = s['support']
+        self.assertEqual((q['waiting'], q['longest_wait']), (2, 15))
+        self.assertEqual((q['members'], q['available'], q['paused']), (3, 1, 1))
+        self.assertEqual(q['windows'][60]['service_level'], None)
+
+        # a answered after 15s, b abandoned after 40s
+        self.event('AgentConnect', Queue = 'support', Uniqueid = 'a',
+            HoldTime = '15', Interface = 'SIP/100')
+        self.event('QueueCallerLeave', Queue = 'support', Uniqueid = 'a')
+        self.now += 30
+        self.event('QueueCallerAbandon', Queue = 'support', Uniqueid = 'b',
+            HoldTime = '40')
+        self.event('AgentComplete', Queue = 'support', Uniqueid = 'a',
+            HoldTime = '15', TalkTime = '30')
+        q = self.stats.queue('support')
+        self.assertEqual((q['waiting'], q['longest_wait']), (0, 0))
+        w = q['windows'][60]
+        self.assertEqual((w['answered'], w['abandoned'], w['completed']),
+            (1, 1, 1))
+        self.assertEqual(w['service_level'], 0.5)
+        self.assertEqual((w['average_hold'], w['average_talk']), (15.0, 30.0))
+        self.assertEqual(self.stats.queue('sales')['waiting'], 1)
+        self.assertEqual(self.stats.queue('unknown'), None)
+
+        # the calls drop out of the short window, but not the long one
+        self.now += 60
+        q = self.stats.queue('support')
+        self.assertEqual(q['windows'][60]['answered'], 0)
+        self.assertEqual(q['windows'][60]['service_level'], None)
+        self.assertEqual(q['windows'][600]['answered'], 1)
+        self.event('QueueMemberRemoved', Queue = 'support',
+            Interface = 'SIP/102')
+        q = self.stats.queue('support')
+        self.assertEqual((q['members'], q['available'], q['paused']), (2, 1, 0))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_QueueStats))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from   asterisk.stats import Histogram, ManagerStats, callback_name
+
+class Test_Stats(unittest.TestCase):
+    """ Test the histograms of the manager instrumentation.
+    """
+
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), None)
+        for k in range(99):
+            h.add(0.0003)
+        h.add(2.5)
+        s = h.snapshot()
+        self.assertEqual(s['count'], 100)
+        self.assertEqual(s['min'], 0.0003)
+        self.assertEqual(s['max'], 2.5)
+        self.assertAlmostEqual(s['mean'], (99 * 0.0003 + 2.5) / 100)
+        # percentiles are the upper bound of their bucket
+        self.assertTrue(0.0003 <= s['p50'] < 0.0006)
+        self.assertEqual(s['p50'], s['p90'])
+        self.assertEqual(s['p99'], s['p50'])
+        self.assertEqual(h.percentile(100), 2.5)
+        self.assertEqual(sorted(s['buckets'].values()), [1, 99])
+        h.add(1e6)
+        self.assertEqual(h.snapshot()['buckets'][None], 1)
+
+    def test_hooks(self):
+        stats = ManagerStats()
+        seen = []
+        def hook(kind, name, seconds):
+            seen.append((kind, name, seconds))
+        stats.add_hook(hook)
+        stats.record('action', 'Ping', 0.01)
+        stats.record('action', 'Ping', 0.02)
+        stats.remove_hook(hook)
+        stats.record('parse', 'Hangup', 0.001)
+        self.assertEqual(seen,
+            [('action', 'Ping', 0.01), ('action', 'Ping', 0.02)])
+        s = stats.snapshot()
+        self.assertEqual(s['action']['Ping']['count'], 2)
+        self.assertEqual(s['parse']['Hangup']['count'], 1)
+        self.assertEqual(s['callback'], {})
+        self.assertEqual(callback_name(self.test_hooks),
+            'test.test_stats.Test_Stats.test_hooks')
+        stats.reset()
+        self.assertEqual(stats.snapshot()['action'], {})
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_Stats))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()